@@ -1,39 +1,90 @@
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from database import get_db
-from models import User, Order, Courier, Promocode, UserRole
-from typing import List
+from database import get_async_db
+from models import User, Promocode, UserRole
+from typing import Optional
+from pydantic import BaseModel
+from auth import get_current_user
+from order_stats import order_stats
+from order_export import DATASETS, FORMATS, export_stream
+from promocode_service import PromocodeService
+from sqlite_writer import run_write
 
 admin_router = APIRouter(prefix="/admin", tags=["admin"])
 
+class PromocodeCreate(BaseModel):
+    code: str
+    discount_percent: Optional[float] = None
+    discount_amount: Optional[float] = None
+    valid_from: datetime
+    valid_to: datetime
+    max_uses: Optional[int] = None
+    is_active: bool = True
+
 def admin_required(user: User = Depends(get_current_user)):
     if user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Требуются права администратора")
     return user
 
 @admin_router.get("/statistics")
-async def get_statistics(
-    admin: User = Depends(admin_required),
-    db: Session = Depends(get_db)
-):
-    total_orders = db.query(Order).count()
-    active_couriers = db.query(Courier).filter(Courier.is_available == True).count()
-    total_revenue = db.query(func.sum(Order.total_price))\
-        .filter(Order.status == OrderStatus.DELIVERED).scalar() or 0
-    
+async def get_statistics(admin: User = Depends(admin_required)):
+    # Итоги поддерживаются инкрементально, запрос читает один хэш Redis
+    summary = await order_stats.summary()
     return {
-        "total_orders": total_orders,
-        "active_couriers": active_couriers,
-        "total_revenue": total_revenue
+        "total_orders": summary["orders_created"],
+        "active_couriers": summary.get("active_couriers", 0),
+        "total_revenue": summary["revenue"],
+        **summary
     }
 
+@admin_router.get("/statistics/range")
+async def get_statistics_range(
+    start: datetime,
+    end: datetime,
+    granularity: str = Query("hour", regex="^(hour|day)$"),
+    admin: User = Depends(admin_required)
+):
+    try:
+        buckets = await order_stats.series(start, end, granularity)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Слишком большой диапазон, уменьшите период или укрупните шаг")
+    return {"granularity": granularity, "buckets": buckets}
+
+@admin_router.get("/exports/{dataset}")
+async def export_data(
+    dataset: str,
+    start: datetime,
+    end: datetime,
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    gzip: bool = False,
+    admin: User = Depends(admin_required)
+):
+    if dataset not in DATASETS:
+        raise HTTPException(status_code=404, detail=f"Неизвестный набор данных: {dataset}")
+    
+    filename = f"{dataset}-{start:%Y%m%d}-{end:%Y%m%d}.{format}" + (".gz" if gzip else "")
+    return StreamingResponse(
+        export_stream(dataset, start, end, format, gzip),
+        media_type="application/gzip" if gzip else FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 @admin_router.post("/promocodes")
 async def create_promocode(
     promocode: PromocodeCreate,
     admin: User = Depends(admin_required),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    db_promocode = Promocode(**promocode.dict())
-    db.add(db_promocode)
-    db.commit()
-    return db_promocode 
\ No newline at end of file
+    def write(session: Session):
+        db_promocode = Promocode(**promocode.dict(), current_uses=0)
+        session.add(db_promocode)
+        session.flush()
+        return db_promocode.id
+    
+    promocode_id = await run_write(db, write)
+    # Сбрасываем закэшированный промах по этому коду
+    await PromocodeService.invalidate(promocode.code)
+    return {"id": promocode_id, **promocode.dict()} 
\ No newline at end of file
@@ -1,24 +1,30 @@
-import secrets
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy import select
+from database import AsyncSessionLocal
 from models import User
 from config import get_settings
+from cache import async_redis_client, cache_key
+from logger import logger
 from pydantic import BaseModel
 
-# Генерируем безопасный ключ
-SECRET_KEY = secrets.token_urlsafe(32)
-ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Refresh-токены подписаны тем же ключом, поэтому помечены и не принимаются вместо access-токена
+REFRESH_TOKEN_TYPE = "refresh"
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 settings = get_settings()
 
+AUTH_INVALIDATION_CHANNEL = "auth:invalidate"
+
 class Token(BaseModel):
     access_token: str
     refresh_token: str
@@ -27,33 +33,204 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     email: Optional[str] = None
 
+class Principal:
+    # Минимальные данные о пользователе из токена; совместимы с User по id, email и role
+    __slots__ = ("id", "email", "role")
+
+    def __init__(self, id: int, email: str, role: str):
+        self.id = id
+        self.email = email
+        self.role = role
+
+def token_claims(user: User) -> dict:
+    return {"sub": user.email, "uid": user.id, "role": user.role}
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+# Кэш проверенных токенов: хэш токена -> Principal.
+# Отозванные токены и момент, раньше которого токены пользователя недействительны, хранятся в Redis
+# с TTL на время жизни токена (их видят и воркеры, запущенные позже); pub/sub лишь сбрасывает кэши воркеров.
+# Локальные копии нужны на случай недоступности Redis.
+class PrincipalCache:
+    def __init__(self, maxsize: int, ttl: float, token_lifetime: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.token_lifetime = token_lifetime
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._revoked: Dict[str, float] = {}
+        self._user_not_before: Dict[int, float] = {}
+        self._listener: Optional[asyncio.Task] = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Principal]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, principal = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return principal
+
+    def peek(self, key: str) -> Optional[Principal]:
+        # Чтение без учета в статистике и без продвижения в LRU (для rate limiter)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def put(self, key: str, principal: Principal, token_exp: float):
+        self._entries[key] = (min(time.time() + self.ttl, token_exp), principal)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def is_revoked(self, key: str, user_id: Optional[int], issued_at: Optional[int]) -> bool:
+        try:
+            revoked, not_before = await async_redis_client.mget(
+                cache_key("auth", "revoked", key), cache_key("auth", "not_before", user_id)
+            )
+        except Exception as e:
+            logger.warning("Auth revocation lookup failed, using local state: %s", e)
+            revoked = key in self._revoked
+            not_before = self._user_not_before.get(user_id)
+        if revoked:
+            return True
+        # iat и not_before — целые секунды; токен, выданный в секунду инвалидации, тоже отклоняется
+        return not_before is not None and (issued_at or 0) <= int(not_before)
+
+    def apply_revoke(self, key: str, token_exp: float):
+        self._entries.pop(key, None)
+        self._revoked[key] = token_exp
+        now = time.time()
+        # Истекшие токены в списке отзыва больше не нужны
+        for revoked_key in [k for k, exp in self._revoked.items() if exp <= now]:
+            del self._revoked[revoked_key]
+
+    def apply_user_invalidation(self, user_id: int, not_before: int):
+        self._user_not_before[user_id] = not_before
+        # Через время жизни токена все токены, выданные до not_before, уже истекли
+        expired_before = time.time() - self.token_lifetime
+        for stale_user in [u for u, value in self._user_not_before.items() if value <= expired_before]:
+            del self._user_not_before[stale_user]
+        for key in [k for k, (_, principal) in self._entries.items() if principal.id == user_id]:
+            del self._entries[key]
+
+    async def _listen(self):
+        pubsub = async_redis_client.pubsub()
+        await pubsub.subscribe(AUTH_INVALIDATION_CHANNEL)
+        try:
+            while True:
+                try:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                except Exception as e:
+                    logger.warning("Auth invalidation listener error: %s", e)
+                    # Пропущенные события могли быть важны — сбрасываем кэш целиком
+                    self._entries.clear()
+                    await asyncio.sleep(1.0)
+                    continue
+                if not message or message["type"] != "message":
+                    continue
+                kind, value, timestamp = message["data"].decode().split(":", 2)
+                if kind == "token":
+                    self.apply_revoke(value, float(timestamp))
+                elif kind == "user":
+                    self.apply_user_invalidation(int(value), int(float(timestamp)))
+        finally:
+            await pubsub.close()
+
+    def start(self):
+        if self._listener is None:
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is None:
+            return
+        self._listener.cancel()
+        try:
+            await self._listener
+        except asyncio.CancelledError:
+            pass
+        self._listener = None
+
+principal_cache = PrincipalCache(
+    maxsize=settings.AUTH_CACHE_MAXSIZE,
+    ttl=settings.AUTH_CACHE_TTL_SECONDS,
+    # Токены без явного срока живут 15 минут (create_access_token)
+    token_lifetime=max(settings.ACCESS_TOKEN_EXPIRE_MINUTES, 15) * 60
+)
+
+async def _publish_invalidation(message: str, key: str, value, ttl: int):
+    # Запись в Redis и рассылка одним запросом
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        pipe.set(key, value, ex=max(ttl, 1))
+        pipe.publish(AUTH_INVALIDATION_CHANNEL, message)
+        await pipe.execute()
+    except Exception as e:
+        logger.error("Failed to publish auth invalidation: %s", e)
+
+async def revoke_token(token: str):
+    # Выход из системы: токен перестает приниматься всеми воркерами до своего истечения
+    try:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        token_exp = float(payload.get("exp", time.time()))
+    except JWTError:
+        return
+    key = token_hash(token)
+    principal_cache.apply_revoke(key, token_exp)
+    await _publish_invalidation(
+        f"token:{key}:{token_exp}", cache_key("auth", "revoked", key), 1, int(token_exp - time.time()) + 1
+    )
+
+async def invalidate_user(user_id: int):
+    # Смена роли или блокировка: все ранее выданные токены пользователя перестают действовать
+    not_before = int(time.time())
+    principal_cache.apply_user_invalidation(user_id, not_before)
+    await _publish_invalidation(
+        f"user:{user_id}:{not_before}", cache_key("auth", "not_before", user_id), not_before,
+        principal_cache.token_lifetime
+    )
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    to_encode.update({"exp": expire, "iat": int(time.time())})
+    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
 def create_refresh_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "typ": REFRESH_TOKEN_TYPE})
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Неверные учетные данные",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    # Быстрый путь: токен уже проверялся, ни декодирования, ни запроса в БД
+    key = token_hash(token)
+    principal = principal_cache.get(key)
+    if principal is not None:
+        return principal
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         email: str = payload.get("sub")
-        if email is None:
+        if email is None or payload.get("typ") == REFRESH_TOKEN_TYPE:
             raise credentials_exception
         exp = payload.get("exp")
         if exp is None or datetime.utcnow() > datetime.fromtimestamp(exp):
@@ -64,26 +241,20 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
             )
     except JWTError:
         raise credentials_exception
-    user = db.query(User).filter(User.email == email).first()
-    if user is None:
+    
+    user_id = payload.get("uid")
+    role = payload.get("role")
+    if await principal_cache.is_revoked(key, user_id, payload.get("iat")):
         raise credentials_exception
-    return user 
-
-@app.post("/refresh-token")
-async def refresh_token(refresh_token: str, db: Session = Depends(get_db)):
-    try:
-        payload = jwt.decode(refresh_token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise HTTPException(status_code=401, detail="Invalid refresh token")
-        
-        user = db.query(User).filter(User.email == email).first()
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        
-        access_token = create_access_token(data={"sub": user.email})
-        new_refresh_token = create_refresh_token(data={"sub": user.email})
-        
-        return {"access_token": access_token, "refresh_token": new_refresh_token, "token_type": "bearer"}
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid refresh token") 
\ No newline at end of file
+    if user_id is not None and role is not None:
+        principal = Principal(user_id, email, role)
+    else:
+        # Токены старого формата без uid/role — один раз сверяемся с БД
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(User).where(User.email == email))
+            user = result.scalars().first()
+        if user is None:
+            raise credentials_exception
+        principal = Principal(user.id, user.email, user.role)
+    principal_cache.put(key, principal, float(exp))
+    return principal
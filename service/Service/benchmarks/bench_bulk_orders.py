@@ -0,0 +1,109 @@
+# Пропускная способность создания заказов: путь POST /orders/ (заказ за заказом, транзакция на каждый)
+# против OrderService.bulk_insert (пачка в одной транзакции). Пишет в DATABASE_URL.
+#   python benchmarks/bench_bulk_orders.py --orders 5000 --items 3 --batch 500
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal, init_db
+from models import Customer, Order, OrderItem
+from order_service import OrderService
+from main import OrderCreate
+
+def make_orders(count: int, items: int, customer_id: int, seed: int):
+    rng = random.Random(seed)
+    return [
+        OrderCreate(
+            customer_id=customer_id,
+            delivery_address=f"ул. Ленина, {i}",
+            delivery_latitude=rng.uniform(55.57, 55.91),
+            delivery_longitude=rng.uniform(37.37, 37.84),
+            items=[
+                {"product_name": f"Товар {j}", "quantity": rng.randint(1, 3), "price": rng.randint(100, 1000)}
+                for j in range(items)
+            ]
+        )
+        for i in range(count)
+    ]
+
+def seed_customer() -> int:
+    db = SessionLocal()
+    try:
+        customer = Customer(name="Партнер", address="ул. Ленина, 1", phone="+70000000000",
+                            email=f"partner{time.time_ns()}@example.com")
+        db.add(customer)
+        db.commit()
+        return customer.id
+    finally:
+        db.close()
+
+def per_order(orders) -> float:
+    # Как create_order: ORM-объекты, flush ради id и отдельная транзакция на каждый заказ
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        for order in orders:
+            db_order = Order(
+                customer_id=order.customer_id,
+                delivery_address=order.delivery_address,
+                delivery_latitude=order.delivery_latitude,
+                delivery_longitude=order.delivery_longitude,
+                total_price=sum(item["price"] * item["quantity"] for item in order.items)
+            )
+            db.add(db_order)
+            db.flush()
+            for item in order.items:
+                db.add(OrderItem(order_id=db_order.id, product_name=item["product_name"],
+                                 quantity=item["quantity"], price=item["price"]))
+            db.commit()
+    finally:
+        db.close()
+    return time.perf_counter() - started
+
+def bulk(orders, batch: int) -> float:
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        for start in range(0, len(orders), batch):
+            OrderService.bulk_insert(db, orders[start:start + batch])
+            db.commit()
+    finally:
+        db.close()
+    return time.perf_counter() - started
+
+def check_items(order_ids, orders):
+    # Позиции должны оказаться у своих заказов, а не у соседей по пачке
+    db = SessionLocal()
+    try:
+        for order_id, order in zip(order_ids, orders):
+            names = sorted(name for name, in db.query(OrderItem.product_name).filter(OrderItem.order_id == order_id))
+            assert names == sorted(item["product_name"] for item in order.items), order_id
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--items", type=int, default=3)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    init_db()
+    customer_id = seed_customer()
+    orders = make_orders(args.orders, args.items, customer_id, args.seed)
+    elapsed = per_order(orders)
+    print(f"per-order: {args.orders} orders in {elapsed:.2f}s, {args.orders / elapsed:.0f} orders/s")
+    elapsed = bulk(orders, args.batch)
+    print(f"bulk by {args.batch}: {args.orders} orders in {elapsed:.2f}s, {args.orders / elapsed:.0f} orders/s")
+    db = SessionLocal()
+    try:
+        sample = orders[:args.batch]
+        order_ids = OrderService.bulk_insert(db, sample)
+        db.commit()
+    finally:
+        db.close()
+    check_items(order_ids, sample)
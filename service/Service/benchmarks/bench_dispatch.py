@@ -0,0 +1,95 @@
+# Пропускная способность пакетного назначения: 10k заказов x 2k курьеров.
+#   python benchmarks/bench_dispatch.py                   # только снимок индекса и сопоставление в памяти
+#   python benchmarks/bench_dispatch.py --db              # полный run_once с записью в DATABASE_URL (пустая БД)
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import engine, init_db
+from models import Courier, Order, OrderStatus, User
+from spatial_index import CourierSpatialIndex
+from courier_ratings import courier_ratings
+from dispatch import DispatchEngine
+
+# Москва в пределах МКАД
+LAT_RANGE = (55.57, 55.91)
+LON_RANGE = (37.37, 37.84)
+
+def random_point(rng: random.Random):
+    return rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)
+
+def build(orders: int, couriers: int, per_courier: int, seed: int):
+    rng = random.Random(seed)
+    index = CourierSpatialIndex()
+    for courier_id in range(1, couriers + 1):
+        index.update(courier_id, *random_point(rng))
+    index.sync_available(range(1, couriers + 1))
+    engine_ = DispatchEngine(
+        index=index,
+        ratings=courier_ratings,
+        interval_seconds=3600,
+        batch_size=orders,
+        candidates_per_order=8,
+        max_orders_per_courier=per_courier,
+        max_distance_km=15.0,
+        rating_weight_km=0.5
+    )
+    batch = [(order_id, *random_point(rng)) for order_id in range(1, orders + 1)]
+    return engine_, batch
+
+def bench_match(orders: int, couriers: int, per_courier: int, seed: int):
+    engine_, batch = build(orders, couriers, per_courier, seed)
+    capacity = {courier_id: per_courier for courier_id in range(1, couriers + 1)}
+    started = time.perf_counter()
+    snapshot = engine_.index.snapshot(capacity.keys())
+    snapshot_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    assignments = engine_.match(snapshot, batch, capacity)
+    match_seconds = time.perf_counter() - started
+    print(f"snapshot of {couriers} couriers: {snapshot_seconds * 1000:.1f}ms (on the event loop)")
+    print(f"match {orders} x {couriers}: {len(assignments)} assigned in {match_seconds:.2f}s, "
+          f"{orders / match_seconds:.0f} orders/s")
+
+def seed_db(batch, couriers: int):
+    init_db()
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {"id": i, "email": f"courier{i}@example.com", "password_hash": "-", "role": "courier"}
+            for i in range(1, couriers + 1)
+        ])
+        conn.execute(Courier.__table__.insert(), [
+            {"id": i, "user_id": i, "name": f"Курьер {i}", "phone": "+70000000000", "is_available": True}
+            for i in range(1, couriers + 1)
+        ])
+        conn.execute(Order.__table__.insert(), [
+            {"id": order_id, "delivery_address": "ул. Ленина", "delivery_latitude": latitude,
+             "delivery_longitude": longitude, "total_price": 100.0, "status": OrderStatus.PAID.value}
+            for order_id, latitude, longitude in batch
+        ])
+
+def bench_db(orders: int, couriers: int, per_courier: int, seed: int):
+    engine_, batch = build(orders, couriers, per_courier, seed)
+    seed_db(batch, couriers)
+    started = time.perf_counter()
+    assigned = asyncio.run(engine_.run_once())
+    elapsed = time.perf_counter() - started
+    print(f"run_once {orders} x {couriers}: {len(assigned)} assigned and written in {elapsed:.2f}s, "
+          f"{len(assigned) / elapsed:.0f} assignments/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--couriers", type=int, default=2000)
+    parser.add_argument("--per-courier", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", action="store_true")
+    args = parser.parse_args()
+    if args.db:
+        bench_db(args.orders, args.couriers, args.per_courier, args.seed)
+    else:
+        bench_match(args.orders, args.couriers, args.per_courier, args.seed)
@@ -0,0 +1,72 @@
+# Нагрузочная проверка выгрузок: память процесса не должна расти с размером выгрузки.
+#   python benchmarks/bench_export.py --seed 5000000           # заполнить orders в DATABASE_URL
+#   python benchmarks/bench_export.py orders --format csv --gzip
+# Каждый прогон — отдельный процесс, чтобы пиковый RSS относился к одной выгрузке.
+import argparse
+import os
+import resource
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import engine, init_db
+from models import Customer, Order, OrderStatus
+from order_export import DATASETS, export_stream
+
+SEED_CHUNK = 50000
+SEED_CUSTOMERS = 1000
+
+def seed(count: int):
+    init_db()
+    table = Order.__table__
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        if not conn.execute(Customer.__table__.select().limit(1)).first():
+            conn.execute(Customer.__table__.insert(), [
+                {"id": i, "name": f"Клиент {i}", "address": "ул. Ленина", "phone": "+70000000000", "email": f"c{i}@example.com"}
+                for i in range(1, SEED_CUSTOMERS + 1)
+            ])
+        first_id = (conn.execute(table.select().with_only_columns([table.c.id]).order_by(table.c.id.desc()).limit(1)).scalar() or 0) + 1
+    for offset in range(0, count, SEED_CHUNK):
+        rows = [
+            {
+                "id": first_id + i,
+                "customer_id": i % SEED_CUSTOMERS + 1,
+                "status": OrderStatus.DELIVERED.value,
+                "created_at": datetime(2024, i % 12 + 1, i % 28 + 1, 12),
+                "delivery_address": f"ул. Ленина, {i}",
+                "delivery_latitude": 55.7,
+                "delivery_longitude": 37.6,
+                "total_price": float(i % 500),
+                "payment_status": "completed",
+                "payment_id": f"pi_{i}",
+                "version": 1,
+            }
+            for i in range(offset, min(offset + SEED_CHUNK, count))
+        ]
+        with engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+    print(f"seeded {count} orders in {time.perf_counter() - started:.1f}s")
+
+def run(dataset: str, fmt: str, gzip: bool):
+    started = time.perf_counter()
+    size = 0
+    for chunk in export_stream(dataset, datetime(2000, 1, 1), datetime(2100, 1, 1), fmt, gzip):
+        size += len(chunk)
+    elapsed = time.perf_counter() - started
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{dataset} {fmt}{' gzip' if gzip else ''}: {size / 2 ** 20:.1f}MiB in {elapsed:.1f}s, peak RSS {max_rss:.0f}MiB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset", nargs="?", choices=sorted(DATASETS), default="orders")
+    parser.add_argument("--format", choices=("ndjson", "csv"), default="ndjson")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.seed:
+        seed(args.seed)
+    else:
+        run(args.dataset, args.format, args.gzip)
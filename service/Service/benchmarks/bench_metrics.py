@@ -0,0 +1,83 @@
+# Накладные расходы метрик на запрос (бюджет — 50us): middleware, пара хуков запроса к БД, обертка команды Redis.
+#   python benchmarks/bench_metrics.py --iterations 100000
+# Внешние сервисы не нужны: приложение ASGI пустое, БД и Redis заменены заглушками на уровне вызова.
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redis import Redis
+from metrics import InstrumentedRedis, MetricsMiddleware, _after_cursor_execute, _before_cursor_execute, _request_db
+
+QUERIES_PER_REQUEST = 5
+REDIS_COMMANDS_PER_REQUEST = 3
+
+async def empty_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+async def receive():
+    return {"type": "http.request", "body": b""}
+
+async def send(message):
+    pass
+
+def per_call(elapsed: float, iterations: int) -> float:
+    return elapsed / iterations * 1e6
+
+async def bench_middleware(iterations: int) -> float:
+    app = MetricsMiddleware(empty_app)
+    scope = {"type": "http", "method": "GET", "path": "/orders/1", "endpoint": empty_app, "app": None}
+    app._templates = {empty_app: "/orders/{order_id}"}
+    for target in (empty_app, app):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            await target(scope, receive, send)
+        elapsed = time.perf_counter() - started
+        if target is empty_app:
+            baseline = elapsed
+    return per_call(elapsed - baseline, iterations)
+
+class FakeContext:
+    compiled = object()
+    isinsert = isupdate = isdelete = False
+
+def bench_query_hooks(iterations: int) -> float:
+    token = _request_db.set([0, 0.0])
+    context = FakeContext()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        _before_cursor_execute(None, None, "", (), context, False)
+        _after_cursor_execute(None, None, "", (), context, False)
+    elapsed = time.perf_counter() - started
+    _request_db.reset(token)
+    return per_call(elapsed, iterations)
+
+def bench_redis_wrapper(iterations: int) -> float:
+    # Базовый execute_command заменен на возврат без сети: остается только стоимость обертки
+    Redis.execute_command = lambda self, *args, **options: None
+    plain = Redis()
+    instrumented = InstrumentedRedis()
+    results = []
+    for client in (plain, instrumented):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            client.execute_command("GET", "key")
+        results.append(time.perf_counter() - started)
+    return per_call(results[1] - results[0], iterations)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+    middleware = asyncio.run(bench_middleware(args.iterations))
+    hooks = bench_query_hooks(args.iterations)
+    wrapper = bench_redis_wrapper(args.iterations)
+    total = middleware + QUERIES_PER_REQUEST * hooks + REDIS_COMMANDS_PER_REQUEST * wrapper
+    print(f"middleware: {middleware:.1f}us per request")
+    print(f"query hooks: {hooks:.1f}us per query")
+    print(f"redis wrapper: {wrapper:.1f}us per command")
+    print(f"request with {QUERIES_PER_REQUEST} queries and {REDIS_COMMANDS_PER_REQUEST} redis commands: {total:.1f}us")
@@ -0,0 +1,218 @@
+# Нагрузочный тест push-уведомлений: N простаивающих SSE-соединений к одному процессу сервиса.
+#   python benchmarks/bench_notification_push.py --connections 50000 --users 10000
+# Скрипт сам запускает uvicorn с одним воркером (окружение — как у сервиса: DATABASE_URL, REDIS_URL, ...),
+# заводит пользователей push{N}@example.com и получает им токены через /token,
+# открывает соединения к /notifications/stream, меряет память процесса на соединение, затем публикует
+# по одному событию на пользователя через Redis-мост и ждет, пока событие дойдет до каждого соединения.
+# Клиент и сервер держат по дескриптору на соединение: лимит открытых файлов поднимается до жесткого,
+# для 50k соединений он должен быть не меньше ~101000 (ulimit -Hn).
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+
+# Дешевый хэш паролей у тестовых пользователей, чтобы логин не упирался в PBKDF2
+os.environ["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:1000"
+
+import redis
+from sqlalchemy import select
+from werkzeug.security import generate_password_hash
+from database import SessionLocal, init_db
+from models import User
+from notification_hub import PUSH_CHANNEL, notification_event
+from config import get_settings
+
+settings = get_settings()
+
+PASSWORD = "push-bench"
+
+def seed_users(users: int) -> list:
+    init_db()
+    emails = [f"push{i}@example.com" for i in range(1, users + 1)]
+    db = SessionLocal()
+    try:
+        existing = set(db.execute(select(User.email).where(User.email.in_(emails))).scalars())
+        password_hash = generate_password_hash(PASSWORD, method=settings.PASSWORD_HASH_METHOD)
+        missing = [
+            {"email": email, "password_hash": password_hash, "role": "customer"}
+            for email in emails if email not in existing
+        ]
+        if missing:
+            db.execute(User.__table__.insert(), missing)
+        db.commit()
+        return db.execute(select(User.id, User.email).where(User.email.in_(emails))).all()
+    finally:
+        db.close()
+
+async def http_request(port: int, request: str) -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(request.encode())
+        status = await reader.readline()
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+        body = await reader.readexactly(length)
+        if b" 200 " not in status:
+            raise RuntimeError(f"{status.decode().strip()} {body[:200]!r}")
+        return body
+    finally:
+        writer.close()
+
+async def login_all(port: int, users: list, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login(user_id: int, email: str):
+        form = f"username={email}&password={PASSWORD}"
+        async with semaphore:
+            body = await http_request(port, (
+                f"POST /token HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n"
+                f"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {len(form)}\r\n\r\n{form}"
+            ))
+        return user_id, json.loads(body)["access_token"]
+
+    return dict(await asyncio.gather(*(login(user_id, email) for user_id, email in users)))
+
+def raise_fd_limit() -> int:
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def start_server(port: int) -> subprocess.Popen:
+    env = dict(os.environ, RATE_LIMIT_PER_MINUTE=str(10 ** 9), NOTIFICATION_PUSH_REDIS_BRIDGE="true",
+               OUTBOX_ENABLED="false", DISPATCH_ENABLED="false")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning",
+         "--no-access-log", "--backlog", "65535"],
+        cwd=SERVICE_DIR, env=env
+    )
+
+async def wait_for_server(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Service did not start")
+
+class Connection:
+    __slots__ = ("user_id", "reader", "writer", "received_at")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.reader = self.writer = None
+        self.received_at = None
+
+    async def open(self, port: int, token: str):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.writer.write(
+            f"GET /notifications/stream HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+            f"Authorization: Bearer {token}\r\nAccept: text/event-stream\r\n\r\n".encode()
+        )
+        status = await self.reader.readline()
+        if b" 200 " not in status:
+            raise RuntimeError(status.decode().strip())
+        while await self.reader.readline() not in (b"\r\n", b""):
+            pass
+
+    async def wait_event(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            if line.startswith(b"event: notification"):
+                self.received_at = time.perf_counter()
+                return
+
+async def open_all(connections, port: int, tokens: dict, concurrency: int) -> int:
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def open_one(connection: Connection):
+        nonlocal failed
+        async with semaphore:
+            try:
+                await connection.open(port, tokens[connection.user_id])
+            except Exception as e:
+                failed += 1
+                if failed <= 5:
+                    print(f"connection for user {connection.user_id} failed: {e!r}")
+
+    await asyncio.gather(*(open_one(connection) for connection in connections))
+    return failed
+
+async def run(connections_count: int, users: int, port: int, concurrency: int, idle_seconds: float):
+    print(f"open files limit: {raise_fd_limit()}")
+    accounts = seed_users(users)
+    server = start_server(port)
+    try:
+        await wait_for_server(port)
+        started = time.perf_counter()
+        tokens = await login_all(port, accounts, min(concurrency, settings.PASSWORD_HASH_MAX_WAITING))
+        print(f"logged in {len(tokens)} users in {time.perf_counter() - started:.1f}s")
+        baseline = rss_mb(server.pid)
+        user_ids = sorted(tokens)
+        connections = [Connection(user_ids[i % len(user_ids)]) for i in range(connections_count)]
+        started = time.perf_counter()
+        failed = await open_all(connections, port, tokens, concurrency)
+        opened = connections_count - failed
+        print(f"opened {opened} of {connections_count} connections in {time.perf_counter() - started:.1f}s")
+
+        await asyncio.sleep(idle_seconds)
+        rss = rss_mb(server.pid)
+        print(f"server RSS: {baseline:.0f}MB idle, {rss:.0f}MB with {opened} connections, "
+              f"{(rss - baseline) * 1024 / max(opened, 1):.1f}KB per connection")
+
+        live = [connection for connection in connections if connection.writer is not None]
+        waiters = [asyncio.ensure_future(connection.wait_event()) for connection in live]
+        client = redis.Redis.from_url(settings.REDIS_URL)
+        pipe = client.pipeline(transaction=False)
+        for user_id in user_ids:
+            message = json.dumps(notification_event("order_status", "Нагрузочный тест"), default=str)
+            pipe.publish(PUSH_CHANNEL, json.dumps({"o": "bench", "u": user_id, "m": message}))
+        published = time.perf_counter()
+        pipe.execute()
+        done, pending = await asyncio.wait(waiters, timeout=60)
+        delays = sorted(connection.received_at - published for connection in live if connection.received_at)
+        if delays:
+            print(f"fan-out of {users} events to {len(delays)} connections: "
+                  f"p50 {delays[len(delays) // 2] * 1000:.0f}ms, max {delays[-1] * 1000:.0f}ms, "
+                  f"{len(pending)} not delivered in 60s")
+        for waiter in pending:
+            waiter.cancel()
+        for connection in live:
+            connection.writer.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--idle-seconds", type=float, default=5.0)
+    args = parser.parse_args()
+    asyncio.run(run(args.connections, args.users, args.port, args.concurrency, args.idle_seconds))
@@ -0,0 +1,120 @@
+# Конкурентные переходы статуса заказа: потоки с отдельными сессиями бьют по небольшому набору заказов
+# случайными переходами (часть — с expected_version, прочитанной заранее и, возможно, уже устаревшей).
+# После прогона проверяется, что ни один принятый переход не потерян: версия каждого заказа равна
+# 1 + число принятых переходов, tracking_updates — по записи на переход, цепочка статусов допустима.
+# Пишет в DATABASE_URL мимо писателя SQLite — так же, как писали бы воркеры с Postgres.
+#   python benchmarks/bench_order_transitions.py --orders 500 --threads 16 --transitions 5000
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+from database import SessionLocal, init_db
+from models import Customer, Order, OrderStatus, TrackingUpdate
+from order_state_machine import TRANSITIONS, OrderStateMachine, TransitionRejected
+
+# Отмена редкая, иначе заказы почти сразу уходят в конечный статус
+DELIVERY_PATH = [OrderStatus.PREPARING, OrderStatus.ASSIGNED_TO_COURIER, OrderStatus.IN_DELIVERY, OrderStatus.DELIVERED]
+
+def seed(orders: int) -> list:
+    db = SessionLocal()
+    try:
+        customer = Customer(name="Нагрузка", address="ул. Ленина, 1", phone="+70000000000",
+                            email=f"transitions{time.time_ns()}@example.com")
+        db.add(customer)
+        db.flush()
+        rows = [Order(customer_id=customer.id, delivery_address="ул. Ленина, 1", total_price=100.0,
+                      status=OrderStatus.PAID) for _ in range(orders)]
+        db.add_all(rows)
+        db.commit()
+        return [row.id for row in rows]
+    finally:
+        db.close()
+
+def read_version(order_id: int) -> int:
+    db = SessionLocal()
+    try:
+        return db.execute(select(Order.version).where(Order.id == order_id)).scalar()
+    finally:
+        db.close()
+
+def run(order_ids: list, threads: int, transitions: int, seed_value: int):
+    accepted = defaultdict(list)
+    counts = defaultdict(int)
+    lock = threading.Lock()
+
+    def worker(index: int):
+        rng = random.Random(seed_value * 1000 + index)
+        order_id = rng.choice(order_ids)
+        status = OrderStatus.CANCELLED if rng.random() < 0.05 else rng.choice(DELIVERY_PATH)
+        expected_version = read_version(order_id) if rng.random() < 0.3 else None
+        db = SessionLocal()
+        try:
+            event = OrderStateMachine.transition(db, order_id, status, "склад", None, expected_version)
+            db.commit()
+            outcome = "accepted"
+        except TransitionRejected:
+            db.rollback()
+            event, outcome = None, "rejected"
+        except OperationalError:
+            # SQLite: писатель не дождался блокировки — переход не применен
+            db.rollback()
+            event, outcome = None, "busy"
+        finally:
+            db.close()
+        with lock:
+            counts[outcome] += 1
+            if event is not None:
+                accepted[order_id].append((event.version, event.status))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(transitions)))
+    return accepted, counts, time.perf_counter() - started
+
+def verify(order_ids: list, accepted: dict):
+    db = SessionLocal()
+    try:
+        orders = {row.id: row for row in db.execute(
+            select(Order.id, Order.status, Order.version).where(Order.id.in_(order_ids))
+        )}
+        tracking = dict(db.execute(
+            select(TrackingUpdate.order_id, func.count()).where(TrackingUpdate.order_id.in_(order_ids))
+            .group_by(TrackingUpdate.order_id)
+        ).all())
+    finally:
+        db.close()
+    for order_id in order_ids:
+        chain = sorted(accepted.get(order_id, []))
+        order = orders[order_id]
+        assert order.version == 1 + len(chain), (order_id, order.version, chain)
+        assert tracking.get(order_id, 0) == len(chain), (order_id, tracking.get(order_id), chain)
+        assert [version for version, _ in chain] == list(range(2, 2 + len(chain))), (order_id, chain)
+        previous = OrderStatus.PAID
+        for _, status in chain:
+            assert status in TRANSITIONS[previous], (order_id, previous, status)
+            previous = status
+        assert order.status == previous, (order_id, order.status, previous)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--transitions", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    init_db()
+    order_ids = seed(args.orders)
+    accepted, counts, elapsed = run(order_ids, args.threads, args.transitions, args.seed)
+    print(f"{args.transitions} transitions on {args.orders} orders by {args.threads} threads in {elapsed:.2f}s: "
+          f"{counts['accepted']} accepted, {counts['rejected']} rejected, {counts['busy']} busy")
+    verify(order_ids, accepted)
+    print("no lost updates: versions, tracking updates and status chains match accepted transitions")
@@ -0,0 +1,67 @@
+# Микробенчмарк проверки лимита: задержка RateLimiter.check на запрос (Redis из REDIS_URL и локальный fallback).
+#   python benchmarks/bench_rate_limiter.py --requests 20000 --concurrency 50
+#   python benchmarks/bench_rate_limiter.py --algorithm token_bucket --local
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from starlette.requests import Request
+from rate_limiter import RateLimiter
+
+def make_request(index: int, clients: int) -> Request:
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/orders/1",
+        "query_string": b"",
+        "headers": [(b"authorization", f"Bearer random-{index}".encode())],
+        "client": (f"10.0.{index % clients // 256}.{index % clients % 256}", 50000),
+    })
+
+async def run(algorithm: str, requests: int, concurrency: int, clients: int, local: bool):
+    limiter = RateLimiter(
+        algorithm=algorithm,
+        limit=10 ** 9,
+        window_seconds=60,
+        route_limits={},
+        burst=None,
+        redis_retry_seconds=3600 if local else 30,
+        local_max_keys=clients * 2,
+    )
+    if local:
+        limiter._redis_down_until = float("inf")
+    pending = [make_request(i, clients) for i in range(requests)]
+    latencies = []
+
+    async def worker(offset: int):
+        for request in pending[offset::concurrency]:
+            started = time.perf_counter()
+            await limiter.check(request)
+            latencies.append(time.perf_counter() - started)
+
+    # Прогрев: загрузка Lua-скриптов и соединения пула
+    await limiter.check(pending[0])
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(
+        f"{algorithm}{' local' if local else ''}: {requests / elapsed:.0f} checks/s, "
+        f"p50 {statistics.median(latencies) * 1e6:.0f}us, "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f}us"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--algorithm", choices=("sliding_window", "token_bucket"), default="sliding_window")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--local", action="store_true")
+    args = parser.parse_args()
+    asyncio.run(run(args.algorithm, args.requests, args.concurrency, args.clients, args.local))
@@ -0,0 +1,83 @@
+# Тик планировщика маршрутов: сколько занимает пересчет и насколько он задерживает event loop.
+#   python benchmarks/bench_route_planner.py --routes 3000 --stops 5
+# Задержка loop меряется фоновой корутиной, которая просыпается каждую миллисекунду.
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spatial_index import CourierSpatialIndex
+from route_planner import RoutePlanner
+
+# Москва в пределах МКАД
+LAT_RANGE = (55.57, 55.91)
+LON_RANGE = (37.37, 37.84)
+
+def random_point(rng: random.Random):
+    return rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)
+
+def build(routes: int, stops: int, seed: int) -> RoutePlanner:
+    rng = random.Random(seed)
+    index = CourierSpatialIndex()
+    planner = RoutePlanner(index=index, speed_kmh=25.0, stop_service_minutes=5.0,
+                           tick_seconds=3600, min_eta_change_seconds=30.0)
+    order_id = 0
+    for courier_id in range(1, routes + 1):
+        index.update(courier_id, *random_point(rng))
+        for _ in range(stops):
+            order_id += 1
+            planner.add_stop(courier_id, order_id, *random_point(rng))
+    return planner
+
+async def measure_lag(stop: asyncio.Event, lags: list):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + 0.001
+        await asyncio.sleep(0.001)
+        lags.append(loop.time() - expected)
+
+def timed(planner: RoutePlanner, name: str, spent: dict):
+    method = getattr(planner, name)
+
+    def wrapper(*args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            spent[name] = spent.get(name, 0.0) + time.perf_counter() - started
+    setattr(planner, name, wrapper)
+
+async def run(routes: int, stops: int, seed: int):
+    planner = build(routes, stops, seed)
+    spent = {}
+    for name in ("_collect", "_plan", "_apply"):
+        timed(planner, name, spent)
+    for label, prepare in (
+        ("reorder + eta", lambda: None),
+        ("eta only", lambda: [planner.on_location(courier_id) for courier_id in range(1, routes + 1)]),
+    ):
+        prepare()
+        spent.clear()
+        stop, lags = asyncio.Event(), []
+        probe = asyncio.get_running_loop().create_task(measure_lag(stop, lags))
+        await asyncio.sleep(0.01)
+        lags.clear()
+        await planner.tick()
+        stop.set()
+        await probe
+        pending = planner.take_pending_writes()
+        print(f"{label}: {planner.last_tick_routes} routes in {planner.last_tick_seconds * 1000:.0f}ms, "
+              f"{len(pending)} ETA writes; on the loop {(spent['_collect'] + spent['_apply']) * 1000:.0f}ms, "
+              f"in the executor {spent['_plan'] * 1000:.0f}ms; max loop lag {max(lags, default=0.0) * 1000:.1f}ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--routes", type=int, default=3000)
+    parser.add_argument("--stops", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(run(args.routes, args.stops, args.seed))
@@ -1,9 +1,20 @@
-from redis import Redis
-from config import get_settings
+import asyncio
 import json
+import math
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+from redis.asyncio import Redis as AsyncRedis
+from metrics import instrumented_redis, instrumented_async_redis
+from config import get_settings
+from logger import logger
 
 settings = get_settings()
-redis_client = Redis.from_url(settings.REDIS_URL)
+redis_client = instrumented_redis(settings.REDIS_URL, "cache")
+async_redis_client = instrumented_async_redis(settings.REDIS_URL, "cache")
+
+INVALIDATION_CHANNEL = "cache:invalidate"
 
 def cache_key(prefix: str, *args):
     return f"{prefix}:{':'.join(str(arg) for arg in args)}"
@@ -13,4 +24,269 @@ def get_cached_data(key: str):
     return json.loads(data) if data else None
 
 def set_cached_data(key: str, data: dict, expire_seconds: int = 300):
-    redis_client.setex(key, expire_seconds, json.dumps(data)) 
\ No newline at end of file
+    redis_client.setex(key, expire_seconds, json.dumps(data))
+
+class JSONSerializer:
+    name = "json"
+
+    @staticmethod
+    def dumps(value) -> bytes:
+        return json.dumps(value, default=str).encode()
+
+    @staticmethod
+    def loads(data: bytes):
+        return json.loads(data)
+
+class OrjsonSerializer:
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, value) -> bytes:
+        return self._orjson.dumps(value, default=str)
+
+    def loads(self, data: bytes):
+        return self._orjson.loads(data)
+
+class MsgpackSerializer:
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def dumps(self, value) -> bytes:
+        return self._msgpack.packb(value, default=str, use_bin_type=True)
+
+    def loads(self, data: bytes):
+        return self._msgpack.unpackb(data, raw=False)
+
+SERIALIZERS = {
+    "json": JSONSerializer,
+    "orjson": OrjsonSerializer,
+    "msgpack": MsgpackSerializer,
+}
+
+def get_serializer(name: str):
+    try:
+        return SERIALIZERS[name]()
+    except ImportError:
+        logger.warning("Cache serializer %s is not installed, falling back to json", name)
+        return JSONSerializer()
+
+# Локальный уровень: ограниченный LRU с TTL на запись
+class LocalTTLCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: str):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def set(self, key: str, value, ttl: float):
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+class PrefixStats:
+    __slots__ = ("local_hits", "remote_hits", "misses", "early_refreshes", "loads",
+                 "load_seconds", "remote_calls", "remote_seconds")
+
+    def __init__(self):
+        self.local_hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+        self.early_refreshes = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.remote_calls = 0
+        self.remote_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+_MISSING = object()
+
+# Двухуровневый кэш: локальный LRU/TTL перед Redis.
+# Промахи по одному ключу схлопываются в одну загрузку (single-flight), а запись
+# в Redis пересчитывается заранее с вероятностью, растущей к концу TTL (XFetch).
+class TwoTierCache:
+    def __init__(self, redis: AsyncRedis, serializer, local_maxsize: int,
+                 local_ttl: float, early_expiry_beta: float):
+        self.redis = redis
+        self.serializer = serializer
+        self.local = LocalTTLCache(local_maxsize)
+        self.local_ttl = local_ttl
+        self.early_expiry_beta = early_expiry_beta
+        self.stats: Dict[str, PrefixStats] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._listener: Optional[asyncio.Task] = None
+
+    def _stats(self, key: str) -> PrefixStats:
+        prefix = key.split(":", 1)[0]
+        stats = self.stats.get(prefix)
+        if stats is None:
+            stats = self.stats[prefix] = PrefixStats()
+        return stats
+
+    async def _remote(self, stats: PrefixStats, coroutine: Awaitable):
+        started = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            stats.remote_calls += 1
+            stats.remote_seconds += time.perf_counter() - started
+
+    def _should_refresh_early(self, delta: float, expires_at: float) -> bool:
+        if self.early_expiry_beta <= 0:
+            return False
+        return time.time() - delta * self.early_expiry_beta * math.log(random.random() or 1e-12) >= expires_at
+
+    async def get(self, key: str, use_local: bool = True):
+        value = await self._get(key, use_local)
+        return None if value is _MISSING else value
+
+    async def _get(self, key: str, use_local: bool, allow_early_refresh: bool = False):
+        stats = self._stats(key)
+        if use_local:
+            entry = self.local.get(key)
+            if entry is not None:
+                stats.local_hits += 1
+                return entry[1]
+        try:
+            data = await self._remote(stats, self.redis.get(key))
+        except Exception as e:
+            logger.warning("Cache read failed for %s: %s", key, e)
+            data = None
+        if data is None:
+            stats.misses += 1
+            return _MISSING
+        envelope = self.serializer.loads(data)
+        if allow_early_refresh and self._should_refresh_early(envelope["d"], envelope["e"]):
+            stats.early_refreshes += 1
+            return _MISSING
+        stats.remote_hits += 1
+        if use_local:
+            self.local.set(key, envelope["v"], min(self.local_ttl, max(envelope["e"] - time.time(), 0)))
+        return envelope["v"]
+
+    async def set(self, key: str, value, ttl: int, use_local: bool = True, load_seconds: float = 0.0):
+        envelope = {"v": value, "d": load_seconds, "e": time.time() + ttl}
+        stats = self._stats(key)
+        try:
+            await self._remote(stats, self.redis.setex(key, ttl, self.serializer.dumps(envelope)))
+        except Exception as e:
+            logger.warning("Cache write failed for %s: %s", key, e)
+        if use_local:
+            self.local.set(key, value, min(self.local_ttl, ttl))
+
+    async def delete(self, *keys: str):
+        if not keys:
+            return
+        for key in keys:
+            self.local.delete(key)
+        try:
+            await self.redis.delete(*keys)
+            # Остальные процессы вычищают ключи из своих локальных уровней
+            await self.redis.publish(INVALIDATION_CHANNEL, self.serializer.dumps(list(keys)))
+        except Exception as e:
+            logger.warning("Cache invalidation failed for %s: %s", keys, e)
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Any]], ttl: int,
+                          use_local: bool = True):
+        value = await self._get(key, use_local, allow_early_refresh=True)
+        if value is not _MISSING:
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        stats = self._stats(key)
+        try:
+            started = time.perf_counter()
+            value = await loader()
+            load_seconds = time.perf_counter() - started
+            stats.loads += 1
+            stats.load_seconds += load_seconds
+            if value is not None:
+                await self.set(key, value, ttl, use_local, load_seconds)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение получат ожидающие; помечаем его обработанным, если их нет
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _listen_invalidations(self):
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(INVALIDATION_CHANNEL)
+        try:
+            while True:
+                try:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                except Exception as e:
+                    logger.warning("Cache invalidation listener error: %s", e)
+                    self.local.clear()
+                    await asyncio.sleep(1.0)
+                    continue
+                if message and message["type"] == "message":
+                    for key in self.serializer.loads(message["data"]):
+                        self.local.delete(key)
+        finally:
+            await pubsub.close()
+
+    def start(self):
+        if self._listener is None:
+            self._listener = asyncio.get_running_loop().create_task(self._listen_invalidations())
+
+    async def stop(self):
+        if self._listener is None:
+            return
+        self._listener.cancel()
+        try:
+            await self._listener
+        except asyncio.CancelledError:
+            pass
+        self._listener = None
+
+    def metrics(self) -> dict:
+        return {
+            "local_size": len(self.local),
+            "prefixes": {prefix: stats.as_dict() for prefix, stats in self.stats.items()},
+        }
+
+cache = TwoTierCache(
+    redis=async_redis_client,
+    serializer=get_serializer(settings.CACHE_SERIALIZER),
+    local_maxsize=settings.CACHE_LOCAL_MAXSIZE,
+    local_ttl=settings.CACHE_LOCAL_TTL_SECONDS,
+    early_expiry_beta=settings.CACHE_EARLY_EXPIRY_BETA
+)
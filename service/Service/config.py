@@ -1,5 +1,6 @@
 from pydantic import BaseSettings
 from functools import lru_cache
+from typing import Dict, List, Optional
 
 class Settings(BaseSettings):
     DATABASE_URL: str
@@ -14,6 +15,167 @@ class Settings(BaseSettings):
     REDIS_URL: str
     RATE_LIMIT_PER_MINUTE: int
 
+    # Асинхронный доступ к БД и пул соединений
+    ASYNC_DATABASE_URL: Optional[str] = None
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_ECHO: bool = False
+
+    # Режим SQLite: WAL, pragma и единственный писатель
+    SQLITE_WAL_MODE: bool = True
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_CACHE_SIZE_KB: int = 65536
+    SQLITE_MMAP_SIZE: int = 268435456
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_READ_POOL_SIZE: int = 8
+    SQLITE_SINGLE_WRITER: bool = True
+    SQLITE_WRITER_BATCH_SIZE: int = 256
+    SQLITE_WRITER_QUEUE_SIZE: int = 10000
+
+    # Пакетное создание заказов
+    BULK_ORDER_MAX_BATCH: int = 1000
+
+    # Кэш карточки заказа
+    ORDER_CACHE_TTL_SECONDS: int = 300
+    ORDER_CACHE_VERSION_TTL_SECONDS: int = 86400
+
+    # Двухуровневый кэш (локальный LRU + Redis)
+    CACHE_SERIALIZER: str = "orjson"
+    CACHE_LOCAL_MAXSIZE: int = 10000
+    CACHE_LOCAL_TTL_SECONDS: float = 5.0
+    CACHE_EARLY_EXPIRY_BETA: float = 1.0
+
+    # Ограничение частоты запросов
+    RATE_LIMIT_ALGORITHM: str = "sliding_window"  # или "token_bucket"
+    RATE_LIMIT_WINDOW_SECONDS: int = 60
+    RATE_LIMIT_BURST: Optional[int] = None
+    RATE_LIMIT_ROUTE_LIMITS: Dict[str, int] = {}
+    RATE_LIMIT_REDIS_RETRY_SECONDS: float = 5.0
+    RATE_LIMIT_LOCAL_MAX_KEYS: int = 100000
+    # Пути без лимита: сбор метрик Prometheus не должен тратить и исчерпывать лимит
+    RATE_LIMIT_EXEMPT_PATHS: List[str] = ["/metrics"]
+
+    # Кэш проверенных JWT
+    AUTH_CACHE_MAXSIZE: int = 50000
+    AUTH_CACHE_TTL_SECONDS: float = 300.0
+
+    # Хэширование паролей
+    PASSWORD_HASH_METHOD: str = "pbkdf2:sha256:260000"
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_MAX_WAITING: int = 64
+    PASSWORD_HASH_WAIT_TIMEOUT_SECONDS: float = 5.0
+    PASSWORD_HASH_USE_PROCESSES: bool = False
+
+    # Доставка уведомлений: пул SMTP-сессий, SMS и outbox
+    SMTP_USE_TLS: bool = True
+    SMTP_TIMEOUT_SECONDS: float = 10.0
+    SMTP_POOL_SIZE: int = 4
+    SMTP_SESSION_MAX_MESSAGES: int = 500
+    SMTP_SESSION_IDLE_SECONDS: float = 60.0
+    TWILIO_ACCOUNT_SID: Optional[str] = None
+    TWILIO_AUTH_TOKEN: Optional[str] = None
+    TWILIO_PHONE_NUMBER: Optional[str] = None
+    OUTBOX_ENABLED: bool = True
+    OUTBOX_BATCH_SIZE: int = 100
+    OUTBOX_CONCURRENCY: int = 8
+    OUTBOX_POLL_INTERVAL_SECONDS: float = 2.0
+    OUTBOX_LEASE_SECONDS: int = 120
+    OUTBOX_MAX_ATTEMPTS: int = 6
+    OUTBOX_BACKOFF_BASE_SECONDS: float = 10.0
+    OUTBOX_BACKOFF_MAX_SECONDS: float = 1800.0
+
+    # Push-уведомления по WebSocket/SSE
+    NOTIFICATION_PUSH_QUEUE_SIZE: int = 64
+    NOTIFICATION_PUSH_REDIS_BRIDGE: bool = True
+    NOTIFICATION_PUSH_HEARTBEAT_SECONDS: float = 25.0
+    NOTIFICATION_UNREAD_CACHE_TTL_SECONDS: int = 3600
+
+    # Трансляция позиции курьера клиентам
+    TRACKING_MIN_INTERVAL_SECONDS: float = 1.0
+    TRACKING_REDIS_BRIDGE: bool = True
+
+    # Компактное хранение истории GPS
+    LOCATION_COMPACTION_ENABLED: bool = True
+    LOCATION_RAW_RETENTION_HOURS: int = 24
+    LOCATION_COMPACTION_INTERVAL_SECONDS: float = 3600.0
+    LOCATION_SIMPLIFY_TOLERANCE_M: float = 0.0
+
+    # Платежи: провайдер, пул клиента, circuit breaker и сверка
+    PAYMENT_PROVIDER: str = "stub"
+    STRIPE_SECRET_KEY: Optional[str] = None
+    STRIPE_WEBHOOK_SECRET: Optional[str] = None
+    PAYMENT_PROVIDER_TIMEOUT_SECONDS: float = 10.0
+    PAYMENT_PROVIDER_POOL_SIZE: int = 16
+    PAYMENT_PROVIDER_MAX_RETRIES: int = 2
+    PAYMENT_BREAKER_FAILURE_THRESHOLD: int = 5
+    PAYMENT_BREAKER_RESET_SECONDS: float = 30.0
+    PAYMENT_RECONCILE_INTERVAL_SECONDS: float = 5.0
+    PAYMENT_RECONCILE_BATCH_SIZE: int = 100
+    PAYMENT_RECONCILE_STALE_SECONDS: int = 300
+
+    # Кэш промокодов
+    PROMOCODE_CACHE_TTL_SECONDS: int = 30
+
+    # Инкрементальная статистика админки
+    STATS_RECONCILE_ENABLED: bool = True
+    STATS_RECONCILE_INTERVAL_SECONDS: float = 300.0
+    STATS_RECONCILE_WINDOW_HOURS: int = 48
+    STATS_HOUR_RETENTION_DAYS: int = 35
+    STATS_DAY_RETENTION_DAYS: int = 400
+    STATS_RANGE_MAX_BUCKETS: int = 1000
+
+    # Потоковая выгрузка данных для аналитики
+    EXPORT_CHUNK_SIZE: int = 5000
+    EXPORT_GZIP_LEVEL: int = 6
+
+    # Рейтинги курьеров: скользящее окно, снимок в памяти и сглаживание
+    RATING_WINDOW_DAYS: int = 30
+    RATING_SNAPSHOT_REFRESH_SECONDS: float = 60.0
+    RATING_PRIOR_MEAN: float = 4.0
+    RATING_PRIOR_WEIGHT: float = 5.0
+    RATING_LOOKUP_MAX_IDS: int = 1000
+
+    # Метрики Prometheus (/metrics)
+    METRICS_ENABLED: bool = True
+
+    # Логирование: очередь с фоновой записью, JSON, ротация по размеру
+    LOG_LEVEL: str = "INFO"
+    LOG_JSON: bool = True
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_FILE: str = "logs/app.log"
+    # size — у каждого процесса свой файл (app.<pid>.log) с ротацией по размеру;
+    # external — общий файл, ротацию делает logrotate, процессы переоткрывают файл после нее
+    LOG_ROTATION: str = "size"
+    LOG_MAX_BYTES: int = 50 * 1024 * 1024
+    LOG_BACKUP_COUNT: int = 10
+    LOG_GPS_SAMPLE_EVERY: int = 100  # в лог попадает одна GPS-точка из N
+
+    # Буферизация GPS-точек курьеров
+    GPS_BATCH_SIZE: int = 500
+    GPS_FLUSH_INTERVAL_SECONDS: float = 1.0
+    GPS_QUEUE_MAX_SIZE: int = 20000
+    GPS_FLUSH_MAX_ATTEMPTS: int = 5
+    GPS_FLUSH_BACKOFF_BASE_SECONDS: float = 0.5
+    GPS_FLUSH_BACKOFF_MAX_SECONDS: float = 10.0
+
+    # Автоматическое пакетное назначение курьеров
+    DISPATCH_ENABLED: bool = False
+    DISPATCH_INTERVAL_SECONDS: float = 10.0
+    DISPATCH_BATCH_SIZE: int = 10000
+    DISPATCH_CANDIDATES_PER_ORDER: int = 8
+    DISPATCH_MAX_ORDERS_PER_COURIER: int = 1
+    DISPATCH_MAX_DISTANCE_KM: float = 15.0
+    DISPATCH_RATING_WEIGHT_KM: float = 0.5  # на сколько км "ближе" курьер с оценкой на звезду выше средней
+
+    # Маршруты и расчет ETA
+    ROUTE_AVERAGE_SPEED_KMH: float = 20.0
+    ROUTE_STOP_SERVICE_MINUTES: float = 3.0
+    ROUTE_TICK_SECONDS: float = 5.0
+    ROUTE_MIN_ETA_CHANGE_SECONDS: float = 30.0
+
     class Config:
         env_file = ".env"
 
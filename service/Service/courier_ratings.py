@@ -0,0 +1,263 @@
+import asyncio
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Optional
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import SessionLocal
+from models import CourierRating, CourierRatingDay, Review
+from sqlite_writer import run_background_write
+from cache import redis_client
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+_UPSERT_DIALECTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+MAINTENANCE_LOCK_KEY = "lock:courier_ratings:maintenance"
+MAINTENANCE_LOCK_SECONDS = 300
+
+def _window_start(window_days: int) -> date:
+    return datetime.utcnow().date() - timedelta(days=window_days - 1)
+
+class RatingStats:
+    __slots__ = ("count", "total", "window_count", "window_total")
+
+    def __init__(self, count: int = 0, total: int = 0, window_count: int = 0, window_total: int = 0):
+        self.count = count
+        self.total = total
+        self.window_count = window_count
+        self.window_total = window_total
+
+    def add(self, rating: int):
+        self.count += 1
+        self.total += rating
+        self.window_count += 1
+        self.window_total += rating
+
+    def score(self, prior_mean: float, prior_weight: float) -> float:
+        # Сглаженное среднее за окно: у курьера с парой отзывов оценка тянется к prior_mean
+        return (self.window_total + prior_mean * prior_weight) / (self.window_count + prior_weight)
+
+    def as_dict(self) -> dict:
+        return {
+            "review_count": self.count,
+            "average": round(self.total / self.count, 2) if self.count else None,
+            "window_review_count": self.window_count,
+            "window_average": round(self.window_total / self.window_count, 2) if self.window_count else None,
+        }
+
+# Агрегаты оценок: итог по курьеру и корзины по дням для скользящего окна.
+# Обновляются в транзакции, создающей отзыв, поэтому расходиться с reviews не могут.
+class CourierRatingService:
+    @staticmethod
+    def _increment(session: Session, model, keys: dict, rating: int, now: datetime):
+        table = model.__table__
+        insert = _UPSERT_DIALECTS.get(session.get_bind().dialect.name)
+        if insert is not None:
+            statement = insert(table).values(**keys, review_count=1, rating_sum=rating, updated_at=now)
+            session.execute(statement.on_conflict_do_update(
+                index_elements=list(keys),
+                set_={
+                    "review_count": table.c.review_count + 1,
+                    "rating_sum": table.c.rating_sum + rating,
+                    "updated_at": now,
+                }
+            ))
+            return
+        updated = session.execute(
+            table.update()
+            .where(*(table.c[name] == value for name, value in keys.items()))
+            .values(review_count=table.c.review_count + 1, rating_sum=table.c.rating_sum + rating, updated_at=now)
+        ).rowcount
+        if not updated:
+            session.execute(table.insert().values(**keys, review_count=1, rating_sum=rating, updated_at=now))
+
+    @staticmethod
+    def record_review(session: Session, courier_id: int, rating: int, now: Optional[datetime] = None):
+        now = now or datetime.utcnow()
+        CourierRatingService._increment(session, CourierRating, {"courier_id": courier_id}, rating, now)
+        CourierRatingService._increment(
+            session, CourierRatingDay, {"courier_id": courier_id, "day": now.date()}, rating, now
+        )
+
+    @staticmethod
+    async def get_many(db: AsyncSession, courier_ids: Iterable[int], window_days: int) -> Dict[int, dict]:
+        # Два запроса IN на любое число курьеров: итоги и сумма дневных корзин окна
+        courier_ids = list(set(courier_ids))
+        if not courier_ids:
+            return {}
+        ratings = {courier_id: RatingStats() for courier_id in courier_ids}
+        totals = await db.execute(
+            select(CourierRating.courier_id, CourierRating.review_count, CourierRating.rating_sum)
+            .where(CourierRating.courier_id.in_(courier_ids))
+        )
+        for courier_id, count, total in totals:
+            ratings[courier_id].count, ratings[courier_id].total = count, total
+        window = await db.execute(
+            select(CourierRatingDay.courier_id, func.sum(CourierRatingDay.review_count), func.sum(CourierRatingDay.rating_sum))
+            .where(CourierRatingDay.courier_id.in_(courier_ids), CourierRatingDay.day >= _window_start(window_days))
+            .group_by(CourierRatingDay.courier_id)
+        )
+        for courier_id, count, total in window:
+            ratings[courier_id].window_count, ratings[courier_id].window_total = count, total
+        return {courier_id: stats.as_dict() for courier_id, stats in ratings.items()}
+
+    @staticmethod
+    def rebuild(session: Session) -> int:
+        # Однократное заполнение агрегатов по уже накопленным отзывам
+        session.execute(delete(CourierRatingDay.__table__))
+        session.execute(delete(CourierRating.__table__))
+        now = datetime.utcnow()
+        reviews = Review.__table__
+        rows = session.execute(
+            select(reviews.c.courier_id, func.count(), func.sum(reviews.c.rating))
+            .where(reviews.c.courier_id.isnot(None))
+            .group_by(reviews.c.courier_id)
+        ).all()
+        if rows:
+            session.execute(CourierRating.__table__.insert(), [
+                {"courier_id": courier_id, "review_count": count, "rating_sum": total, "updated_at": now}
+                for courier_id, count, total in rows
+            ])
+        days = {}
+        for courier_id, created_at, rating in session.execute(
+            select(reviews.c.courier_id, reviews.c.created_at, reviews.c.rating)
+            .where(reviews.c.courier_id.isnot(None), reviews.c.created_at >= _window_start(settings.RATING_WINDOW_DAYS))
+        ):
+            bucket = days.setdefault((courier_id, created_at.date()), [0, 0])
+            bucket[0] += 1
+            bucket[1] += rating
+        if days:
+            session.execute(CourierRatingDay.__table__.insert(), [
+                {"courier_id": courier_id, "day": day, "review_count": count, "rating_sum": total, "updated_at": now}
+                for (courier_id, day), (count, total) in days.items()
+            ])
+        return len(rows)
+
+# Снимок рейтингов в памяти процесса для пути назначения: диспетчер читает словарь без БД.
+# Снимок целиком перечитывается раз в интервал и подменяется одной ссылкой,
+# а отзывы, принятые этим воркером, применяются к нему сразу.
+class CourierRatingSnapshot:
+    def __init__(self, refresh_interval_seconds: float, window_days: int, prior_mean: float, prior_weight: float):
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.window_days = window_days
+        self.prior_mean = prior_mean
+        self.prior_weight = prior_weight
+        self._ratings: Dict[int, RatingStats] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        self.loads = 0
+        self.last_load_seconds = 0.0
+
+    def _maintain(self, db: Session, window_start: date):
+        # Пересборка и чистка агрегатов выполняются одним воркером; остальные, не получив блокировку, только читают.
+        # Без Redis обслуживание пропускается до следующего обновления снимка
+        try:
+            lock = redis_client.lock(MAINTENANCE_LOCK_KEY, timeout=MAINTENANCE_LOCK_SECONDS, blocking=False)
+            if not lock.acquire():
+                return
+        except Exception as e:
+            logger.warning("Rating maintenance skipped, lock unavailable: %s", e)
+            return
+        try:
+            if db.execute(select(CourierRating.courier_id).limit(1)).first() is None and \
+                    db.execute(select(Review.id).limit(1)).first() is not None:
+                logger.info("Rebuilt rating aggregates for %d couriers", CourierRatingService.rebuild(db))
+            # Корзины старше окна больше не участвуют в расчете
+            db.execute(delete(CourierRatingDay.__table__).where(CourierRatingDay.__table__.c.day < window_start))
+        finally:
+            try:
+                lock.release()
+            except Exception as e:
+                logger.warning("Rating maintenance lock release failed: %s", e)
+
+    def load(self, db: Session):
+        # При старте писатель SQLite еще не запущен, поэтому обслуживание фиксируется в сессии вызывающего
+        self._maintain(db, _window_start(self.window_days))
+        db.commit()
+        self.refresh(db)
+
+    def refresh(self, db: Session):
+        started = time.perf_counter()
+        window_start = _window_start(self.window_days)
+        ratings = {
+            courier_id: RatingStats(count, total)
+            for courier_id, count, total in db.execute(
+                select(CourierRating.courier_id, CourierRating.review_count, CourierRating.rating_sum)
+            )
+        }
+        for courier_id, count, total in db.execute(
+            select(CourierRatingDay.courier_id, func.sum(CourierRatingDay.review_count), func.sum(CourierRatingDay.rating_sum))
+            .where(CourierRatingDay.day >= window_start)
+            .group_by(CourierRatingDay.courier_id)
+        ):
+            stats = ratings.setdefault(courier_id, RatingStats())
+            stats.window_count, stats.window_total = count, total
+        self._ratings = ratings
+        self.loads += 1
+        self.last_load_seconds = time.perf_counter() - started
+
+    def apply(self, courier_id: int, rating: int):
+        stats = self._ratings.get(courier_id)
+        if stats is None:
+            stats = self._ratings[courier_id] = RatingStats()
+        stats.add(rating)
+
+    def get(self, courier_id: int) -> Optional[RatingStats]:
+        return self._ratings.get(courier_id)
+
+    def score(self, courier_id: int) -> float:
+        stats = self._ratings.get(courier_id)
+        if stats is None:
+            return self.prior_mean
+        return stats.score(self.prior_mean, self.prior_weight)
+
+    def _refresh_in_session(self):
+        db = SessionLocal()
+        try:
+            self.refresh(db)
+        finally:
+            db.close()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.refresh_interval_seconds)
+            try:
+                window_start = _window_start(self.window_days)
+                await run_background_write(lambda session: self._maintain(session, window_start))
+                await loop.run_in_executor(None, self._refresh_in_session)
+            except Exception as e:
+                logger.error("Courier rating snapshot refresh failed: %s", e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "couriers": len(self._ratings),
+            "loads": self.loads,
+            "last_load_seconds": self.last_load_seconds,
+        }
+
+courier_ratings = CourierRatingSnapshot(
+    refresh_interval_seconds=settings.RATING_SNAPSHOT_REFRESH_SECONDS,
+    window_days=settings.RATING_WINDOW_DAYS,
+    prior_mean=settings.RATING_PRIOR_MEAN,
+    prior_weight=settings.RATING_PRIOR_WEIGHT
+)
@@ -1,30 +1,135 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from models import Base
+from migrations import migrate
+from config import get_settings
 import logging
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-DATABASE_URL = "sqlite:///delivery_service.db"
+settings = get_settings()
+
+DATABASE_URL = settings.DATABASE_URL
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+def derive_async_url(url: str) -> str:
+    if settings.ASYNC_DATABASE_URL:
+        return settings.ASYNC_DATABASE_URL
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgresql:") or url.startswith("postgres:"):
+        return "postgresql+asyncpg:" + url.split(":", 1)[1]
+    return url
+
+def sqlite_read_only_url(url: str, driver: str = "sqlite") -> str:
+    # Читающие соединения открываются в режиме только-чтение через URI SQLite
+    path = make_url(url).database
+    return f"{driver}:///file:{path}?mode=ro&uri=true"
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    if settings.SQLITE_WAL_MODE:
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    # Отрицательное значение cache_size задается в килобайтах
+    cursor.execute(f"PRAGMA cache_size=-{settings.SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+def async_engine_options(url: str) -> dict:
+    options = {
+        "echo": settings.DB_ECHO,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+    # aiosqlite работает без пула соединений, параметры пула нужны для Postgres (asyncpg)
+    if not url.startswith("sqlite"):
+        options.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+        )
+    return options
 
 try:
-    engine = create_engine(DATABASE_URL)
+    ASYNC_DATABASE_URL = derive_async_url(DATABASE_URL)
+
+    engine = create_engine(
+        DATABASE_URL,
+        connect_args={"check_same_thread": False} if IS_SQLITE else {}
+    )
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        **async_engine_options(ASYNC_DATABASE_URL)
+    )
+    AsyncSessionLocal = sessionmaker(
+        async_engine,
+        class_=AsyncSession,
+        autoflush=False,
+        expire_on_commit=False
+    )
+
+    if IS_SQLITE:
+        event.listen(engine, "connect", apply_sqlite_pragmas)
+        event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+
+        # Чтения расходятся по пулу read-only соединений и не конкурируют с писателем
+        async_read_engine = create_async_engine(
+            sqlite_read_only_url(ASYNC_DATABASE_URL, "sqlite+aiosqlite"),
+            echo=settings.DB_ECHO,
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=settings.SQLITE_READ_POOL_SIZE,
+            max_overflow=0
+        )
+        event.listen(async_read_engine.sync_engine, "connect", apply_sqlite_pragmas)
+    else:
+        async_read_engine = async_engine
+    AsyncReadSessionLocal = sessionmaker(
+        async_read_engine,
+        class_=AsyncSession,
+        autoflush=False,
+        expire_on_commit=False
+    )
 except SQLAlchemyError as e:
-    logger.error(f"Ошибка подключения к базе данных: {e}")
+    logger.error("Ошибка подключения к базе данных: %s", e)
     raise
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    migrate(engine)
 
 def get_db():
     db = SessionLocal()
     try:
         yield db
     except SQLAlchemyError as e:
-        logger.error(f"Ошибка при работе с базой данных: {e}")
+        logger.error("Ошибка при работе с базой данных: %s", e)
         raise
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except SQLAlchemyError as e:
+            logger.error("Ошибка при работе с базой данных: %s", e)
+            await db.rollback()
+            raise
+
+async def get_async_read_db():
+    async with AsyncReadSessionLocal() as db:
+        try:
+            yield db
+        except SQLAlchemyError as e:
+            logger.error("Ошибка при работе с базой данных: %s", e)
+            raise
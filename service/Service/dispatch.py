@@ -0,0 +1,267 @@
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+from sqlalchemy import and_, bindparam, func, or_, select, update
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import Courier, Notification, Order, OrderStatus, User
+from spatial_index import CourierSpatialIndex, courier_index
+from route_planner import route_planner
+from notification_outbox import add_to_outbox, notification_outbox, outbox_rows
+from notification_hub import notification_event, notification_hub
+from notification_service import NotificationService
+from order_state_machine import OrderStatusChanged, order_events
+from sqlite_writer import run_background_write
+from courier_ratings import CourierRatingSnapshot, courier_ratings
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+DISPATCHABLE_STATUSES = (OrderStatus.PAID, OrderStatus.PREPARING)
+ACTIVE_STATUSES = (OrderStatus.ASSIGNED_TO_COURIER, OrderStatus.IN_DELIVERY)
+# Размер IN-списков по id заказов пачки: держимся ниже лимита параметров SQLite
+ID_CHUNK = 500
+
+class DispatchConflict(Exception):
+    pass
+
+# Пакетное назначение курьеров: жадное сопоставление по расстоянию.
+# Для каждого заказа берутся k ближайших курьеров со свободными местами из снимка пространственного индекса,
+# все пары сортируются по расстоянию с поправкой на рейтинг курьера из снимка в памяти
+# и разбираются с учетом вместимости курьера.
+class DispatchEngine:
+    def __init__(self, index: CourierSpatialIndex, ratings: CourierRatingSnapshot, interval_seconds: float,
+                 batch_size: int, candidates_per_order: int, max_orders_per_courier: int,
+                 max_distance_km: float, rating_weight_km: float):
+        self.index = index
+        self.ratings = ratings
+        self.rating_weight_km = rating_weight_km
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.candidates_per_order = candidates_per_order
+        self.max_orders_per_courier = max_orders_per_courier
+        self.max_distance_km = max_distance_km
+        self._task: Optional[asyncio.Task] = None
+
+        self.runs = 0
+        self.assigned_total = 0
+        self.last_run_seconds = 0.0
+
+    def match(self, index: CourierSpatialIndex, orders: List[Tuple[int, float, float]],
+              capacity: Dict[int, int]) -> List[Tuple[int, int, float]]:
+        # index — снимок, в котором есть только курьеры со свободными местами,
+        # поэтому k кандидатов не расходуются на занятых курьеров
+        edges = []
+        for order_id, latitude, longitude in orders:
+            for courier_id, distance in index.nearest(
+                latitude, longitude,
+                k=self.candidates_per_order,
+                max_distance_km=self.max_distance_km
+            ):
+                bonus = self.rating_weight_km * (self.ratings.score(courier_id) - self.ratings.prior_mean)
+                edges.append((distance - bonus, distance, order_id, courier_id))
+        edges.sort()
+
+        remaining = dict(capacity)
+        assigned_orders = set()
+        assignments = []
+        for _, distance, order_id, courier_id in edges:
+            if order_id in assigned_orders or remaining[courier_id] <= 0:
+                continue
+            assigned_orders.add(order_id)
+            remaining[courier_id] -= 1
+            assignments.append((order_id, courier_id, distance))
+        return assignments
+
+    def load_batch(self, db: Session):
+        orders = db.query(Order.id, Order.delivery_latitude, Order.delivery_longitude).filter(
+            Order.status.in_(DISPATCHABLE_STATUSES),
+            Order.courier_id.is_(None),
+            Order.delivery_latitude.isnot(None),
+            Order.delivery_longitude.isnot(None)
+        ).order_by(Order.created_at).limit(self.batch_size).all()
+        if not orders:
+            return None
+
+        available = (
+            db.query(Courier.id, Courier.user_id, Courier.phone, User.email)
+            .outerjoin(User, User.id == Courier.user_id)
+            .filter(Courier.is_available == True)
+            .all()
+        )
+        couriers = {courier_id: user_id for courier_id, user_id, _, _ in available}
+        contacts = {courier_id: (phone, email) for courier_id, _, phone, email in available}
+        active_load = dict(
+            db.query(Order.courier_id, func.count(Order.id))
+            .filter(Order.status.in_(ACTIVE_STATUSES), Order.courier_id.isnot(None))
+            .group_by(Order.courier_id)
+        )
+        capacity = {}
+        for courier_id in couriers:
+            free_slots = self.max_orders_per_courier - active_load.get(courier_id, 0)
+            if free_slots > 0:
+                capacity[courier_id] = free_slots
+        return orders, couriers, contacts, capacity
+
+    def assign(self, db: Session, couriers: Dict[int, int], contacts: Dict[int, tuple],
+               assignments: List[Tuple[int, int, float]]
+               ) -> Tuple[List[Tuple[int, int, float]], Dict[int, int], List[OrderStatusChanged]]:
+        # Все назначения и уведомления пишутся одной транзакцией, которую фиксирует run_background_write.
+        # Заказы пачки блокируются до UPDATE, и те, что успели назначить вручную после load_batch,
+        # отсеиваются: уведомления, события и остановки маршрута — только для реально назначенных.
+        # На rowcount executemany полагаться нельзя: psycopg2 и asyncpg его не сообщают
+        orders = Order.__table__
+        order_ids = [order_id for order_id, _, _ in assignments]
+        free = set()
+        for start in range(0, len(order_ids), ID_CHUNK):
+            free.update(db.execute(
+                select(orders.c.id)
+                .where(
+                    orders.c.id.in_(order_ids[start:start + ID_CHUNK]),
+                    orders.c.courier_id.is_(None),
+                    or_(*(orders.c.status == status for status in DISPATCHABLE_STATUSES))
+                )
+                .with_for_update()
+            ).scalars())
+        assignments = [assignment for assignment in assignments if assignment[0] in free]
+        if not assignments:
+            return [], {}, []
+
+        result = db.execute(
+            update(Order.__table__)
+            .where(and_(
+                Order.__table__.c.id == bindparam("order_id"),
+                Order.__table__.c.courier_id.is_(None),
+                or_(*(Order.__table__.c.status == status for status in DISPATCHABLE_STATUSES))
+            ))
+            .values(courier_id=bindparam("new_courier_id"), status=OrderStatus.ASSIGNED_TO_COURIER,
+                    version=Order.__table__.c.version + 1),
+            [{"order_id": order_id, "new_courier_id": courier_id} for order_id, courier_id, _ in assignments]
+        )
+        if db.bind.dialect.supports_sane_multi_rowcount and result.rowcount != len(assignments):
+            raise DispatchConflict()
+
+        # События для order_events: версия, сумма и клиент — как у строки после UPDATE
+        now = datetime.utcnow()
+        order_ids = [order_id for order_id, _, _ in assignments]
+        events = []
+        for start in range(0, len(order_ids), ID_CHUNK):
+            rows = db.execute(
+                select(Order.id, Order.version, Order.total_price, Order.courier_id, Order.customer_id)
+                .where(Order.id.in_(order_ids[start:start + ID_CHUNK]))
+            )
+            events.extend(
+                OrderStatusChanged(row.id, OrderStatus.ASSIGNED_TO_COURIER, row.version, row.total_price,
+                                   row.courier_id, row.customer_id, now)
+                for row in rows
+            )
+
+        db.execute(Notification.__table__.insert(), [
+            {
+                "user_id": couriers[courier_id],
+                "order_id": order_id,
+                "type": "new_assignment",
+                "message": f"Вам назначен новый заказ #{order_id}"
+            }
+            for order_id, courier_id, _ in assignments
+        ])
+        add_to_outbox(db, [
+            row
+            for order_id, courier_id, _ in assignments
+            for row in outbox_rows(
+                "new_assignment", f"Вам назначен новый заказ #{order_id}", couriers[courier_id], order_id,
+                email=contacts[courier_id][1], phone=contacts[courier_id][0]
+            )
+        ])
+        unread_deltas = NotificationService.count_created(db, (couriers[courier_id] for _, courier_id, _ in assignments))
+        return assignments, unread_deltas, events
+
+    @staticmethod
+    def _read(fn):
+        # Отдельная сессия только на чтение пачки; записи идут через run_background_write
+        db = SessionLocal()
+        try:
+            return fn(db)
+        finally:
+            db.close()
+
+    async def run_once(self) -> List[Tuple[int, int, float, float]]:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        batch = await loop.run_in_executor(None, self._read, self.load_batch)
+        if batch is None:
+            return []
+        orders, couriers, contacts, capacity = batch
+
+        # Индекс обновляется GPS-точками на event loop: доступность и снимок берутся здесь,
+        # а поиск кандидатов идет по снимку в пуле потоков
+        self.index.sync_available(couriers.keys())
+        snapshot = self.index.snapshot(capacity.keys())
+        matched = await loop.run_in_executor(None, self.match, snapshot, orders, capacity)
+        if not matched:
+            return []
+        try:
+            assignments, unread_deltas, events = await run_background_write(
+                lambda session: self.assign(session, couriers, contacts, matched)
+            )
+        except DispatchConflict:
+            logger.warning("Dispatch batch conflicted with concurrent assignment, retrying next run")
+            return []
+        if len(assignments) < len(matched):
+            logger.info("Dispatch skipped %d orders assigned concurrently", len(matched) - len(assignments))
+
+        # Побочные эффекты — только после фиксации транзакции; кэш заказов, статистику,
+        # маршруты и GPS-подписки обновляют подписчики order_events
+        await order_events.publish_many(events)
+        await NotificationService.adjust_cached_async(unread_deltas)
+        await notification_hub.publish_many([
+            (couriers[courier_id], notification_event("new_assignment", f"Вам назначен новый заказ #{order_id}", order_id))
+            for order_id, courier_id, _ in assignments
+        ])
+        coordinates = {order_id: (latitude, longitude) for order_id, latitude, longitude in orders}
+        assigned = [(order_id, courier_id) + coordinates[order_id] for order_id, courier_id, _ in assignments]
+
+        self.runs += 1
+        self.assigned_total += len(assigned)
+        self.last_run_seconds = time.perf_counter() - started
+        logger.info("Dispatched %d of %d orders in %.3fs", len(assigned), len(orders), self.last_run_seconds)
+        return assigned
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                assigned = await self.run_once()
+                for order_id, courier_id, latitude, longitude in assigned:
+                    route_planner.add_stop(courier_id, order_id, latitude, longitude)
+                if assigned:
+                    notification_outbox.wake()
+            except Exception as e:
+                logger.error("Dispatch run failed: %s", e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+dispatch_engine = DispatchEngine(
+    index=courier_index,
+    ratings=courier_ratings,
+    interval_seconds=settings.DISPATCH_INTERVAL_SECONDS,
+    batch_size=settings.DISPATCH_BATCH_SIZE,
+    candidates_per_order=settings.DISPATCH_CANDIDATES_PER_ORDER,
+    max_orders_per_courier=settings.DISPATCH_MAX_ORDERS_PER_COURIER,
+    max_distance_km=settings.DISPATCH_MAX_DISTANCE_KM,
+    rating_weight_km=settings.DISPATCH_RATING_WEIGHT_KM
+)
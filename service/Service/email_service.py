@@ -1,4 +1,7 @@
+import queue
 import smtplib
+import threading
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from config import get_settings
@@ -6,22 +9,140 @@ from logger import logger
 
 settings = get_settings()
 
+class SMTPSession:
+    __slots__ = ("server", "messages", "last_used")
+
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+# Пул постоянных SMTP-сессий: STARTTLS и LOGIN выполняются один раз на соединение,
+# а не на каждое письмо. Сессии, простоявшие дольше idle_seconds или отправившие
+# max_messages писем, переоткрываются — серверы сами рвут такие соединения.
+class SMTPSessionPool:
+    def __init__(self, host: str, port: int, user: str, password: str, use_tls: bool,
+                 timeout: float, size: int, max_messages: int, idle_seconds: float):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.size = size
+        self.max_messages = max_messages
+        self.idle_seconds = idle_seconds
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+        self.connects_total = 0
+        self.sent_total = 0
+
+    def _connect(self) -> SMTPSession:
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            server.starttls()
+        if self.user and self.password:
+            server.login(self.user, self.password)
+        self.connects_total += 1
+        return SMTPSession(server)
+
+    @staticmethod
+    def _close(session: SMTPSession):
+        try:
+            session.server.quit()
+        except Exception:
+            session.server.close()
+
+    def _acquire(self) -> SMTPSession:
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - session.last_used < self.idle_seconds:
+                return session
+            self._close(session)
+
+    def _release(self, session: SMTPSession):
+        session.last_used = time.monotonic()
+        if session.messages >= self.max_messages:
+            self._close(session)
+        else:
+            self._idle.put(session)
+
+    def send(self, message):
+        self._slots.acquire()
+        try:
+            session = self._acquire()
+            try:
+                try:
+                    session.server.send_message(message)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    # Сервер закрыл соединение из пула — одна попытка на свежей сессии
+                    self._close(session)
+                    session = self._connect()
+                    session.server.send_message(message)
+            except smtplib.SMTPResponseException:
+                # Отказ по конкретному письму: сессия остается рабочей
+                self._release(session)
+                raise
+            except Exception:
+                self._close(session)
+                raise
+            session.messages += 1
+            self.sent_total += 1
+            self._release(session)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    def stats(self) -> dict:
+        return {
+            "idle_sessions": self._idle.qsize(),
+            "connects_total": self.connects_total,
+            "sent_total": self.sent_total,
+        }
+
+smtp_pool = SMTPSessionPool(
+    host=settings.SMTP_SERVER,
+    port=settings.SMTP_PORT,
+    user=settings.SMTP_USER,
+    password=settings.SMTP_PASSWORD,
+    use_tls=settings.SMTP_USE_TLS,
+    timeout=settings.SMTP_TIMEOUT_SECONDS,
+    size=settings.SMTP_POOL_SIZE,
+    max_messages=settings.SMTP_SESSION_MAX_MESSAGES,
+    idle_seconds=settings.SMTP_SESSION_IDLE_SECONDS
+)
+
+def build_message(to_email: str, subject: str, body: str) -> MIMEMultipart:
+    msg = MIMEMultipart()
+    msg['From'] = settings.SMTP_USER
+    msg['To'] = to_email
+    msg['Subject'] = subject
+
+    msg.attach(MIMEText(body, 'html'))
+    return msg
+
+def is_permanent_error(error: Exception) -> bool:
+    # Повторять бессмысленно: адрес отклонен или сервер окончательно отверг письмо
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+
 def send_email(to_email: str, subject: str, body: str):
     try:
-        msg = MIMEMultipart()
-        msg['From'] = settings.SMTP_USER
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        msg.attach(MIMEText(body, 'html'))
-        
-        server = smtplib.SMTP(settings.SMTP_SERVER, settings.SMTP_PORT)
-        server.starttls()
-        server.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        
-        logger.info(f"Email sent successfully to {to_email}")
+        smtp_pool.send(build_message(to_email, subject, body))
+        logger.info("Email sent successfully to %s", to_email)
     except Exception as e:
-        logger.error(f"Failed to send email to {to_email}: {str(e)}")
-        raise 
\ No newline at end of file
+        logger.error("Failed to send email to %s: %s", to_email, e)
+        raise
\ No newline at end of file
@@ -0,0 +1,161 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import List, Optional
+from sqlite_writer import run_background_write
+from models import CourierLocation
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+# Буфер GPS-точек: копит фиксы в ограниченной очереди и пишет их пачками
+class LocationIngestionBuffer:
+    def __init__(self, batch_size: int, flush_interval: float, max_queue_size: int,
+                 max_attempts: int, backoff_base: float, backoff_max: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        # Счетчики для мониторинга
+        self.enqueued_total = 0
+        self.flushed_total = 0
+        self.flush_count = 0
+        self.failed_total = 0
+        self.retried_total = 0
+        self.backpressure_waits = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # Дожидаемся, пока воркер допишет всё, что осталось в очереди
+        self._stopping = True
+        await self._task
+        self._task = None
+        # Очередь принадлежала завершившемуся циклу; после остановки submit пишет напрямую
+        self._queue = None
+
+    async def submit(self, courier_id: int, latitude: float, longitude: float,
+                     timestamp: Optional[datetime] = None) -> datetime:
+        timestamp = timestamp or datetime.utcnow()
+        row = {
+            "courier_id": courier_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "timestamp": timestamp,
+        }
+        if self._queue is None:
+            # Буфер не запущен (например, в скриптах) — пишем сразу
+            await self._write([row])
+            return timestamp
+
+        if self._queue.full():
+            # Очередь заполнена: читатель сокета ждет, тем самым притормаживая курьера
+            self.backpressure_waits += 1
+        await self._queue.put(row)
+        self.enqueued_total += 1
+        return timestamp
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            if batch:
+                await self._flush(batch)
+            elif self._stopping:
+                break
+
+    async def _collect_batch(self) -> List[dict]:
+        batch: List[dict] = []
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if self._stopping and self._queue.empty():
+                break
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+            # Забираем всё, что уже лежит в очереди, без лишних переключений
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+        return batch
+
+    def _backoff(self, attempt: int) -> float:
+        return min(self.backoff_base * 2 ** (attempt - 1), self.backoff_max)
+
+    async def _flush(self, batch: List[dict]):
+        started = time.perf_counter()
+        try:
+            # Пачка повторяется с экспоненциальной паузой; пока идут повторы, очередь копится
+            # и через backpressure притормаживает сокеты курьеров
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    await self._write(batch)
+                    self.flushed_total += len(batch)
+                    return
+                except Exception as e:
+                    if attempt == self.max_attempts:
+                        self.failed_total += len(batch)
+                        logger.error("Dropped %d courier locations after %d attempts: %s", len(batch), attempt, e)
+                        return
+                    delay = self._backoff(attempt)
+                    self.retried_total += 1
+                    logger.warning("Failed to flush %d courier locations (attempt %d), retrying in %.1fs: %s",
+                                   len(batch), attempt, delay, e)
+                    await asyncio.sleep(delay)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.flush_count += 1
+            self.last_flush_seconds = elapsed
+            self.total_flush_seconds += elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    async def _write(self, rows: List[dict]):
+        await run_background_write(lambda session: session.execute(CourierLocation.__table__.insert(), rows))
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "queue_capacity": self.max_queue_size,
+            "enqueued_total": self.enqueued_total,
+            "flushed_total": self.flushed_total,
+            "failed_total": self.failed_total,
+            "retried_total": self.retried_total,
+            "flush_count": self.flush_count,
+            "backpressure_waits": self.backpressure_waits,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "avg_flush_seconds": self.total_flush_seconds / self.flush_count if self.flush_count else 0.0,
+        }
+
+location_buffer = LocationIngestionBuffer(
+    batch_size=settings.GPS_BATCH_SIZE,
+    flush_interval=settings.GPS_FLUSH_INTERVAL_SECONDS,
+    max_queue_size=settings.GPS_QUEUE_MAX_SIZE,
+    max_attempts=settings.GPS_FLUSH_MAX_ATTEMPTS,
+    backoff_base=settings.GPS_FLUSH_BACKOFF_BASE_SECONDS,
+    backoff_max=settings.GPS_FLUSH_BACKOFF_MAX_SECONDS
+)
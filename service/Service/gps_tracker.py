@@ -1,34 +1,297 @@
 from fastapi import WebSocket
-from models import CourierLocation
-from sqlalchemy.orm import Session
+from gps_ingestion import location_buffer
+from spatial_index import courier_index
+from route_planner import route_planner
+from cache import async_redis_client
+from models import OrderStatus
+from config import get_settings
+from logger import logger, gps_logger
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
 import json
+import time
+import uuid
+
+settings = get_settings()
+
+# Смена курьера и завершение заказа рассылаются воркерам, у которых могут быть подписчики этого заказа
+ORDER_CHANNEL = "gps:orders"
+TRACKING_END_STATUSES = (OrderStatus.DELIVERED, OrderStatus.CANCELLED)
+
+# Подписка клиента на позицию курьера своего заказа.
+# Хранится только последний кадр: новый кадр вытесняет неотправленный, поэтому медленный
+# клиент получает свежую позицию, а не очередь устаревших. Отправка не чаще min_interval.
+class PositionWatcher:
+    __slots__ = ("courier_id", "order_id", "min_interval", "latest", "last_sent", "dropped", "closed", "_waiter")
+
+    def __init__(self, courier_id: int, order_id: int, min_interval: float):
+        self.courier_id = courier_id
+        self.order_id = order_id
+        self.min_interval = min_interval
+        self.latest: Optional[str] = None
+        self.last_sent = 0.0
+        self.dropped = 0
+        self.closed = False
+        self._waiter: Optional[asyncio.Future] = None
+
+    def _wake(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def offer(self, frame: str):
+        if self.latest is not None:
+            self.dropped += 1
+        self.latest = frame
+        self._wake()
+
+    def close(self):
+        self.closed = True
+        self._wake()
+
+    async def next_frame(self) -> Optional[str]:
+        # None — слежение закончено (заказ доставлен, отменен или снят с курьера)
+        while True:
+            if self.closed:
+                return None
+            if self.latest is None:
+                self._waiter = asyncio.get_running_loop().create_future()
+                try:
+                    await self._waiter
+                finally:
+                    self._waiter = None
+            if self.closed:
+                return None
+            # Кадры, пришедшие во время паузы, схлопываются в последний
+            delay = self.last_sent + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            frame, self.latest = self.latest, None
+            if frame is not None:
+                self.last_sent = time.monotonic()
+                return frame
 
 class GPSTracker:
-    def __init__(self):
+    def __init__(self, min_interval: float, bridge_enabled: bool):
         self.active_connections: dict = {}  # courier_id: WebSocket
+        self.min_interval = min_interval
+        self.bridge_enabled = bridge_enabled
+        self.watchers: Dict[int, Set[PositionWatcher]] = {}  # courier_id: подписки клиентов
+        self.order_watchers: Dict[int, Set[PositionWatcher]] = {}  # order_id: те же подписки
+        self._origin = uuid.uuid4().hex
+        self._pending_publish: Dict[int, str] = {}
+        self._channels_changed: Optional[asyncio.Event] = None
+        self._tasks = []
+
+        self.frames_total = 0
+        self.published_total = 0
+        self.connections_total = 0
 
     async def connect(self, courier_id: int, websocket: WebSocket):
         await websocket.accept()
         self.active_connections[courier_id] = websocket
+        self.connections_total += 1
+
+    def disconnect(self, courier_id: int, websocket: WebSocket):
+        # Новое соединение того же курьера могло заменить это — его не трогаем
+        if self.active_connections.get(courier_id) is websocket:
+            del self.active_connections[courier_id]
+
+    def _attach(self, watcher: PositionWatcher):
+        watchers = self.watchers.get(watcher.courier_id)
+        if watchers is None:
+            watchers = self.watchers[watcher.courier_id] = set()
+            self._notify_channels_changed()
+        watchers.add(watcher)
+        position = courier_index.get(watcher.courier_id)
+        if position is not None:
+            watcher.offer(self._frame(
+                watcher.courier_id, position.latitude, position.longitude, position.timestamp.isoformat()
+            ))
+
+    def _detach(self, watcher: PositionWatcher):
+        watchers = self.watchers.get(watcher.courier_id)
+        if not watchers:
+            return
+        watchers.discard(watcher)
+        if not watchers:
+            del self.watchers[watcher.courier_id]
+            self._notify_channels_changed()
+
+    def watch(self, order_id: int, courier_id: int) -> PositionWatcher:
+        watcher = PositionWatcher(courier_id, order_id, self.min_interval)
+        self.order_watchers.setdefault(order_id, set()).add(watcher)
+        self._attach(watcher)
+        return watcher
 
-    def disconnect(self, courier_id: int):
-        self.active_connections.pop(courier_id, None)
+    def unwatch(self, watcher: PositionWatcher):
+        self._detach(watcher)
+        order_watchers = self.order_watchers.get(watcher.order_id)
+        if order_watchers is not None:
+            order_watchers.discard(watcher)
+            if not order_watchers:
+                del self.order_watchers[watcher.order_id]
 
-    async def update_location(self, courier_id: int, latitude: float, longitude: float, db: Session):
-        location = CourierLocation(
-            courier_id=courier_id,
-            latitude=latitude,
-            longitude=longitude
-        )
-        db.add(location)
-        db.commit()
+    def _apply_order_update(self, order_id: int, status: str, courier_id: Optional[int]):
+        for watcher in list(self.order_watchers.get(order_id, ())):
+            if status in TRACKING_END_STATUSES or courier_id is None:
+                # Соединение закрывает обработчик WebSocket, он же снимает подписку
+                watcher.close()
+            elif watcher.courier_id != courier_id:
+                self._detach(watcher)
+                watcher.courier_id = courier_id
+                watcher.last_sent = 0.0
+                self._attach(watcher)
+
+    async def on_order_update(self, order_id: int, status: str, courier_id: Optional[int]):
+        # Подписчик order_events и ручного переназначения: подписки заказа переходят к новому курьеру
+        # или закрываются, когда следить больше не за кем
+        await self.on_order_updates([(order_id, status, courier_id)])
+
+    async def on_order_updates(self, updates: List[Tuple[int, str, Optional[int]]]):
+        # Пачка обновлений (диспетчер) уходит другим воркерам одним pipeline
+        for order_id, status, courier_id in updates:
+            self._apply_order_update(order_id, status, courier_id)
+        if not self.bridge_enabled or not updates:
+            return
+        try:
+            pipe = async_redis_client.pipeline(transaction=False)
+            for order_id, status, courier_id in updates:
+                pipe.publish(
+                    ORDER_CHANNEL, f"{self._origin}|{order_id}|{status}|{courier_id if courier_id is not None else ''}"
+                )
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("Order tracking update publish failed for %d orders: %s", len(updates), e)
+
+    def _notify_channels_changed(self):
+        if self._channels_changed is not None:
+            self._channels_changed.set()
+
+    @staticmethod
+    def _frame(courier_id: int, latitude: float, longitude: float, timestamp: str) -> str:
+        return json.dumps({
+            "courier_id": courier_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "timestamp": timestamp
+        })
+
+    def _fan_out(self, courier_id: int, frame: str):
+        for watcher in self.watchers.get(courier_id, ()):
+            watcher.offer(frame)
+
+    async def update_location(self, courier_id: int, latitude: float, longitude: float):
+        # Точка уходит в буфер и пишется в БД пачкой вместе с остальными
+        timestamp = await location_buffer.submit(courier_id, latitude, longitude)
+        courier_index.update(courier_id, latitude, longitude, timestamp)
+        route_planner.on_location(courier_id)
+        gps_logger.info("Courier %s at %.6f,%.6f", courier_id, latitude, longitude, extra={"courier_id": courier_id})
+
+        # Кадр сериализуется один раз и раздается всем подписчикам заказов курьера
+        frame = self._frame(courier_id, latitude, longitude, timestamp.isoformat())
+        self.frames_total += 1
+        self._fan_out(courier_id, frame)
+        if self.bridge_enabled:
+            self._pending_publish[courier_id] = frame
 
-        # Отправляем обновление всем подписчикам
         if courier_id in self.active_connections:
-            await self.active_connections[courier_id].send_json({
-                "latitude": latitude,
-                "longitude": longitude,
-                "timestamp": location.timestamp.isoformat()
-            })
+            await self.active_connections[courier_id].send_text(frame)
+
+    @staticmethod
+    def _channel(courier_id: int) -> str:
+        return f"gps:courier:{courier_id}"
+
+    async def _publish_loop(self):
+        # Для других воркеров позиции уходят пачкой раз в min_interval: не чаще, чем их получат клиенты
+        while True:
+            await asyncio.sleep(self.min_interval)
+            if not self._pending_publish:
+                continue
+            pending, self._pending_publish = self._pending_publish, {}
+            try:
+                pipe = async_redis_client.pipeline(transaction=False)
+                for courier_id, frame in pending.items():
+                    pipe.publish(self._channel(courier_id), f"{self._origin}|{frame}")
+                await pipe.execute()
+                self.published_total += len(pending)
+            except Exception as e:
+                logger.warning("GPS broadcast publish failed for %d couriers: %s", len(pending), e)
+
+    async def _listen(self):
+        # Подписываемся только на каналы курьеров, за которыми следят клиенты этого воркера
+        pubsub = async_redis_client.pubsub()
+        subscribed: Set[str] = set()
+        try:
+            while True:
+                try:
+                    if self._channels_changed.is_set():
+                        self._channels_changed.clear()
+                        wanted = {self._channel(courier_id) for courier_id in self.watchers}
+                        if self.order_watchers:
+                            wanted.add(ORDER_CHANNEL)
+                        if wanted - subscribed:
+                            await pubsub.subscribe(*(wanted - subscribed))
+                        if subscribed - wanted:
+                            await pubsub.unsubscribe(*(subscribed - wanted))
+                        subscribed = wanted
+                    if not subscribed:
+                        try:
+                            await asyncio.wait_for(self._channels_changed.wait(), timeout=1.0)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.2)
+                except Exception as e:
+                    logger.warning("GPS broadcast listener error: %s", e)
+                    subscribed = set()
+                    self._channels_changed.set()
+                    await asyncio.sleep(1.0)
+                    continue
+                if not message or message["type"] != "message":
+                    continue
+                origin, payload = message["data"].decode().split("|", 1)
+                if origin == self._origin:
+                    continue
+                channel = message["channel"].decode()
+                if channel == ORDER_CHANNEL:
+                    order_id, status, courier_id = payload.split("|")
+                    self._apply_order_update(int(order_id), status, int(courier_id) if courier_id else None)
+                else:
+                    self._fan_out(int(channel.rsplit(":", 1)[1]), payload)
+        finally:
+            await pubsub.close()
+
+    def start(self):
+        if not self.bridge_enabled or self._tasks:
+            return
+        loop = asyncio.get_running_loop()
+        self._channels_changed = asyncio.Event()
+        self._channels_changed.set()
+        self._tasks = [loop.create_task(self._publish_loop()), loop.create_task(self._listen())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._channels_changed = None
+
+    def stats(self) -> dict:
+        return {
+            "courier_connections": len(self.active_connections),
+            "watched_couriers": len(self.watchers),
+            "watchers": sum(len(watchers) for watchers in self.watchers.values()),
+            "frames_total": self.frames_total,
+            "published_total": self.published_total,
+            "connections_total": self.connections_total,
+        }
 
-gps_tracker = GPSTracker() 
\ No newline at end of file
+gps_tracker = GPSTracker(
+    min_interval=settings.TRACKING_MIN_INTERVAL_SECONDS,
+    bridge_enabled=settings.TRACKING_REDIS_BRIDGE
+)
@@ -0,0 +1,249 @@
+import asyncio
+import heapq
+import math
+import struct
+import sys
+import time
+import zlib
+from array import array
+from datetime import date, datetime, timedelta
+from typing import Iterator, List, Optional, Tuple
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import CourierLocation, CourierTrackSegment
+from sqlite_writer import run_background_write
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+Point = Tuple[datetime, float, float]
+
+SEGMENT_VERSION = 1
+# Версия, число точек, время первой точки (мс), широта и долгота первой точки (1e-6 градуса)
+_HEADER = struct.Struct("<BIqii")
+_EPOCH = datetime(1970, 1, 1)
+_COORD_SCALE = 1_000_000
+_METERS_PER_DEGREE = 111_320.0
+
+def _to_ms(value: datetime) -> int:
+    return (value - _EPOCH) // timedelta(milliseconds=1)
+
+def _from_ms(value: int) -> datetime:
+    return _EPOCH + timedelta(milliseconds=value)
+
+def encode_segment(points: List[Point]) -> bytes:
+    # Колонки время/широта/долгота хранятся как дельты int32 от предыдущей точки и сжимаются zlib:
+    # соседние фиксы близки, поэтому старшие байты дельт почти всегда нулевые
+    times = [_to_ms(timestamp) for timestamp, _, _ in points]
+    lats = [round(latitude * _COORD_SCALE) for _, latitude, _ in points]
+    lons = [round(longitude * _COORD_SCALE) for _, _, longitude in points]
+    columns = array("i")
+    for column in (times, lats, lons):
+        columns.extend(b - a for a, b in zip(column, column[1:]))
+    if sys.byteorder == "big":
+        columns.byteswap()
+    header = _HEADER.pack(SEGMENT_VERSION, len(points), times[0], lats[0], lons[0])
+    return header + zlib.compress(columns.tobytes(), 6)
+
+def decode_segment(data: bytes) -> Iterator[Point]:
+    version, count, time_ms, lat, lon = _HEADER.unpack_from(data)
+    if version != SEGMENT_VERSION:
+        raise ValueError(f"Unsupported track segment version {version}")
+    columns = array("i")
+    columns.frombytes(zlib.decompress(data[_HEADER.size:]))
+    if sys.byteorder == "big":
+        columns.byteswap()
+    deltas = count - 1
+    yield _from_ms(time_ms), lat / _COORD_SCALE, lon / _COORD_SCALE
+    for i in range(deltas):
+        time_ms += columns[i]
+        lat += columns[deltas + i]
+        lon += columns[2 * deltas + i]
+        yield _from_ms(time_ms), lat / _COORD_SCALE, lon / _COORD_SCALE
+
+def simplify_track(points: List[Point], tolerance_m: float) -> List[Point]:
+    # Дуглас — Пекер без рекурсии; расстояния в локальной равнопромежуточной проекции
+    if tolerance_m <= 0 or len(points) < 3:
+        return points
+    cos_lat = math.cos(math.radians(points[0][1]))
+    xy = [(longitude * _METERS_PER_DEGREE * cos_lat, latitude * _METERS_PER_DEGREE)
+          for _, latitude, longitude in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = xy[first], xy[last]
+        dx, dy = x2 - x1, y2 - y1
+        length = math.hypot(dx, dy)
+        max_distance, index = 0.0, None
+        for i in range(first + 1, last):
+            x0, y0 = xy[i]
+            if length > 0:
+                distance = abs(dy * x0 - dx * y0 + x2 * y1 - y2 * x1) / length
+            else:
+                distance = math.hypot(x0 - x1, y0 - y1)
+            if distance > max_distance:
+                max_distance, index = distance, i
+        if index is not None and max_distance > tolerance_m:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+# Компактор истории: сырые фиксы старше retention сворачиваются в один сегмент на курьера и день.
+# Каждый курьер обрабатывается своей короткой транзакцией: сегменты дня дописываются,
+# затем удаляются ровно прочитанные строки (id не больше максимального прочитанного).
+class LocationCompactor:
+    def __init__(self, retention_hours: int, interval_seconds: float, tolerance_m: float):
+        self.retention_hours = retention_hours
+        self.interval_seconds = interval_seconds
+        self.tolerance_m = tolerance_m
+        self._task: Optional[asyncio.Task] = None
+
+        self.runs = 0
+        self.compacted_points_total = 0
+        self.stored_points_total = 0
+        self.last_run_seconds = 0.0
+
+    def _merge_day(self, db: Session, courier_id: int, day: date, points: List[Point]) -> int:
+        points = simplify_track(points, self.tolerance_m)
+        kept = len(points)
+        segment = db.execute(
+            select(CourierTrackSegment)
+            .where(CourierTrackSegment.courier_id == courier_id, CourierTrackSegment.day == day)
+        ).scalars().first()
+        if segment is not None:
+            points = sorted(list(decode_segment(segment.data)) + points, key=lambda point: point[0])
+        else:
+            segment = CourierTrackSegment(courier_id=courier_id, day=day)
+            db.add(segment)
+        segment.start_time = points[0][0]
+        segment.end_time = points[-1][0]
+        segment.point_count = len(points)
+        segment.data = encode_segment(points)
+        return kept
+
+    def compact_courier(self, db: Session, courier_id: int, cutoff: datetime) -> Tuple[int, int]:
+        table = CourierLocation.__table__
+        rows = db.execute(
+            select(table.c.id, table.c.timestamp, table.c.latitude, table.c.longitude)
+            .where(table.c.courier_id == courier_id, table.c.timestamp < cutoff)
+            .order_by(table.c.timestamp)
+        ).all()
+        if not rows:
+            return 0, 0
+
+        days = {}
+        for _, timestamp, latitude, longitude in rows:
+            days.setdefault(timestamp.date(), []).append((timestamp, latitude, longitude))
+        stored = sum(self._merge_day(db, courier_id, day, points) for day, points in days.items())
+        max_id = max(row.id for row in rows)
+        db.execute(
+            delete(table)
+            .where(table.c.courier_id == courier_id, table.c.timestamp < cutoff, table.c.id <= max_id)
+        )
+        return len(rows), stored
+
+    @staticmethod
+    def _stale_couriers(cutoff: datetime) -> List[int]:
+        db = SessionLocal()
+        try:
+            return db.execute(
+                select(CourierLocation.courier_id)
+                .where(CourierLocation.timestamp < cutoff)
+                .group_by(CourierLocation.courier_id)
+            ).scalars().all()
+        finally:
+            db.close()
+
+    async def compact_once(self, now: Optional[datetime] = None) -> Tuple[int, int]:
+        started = time.perf_counter()
+        cutoff = (now or datetime.utcnow()) - timedelta(hours=self.retention_hours)
+        courier_ids = await asyncio.get_running_loop().run_in_executor(None, self._stale_couriers, cutoff)
+
+        compacted = stored = 0
+        for courier_id in courier_ids:
+            try:
+                raw, kept = await run_background_write(
+                    lambda session: self.compact_courier(session, courier_id, cutoff)
+                )
+            except Exception as e:
+                logger.error("Location compaction failed for courier %s: %s", courier_id, e)
+                continue
+            compacted += raw
+            stored += kept
+
+        self.runs += 1
+        self.compacted_points_total += compacted
+        self.stored_points_total += stored
+        self.last_run_seconds = time.perf_counter() - started
+        if compacted:
+            logger.info("Compacted %d GPS fixes of %d couriers into %d points in %.3fs",
+                        compacted, len(courier_ids), stored, self.last_run_seconds)
+        return compacted, stored
+
+    async def _run(self):
+        while True:
+            try:
+                await self.compact_once()
+            except Exception as e:
+                logger.error("Location compaction run failed: %s", e)
+            await asyncio.sleep(self.interval_seconds)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+def iter_track(db: Session, courier_id: int, start: datetime, end: datetime,
+               chunk_size: int = 5000) -> Iterator[Point]:
+    # Трек по времени: сжатые сегменты и еще не свернутые сырые фиксы сливаются по timestamp
+    # (сырые точки могут быть старше сегментов — например, пришедшие с опозданием); ORM-объекты не создаются.
+    # Сегменты компактны и читаются целиком, сырые фиксы — потоком
+    segments = db.execute(
+        select(CourierTrackSegment.data)
+        .where(
+            CourierTrackSegment.courier_id == courier_id,
+            CourierTrackSegment.start_time <= end,
+            CourierTrackSegment.end_time >= start
+        )
+        .order_by(CourierTrackSegment.start_time)
+    ).scalars().all()
+
+    def compacted() -> Iterator[Point]:
+        for data in segments:
+            for point in decode_segment(data):
+                if start <= point[0] <= end:
+                    yield point
+
+    def raw() -> Iterator[Point]:
+        table = CourierLocation.__table__
+        result = db.execute(
+            select(table.c.timestamp, table.c.latitude, table.c.longitude)
+            .where(table.c.courier_id == courier_id, table.c.timestamp >= start, table.c.timestamp <= end)
+            .order_by(table.c.timestamp)
+            .execution_options(stream_results=True)
+        )
+        for rows in result.partitions(chunk_size):
+            for timestamp, latitude, longitude in rows:
+                yield timestamp, latitude, longitude
+
+    yield from heapq.merge(compacted(), raw(), key=lambda point: point[0])
+
+location_compactor = LocationCompactor(
+    retention_hours=settings.LOCATION_RAW_RETENTION_HOURS,
+    interval_seconds=settings.LOCATION_COMPACTION_INTERVAL_SECONDS,
+    tolerance_m=settings.LOCATION_SIMPLIFY_TOLERANCE_M
+)
@@ -1,19 +1,174 @@
+import atexit
+import copy
+import itertools
+import json
 import logging
-from datetime import datetime
+import logging.handlers
 import os
+import queue
+import traceback
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+from config import get_settings
+
+settings = get_settings()
 
 # Создаем директорию для логов, если её нет
-if not os.path.exists('logs'):
-    os.makedirs('logs')
-
-# Настраиваем логгер
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(f'logs/app_{datetime.now().strftime("%Y%m%d")}.log'),
-        logging.StreamHandler()
-    ]
-)
-
-logger = logging.getLogger(__name__) 
\ No newline at end of file
+os.makedirs(os.path.dirname(settings.LOG_FILE) or '.', exist_ok=True)
+
+# Текущий HTTP-запрос: id запроса и scope, из которого после маршрутизации
+# читаются order_id и courier_id параметров пути
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_request_scope: ContextVar[Optional[dict]] = ContextVar("request_scope", default=None)
+PATH_CORRELATION_FIELDS = ("order_id", "courier_id")
+
+_STANDARD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+class ContextFilter(logging.Filter):
+    # Выполняется в потоке, который пишет в лог, пока контекст запроса еще доступен
+    def filter(self, record: logging.LogRecord) -> bool:
+        request_id = _request_id.get()
+        if request_id is not None and not hasattr(record, "request_id"):
+            record.request_id = request_id
+        scope = _request_scope.get()
+        if scope is not None:
+            path_params = scope.get("path_params") or {}
+            for field in PATH_CORRELATION_FIELDS:
+                if field in path_params and not hasattr(record, field):
+                    setattr(record, field, path_params[field])
+        return True
+
+class SamplingFilter(logging.Filter):
+    # Пропускает одну запись из every; предупреждения и ошибки проходят всегда
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(every, 1)
+        self._counter = itertools.count()
+        self.dropped_total = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or next(self._counter) % self.every == 0:
+            return True
+        self.dropped_total += 1
+        return False
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        elif record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Запись в лог только кладет готовую запись в очередь; файл и консоль пишет поток QueueListener,
+# поэтому зависание диска не задерживает запросы. При переполнении запись отбрасывается.
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped_total = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Сообщение подставляется здесь: аргументы могут измениться после возврата из вызова.
+        # JSON собирается уже в потоке слушателя.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_total += 1
+
+def _file_handler() -> logging.Handler:
+    # RotatingFileHandler нельзя делить между воркерами: каждый ротирует файл сам и затирает чужие записи
+    if settings.LOG_ROTATION == "external":
+        return logging.handlers.WatchedFileHandler(settings.LOG_FILE, encoding='utf-8')
+    root, extension = os.path.splitext(settings.LOG_FILE)
+    return logging.handlers.RotatingFileHandler(
+        f"{root}.{os.getpid()}{extension}", maxBytes=settings.LOG_MAX_BYTES,
+        backupCount=settings.LOG_BACKUP_COUNT, encoding='utf-8'
+    )
+
+def _configure():
+    log_queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    formatter = JsonFormatter() if settings.LOG_JSON else logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    file_handler = _file_handler()
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.setLevel(settings.LOG_LEVEL)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Дописываем очередь при завершении процесса
+    atexit.register(listener.stop)
+    return queue_handler
+
+queue_handler = _configure()
+
+logger = logging.getLogger(__name__)
+
+# Массовые события (точки GPS) пишутся в отдельный логгер с выборкой
+gps_sampler = SamplingFilter(settings.LOG_GPS_SAMPLE_EVERY)
+gps_logger = logging.getLogger(f"{__name__}.gps")
+gps_logger.addFilter(gps_sampler)
+
+def logging_stats() -> dict:
+    return {
+        "queue_depth": queue_handler.queue.qsize(),
+        "dropped_total": queue_handler.dropped_total,
+        "gps_sampled_out_total": gps_sampler.dropped_total,
+    }
+
+# ASGI-middleware: id запроса из X-Request-ID (или новый) в контексте логов и в заголовке ответа
+class RequestContextMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", ())) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        id_token = _request_id.set(request_id)
+        scope_token = _request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_scope.reset(scope_token)
+            _request_id.reset(id_token)
@@ -1,20 +1,48 @@
-from fastapi import FastAPI, Depends, HTTPException, Request, WebSocket
+import asyncio
+import json
+from fastapi import FastAPI, Body, Depends, Header, HTTPException, Query, Request, WebSocket, status
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
-from typing import List
-from database import get_db, init_db
-from models import Customer, Order, OrderItem, User, Courier, OrderStatus, Order, TrackingUpdate, Notification, UserRole, Review
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from database import get_db, get_async_db, get_async_read_db, init_db, SessionLocal, AsyncReadSessionLocal, IS_SQLITE
+from models import Customer, Order, OrderItem, User, Courier, OrderStatus, Notification, UserRole, Review
 from pydantic import BaseModel, EmailStr
+from jose import JWTError, jwt
 from fastapi.security import OAuth2PasswordRequestForm
-from auth import create_access_token, get_current_user
+from auth import REFRESH_TOKEN_TYPE, create_access_token, create_refresh_token, get_current_user, oauth2_scheme, principal_cache, revoke_token, token_claims
 from datetime import timedelta, datetime
-from pydantic import validator
-from fastapi.middleware.cors import CORSMiddleware
+from pydantic import validator, ValidationError
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from rate_limiter import rate_limit
-from cache import get_cached_data, set_cached_data
-from payment_service import PaymentService, PaymentError
-from logger import logger
+from order_read_model import get_order_view, invalidate_order, invalidate_orders_async
+from cache import cache
+from promocode_service import PromocodeService
+from payment_service import PaymentService, PaymentError, PaymentInProgress, payment_gateway, payment_reconciler
+from order_service import OrderService
+from logger import logger, logging_stats, RequestContextMiddleware
 from fastapi import WebSocketDisconnect
-from tracking.gps_tracker import gps_tracker
+from gps_tracker import gps_tracker
+from gps_ingestion import location_buffer
+from spatial_index import courier_index
+from dispatch import dispatch_engine
+from route_planner import route_planner
+from sqlite_writer import sqlite_writer, run_write
+from password_hasher import password_hasher, PasswordHasherBusy
+from notification_outbox import notification_outbox, outbox_rows, add_to_outbox
+from notification_hub import notification_hub, notification_event
+from notification_service import NotificationService
+from location_history import location_compactor, iter_track
+from order_stats import order_stats, transition_deltas
+from courier_ratings import CourierRatingService, courier_ratings
+from order_state_machine import OrderStateMachine, OrderStatusChanged, TransitionRejected, can_transition, order_events
+from metrics import MetricsMiddleware, registry
+from admin_router import admin_router
+from config import get_settings
+
+settings = get_settings()
 
 app = FastAPI(
     title="Delivery Service API",
@@ -22,12 +50,34 @@ app = FastAPI(
     version="1.0.0"
 )
 
+app.include_router(admin_router)
+
 @app.middleware("http")
 async def rate_limit_middleware(request: Request, call_next):
-    await rate_limit(request)
+    if request.url.path in settings.RATE_LIMIT_EXEMPT_PATHS:
+        return await call_next(request)
+    decision = await rate_limit(request)
+    if not decision.allowed:
+        # Исключение из middleware не проходит через обработчики FastAPI — отвечаем сами
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Too many requests"},
+            headers={
+                "Retry-After": str(decision.retry_after),
+                "X-RateLimit-Limit": str(decision.limit),
+                "X-RateLimit-Remaining": "0",
+            }
+        )
     response = await call_next(request)
+    response.headers["X-RateLimit-Limit"] = str(decision.limit)
+    response.headers["X-RateLimit-Remaining"] = str(decision.remaining)
     return response
 
+# Добавляются последними, поэтому оборачивают остальные middleware и видят ответы 429
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+app.add_middleware(RequestContextMiddleware)
+
 class CustomerCreate(BaseModel):
     name: str
     address: str
@@ -41,6 +91,8 @@ class CustomerCreate(BaseModel):
 class OrderCreate(BaseModel):
     customer_id: int
     delivery_address: str
+    delivery_latitude: Optional[float] = None
+    delivery_longitude: Optional[float] = None
     items: List[dict]
     
     @validator('items')
@@ -59,148 +111,428 @@ class OrderCreate(BaseModel):
 class PaymentCreate(BaseModel):
     order_id: int
     payment_method: str
-    amount: float
 
 class ReviewCreate(BaseModel):
     rating: int
     comment: str
 
+    @validator('rating')
+    def validate_rating(cls, v):
+        if not 1 <= v <= 5:
+            raise ValueError('Оценка должна быть от 1 до 5')
+        return v
+
+class NotificationsRead(BaseModel):
+    # Без ids помечаются прочитанными все уведомления пользователя
+    ids: Optional[List[int]] = None
+
+class CourierAvailability(BaseModel):
+    is_available: bool
+
+async def require_order_access(db: AsyncSession, order_id: int, user: User):
+    allowed = await OrderService.can_access(db, order_id, user)
+    if allowed is None:
+        raise HTTPException(status_code=404, detail="Заказ не найден")
+    if not allowed:
+        raise HTTPException(status_code=403, detail="Недостаточно прав")
+
+def batch_transition_deltas(events: List[OrderStatusChanged]) -> dict:
+    deltas = {}
+    for event in events:
+        for key, value in transition_deltas(None, event.status, event.total_price).items():
+            deltas[key] = deltas.get(key, 0) + value
+    return deltas
+
+# Реакции на смену статуса заказа; пакетные варианты — для пачек диспетчера
+order_events.subscribe(
+    lambda event: invalidate_order(event.order_id),
+    lambda events: invalidate_orders_async(event.order_id for event in events)
+)
+order_events.subscribe(
+    lambda event: order_stats.record(transition_deltas(None, event.status, event.total_price)),
+    lambda events: order_stats.record(batch_transition_deltas(events))
+)
+order_events.subscribe(lambda event: route_planner.on_status(event.order_id, event.status))
+order_events.subscribe(
+    lambda event: gps_tracker.on_order_update(event.order_id, event.status, event.courier_id),
+    lambda events: gps_tracker.on_order_updates([(event.order_id, event.status, event.courier_id) for event in events])
+)
+
+# Внутренние счетчики фоновых компонентов в /metrics
+registry.register_stats("gps_tracker", gps_tracker.stats)
+registry.register_stats("gps_ingestion", location_buffer.stats)
+registry.register_stats("notification_hub", notification_hub.stats)
+registry.register_stats("notification_outbox", notification_outbox.stats)
+registry.register_stats("sqlite_writer", sqlite_writer.stats)
+registry.register_stats("password_hasher", password_hasher.stats)
+registry.register_stats("payment_gateway", payment_gateway.stats)
+registry.register_stats("payment_reconciler", payment_reconciler.stats)
+registry.register_stats("order_events", lambda: {
+    "published_total": order_events.published_total,
+    "handler_errors_total": order_events.handler_errors_total,
+})
+registry.register_stats("order_stats", order_stats.stats)
+registry.register_stats("courier_ratings", courier_ratings.stats)
+registry.register_stats("logging", logging_stats)
+
 @app.on_event("startup")
 async def startup():
     init_db()
+    db = SessionLocal()
+    try:
+        courier_index.load(db)
+        route_planner.load(db)
+        courier_ratings.load(db)
+    finally:
+        db.close()
+    if IS_SQLITE and settings.SQLITE_SINGLE_WRITER:
+        sqlite_writer.start()
+    location_buffer.start()
+    route_planner.start()
+    cache.start()
+    principal_cache.start()
+    notification_hub.start()
+    gps_tracker.start()
+    payment_reconciler.start()
+    courier_ratings.start()
+    if settings.OUTBOX_ENABLED:
+        notification_outbox.start()
+    if settings.DISPATCH_ENABLED:
+        dispatch_engine.start()
+    if settings.LOCATION_COMPACTION_ENABLED:
+        location_compactor.start()
+    if settings.STATS_RECONCILE_ENABLED:
+        order_stats.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await cache.stop()
+    await principal_cache.stop()
+    await notification_hub.stop()
+    await gps_tracker.stop()
+    await payment_reconciler.stop()
+    await dispatch_engine.stop()
+    await location_compactor.stop()
+    await order_stats.stop()
+    await courier_ratings.stop()
+    await notification_outbox.stop()
+    await route_planner.stop()
+    # Дописываем накопленные GPS-точки перед остановкой писателя
+    await location_buffer.stop()
+    await sqlite_writer.stop()
+    password_hasher.shutdown()
+    payment_gateway.shutdown()
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 @app.post("/customers/")
-def create_customer(customer: CustomerCreate, db: Session = Depends(get_db)):
-    db_customer = Customer(**customer.dict())
-    db.add(db_customer)
-    db.commit()
-    db.refresh(db_customer)
-    return db_customer
+async def create_customer(customer: CustomerCreate, db: AsyncSession = Depends(get_async_db)):
+    def write(session: Session):
+        db_customer = Customer(**customer.dict())
+        session.add(db_customer)
+        session.flush()
+        return db_customer
+    
+    return await run_write(db, write)
 
 @app.post("/orders/")
-async def create_order(order: OrderCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_order(order: OrderCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     # Проверяем существование клиента
-    customer = db.query(Customer).filter(Customer.id == order.customer_id).first()
+    customer = await db.get(Customer, order.customer_id)
     if not customer:
         raise HTTPException(status_code=404, detail="Клиент не найден")
     
     # Вычисление общей стоимости
     total_price = sum(item["price"] * item["quantity"] for item in order.items)
     
-    # Создание заказа
-    db_order = Order(
-        customer_id=order.customer_id,
-        delivery_address=order.delivery_address,
-        total_price=total_price
-    )
-    db.add(db_order)
-    db.commit()
-    
-    # Добавление позиций заказа
-    for item in order.items:
-        order_item = OrderItem(
-            order_id=db_order.id,
-            product_name=item["product_name"],
-            quantity=item["quantity"],
-            price=item["price"]
+    def write(session: Session):
+        # Создание заказа
+        db_order = Order(
+            customer_id=order.customer_id,
+            delivery_address=order.delivery_address,
+            delivery_latitude=order.delivery_latitude,
+            delivery_longitude=order.delivery_longitude,
+            total_price=total_price
         )
-        db.add(order_item)
+        session.add(db_order)
+        session.flush()
+        
+        # Добавление позиций заказа в той же транзакции
+        for item in order.items:
+            order_item = OrderItem(
+                order_id=db_order.id,
+                product_name=item["product_name"],
+                quantity=item["quantity"],
+                price=item["price"]
+            )
+            session.add(order_item)
+        return db_order
     
-    db.commit()
-    db.refresh(db_order)
+    db_order = await run_write(db, write)
+    await order_stats.record({"orders_created": 1})
     return db_order
 
-@app.get("/orders/{order_id}")
-async def get_order(order_id: int, db: Session = Depends(get_db)):
-    cache_key = f"order:{order_id}"
-    cached_order = get_cached_data(cache_key)
+@app.post("/orders/bulk")
+async def create_orders_bulk(
+    orders: List[dict] = Body(...),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if len(orders) > settings.BULK_ORDER_MAX_BATCH:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Не более {settings.BULK_ORDER_MAX_BATCH} заказов за один запрос"
+        )
     
-    if cached_order:
-        return cached_order
-        
-    order = db.query(Order).filter(Order.id == order_id).first()
+    # Валидируем каждый заказ отдельно, чтобы ошибка в одном не отклоняла всю пачку
+    valid = []
+    failed = []
+    for index, payload in enumerate(orders):
+        try:
+            valid.append((index, OrderCreate.parse_obj(payload)))
+        except ValidationError as e:
+            failed.append({"index": index, "errors": e.errors()})
+    
+    # Все клиенты проверяются одним запросом IN
+    customer_ids = {order.customer_id for _, order in valid}
+    existing = set()
+    if customer_ids:
+        result = await db.execute(select(Customer.id).where(Customer.id.in_(customer_ids)))
+        existing = set(result.scalars())
+    
+    accepted = []
+    for index, order in valid:
+        if order.customer_id in existing:
+            accepted.append((index, order))
+        else:
+            failed.append({"index": index, "errors": [{"msg": "Клиент не найден"}]})
+    
+    order_ids = []
+    if accepted:
+        order_ids = await run_write(db, lambda session: OrderService.bulk_insert(
+            session, [order for _, order in accepted]
+        ))
+        await order_stats.record({"orders_created": len(order_ids)})
+    
+    return {
+        "created": [
+            {"index": index, "order_id": order_id}
+            for (index, _), order_id in zip(accepted, order_ids)
+        ],
+        "failed": sorted(failed, key=lambda entry: entry["index"])
+    }
+
+@app.get("/orders/{order_id}")
+async def get_order(
+    order_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    # В заказе контакты клиента и курьера — только для участников заказа
+    await require_order_access(db, order_id, current_user)
+    order = await get_order_view(db, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Заказ не найден")
-    
-    order_data = jsonable_encoder(order)
-    set_cached_data(cache_key, order_data)
     return order
 
 @app.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == form_data.username).first()
-    if not user or not user.check_password(form_data.password):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    result = await db.execute(select(User).where(User.email == form_data.username))
+    user = result.scalars().first()
+    if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Неверный email или пароль",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    old_hash = user.password_hash
+    try:
+        valid = await user.verify_password(form_data.password)
+    except PasswordHasherBusy:
+        raise HTTPException(
+            status_code=503,
+            detail="Сервис авторизации перегружен, повторите попытку позже",
+            headers={"Retry-After": "1"},
+        )
+    if not valid:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Неверный email или пароль",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if user.password_hash != old_hash:
+        new_hash = user.password_hash
+        # Условие по старому хэшу не даст затереть пароль, смененный параллельно
+        await run_write(db, lambda session: session.execute(
+            update(User)
+            .where(User.id == user.id, User.password_hash == old_hash)
+            .values(password_hash=new_hash)
+        ))
+    access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data=token_claims(user), expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
+@app.post("/refresh-token")
+async def refresh_token(refresh_token: str, db: Session = Depends(get_db)):
+    try:
+        payload = jwt.decode(refresh_token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        email: str = payload.get("sub")
+        if email is None or payload.get("typ") != REFRESH_TOKEN_TYPE:
+            raise HTTPException(status_code=401, detail="Invalid refresh token")
+        
+        user = db.query(User).filter(User.email == email).first()
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+        
+        access_token = create_access_token(data=token_claims(user))
+        new_refresh_token = create_refresh_token(data={"sub": user.email})
+        
+        return {"access_token": access_token, "refresh_token": new_refresh_token, "token_type": "bearer"}
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+
+@app.post("/logout")
+async def logout(token: str = Depends(oauth2_scheme)):
+    await revoke_token(token)
+    return {"status": "success"}
+
 @app.post("/orders/{order_id}/pay")
 async def process_payment(
     order_id: int,
     payment: PaymentCreate,
+    idempotency_key: Optional[str] = Header(None, max_length=64),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
+    # Без заголовка Idempotency-Key повторы одного заказа схлопываются в один платеж до первого отказа
+    await require_order_access(db, order_id, current_user)
     try:
-        order = db.query(Order).filter(Order.id == order_id).first()
-        if not order:
-            raise HTTPException(status_code=404, detail="Заказ не найден")
-        
-        status, payment_id = await PaymentService.process_payment(
-            amount=payment.amount,
+        result = await PaymentService.pay_order(
+            db,
+            order_id=order_id,
             currency="RUB",
             payment_method=payment.payment_method,
-            order_id=str(order_id)
+            idempotency_key=idempotency_key
         )
-        
-        order.payment_status = status
-        order.payment_id = payment_id
-        db.commit()
-        
-        return {"status": status, "payment_id": payment_id}
-        
+    except PaymentInProgress:
+        raise HTTPException(status_code=409, detail="Платеж уже обрабатывается")
     except PaymentError as e:
-        logger.error(f"Payment failed for order {order_id}: {str(e)}")
+        logger.error("Payment failed for order %s: %s", order_id, e)
+        if e.error_code == "PROVIDER_UNAVAILABLE":
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
         raise HTTPException(status_code=400, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Заказ не найден")
+    return result
+
+@app.post("/orders/{order_id}/promocode")
+async def apply_promocode(
+    order_id: int,
+    code: str,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    await require_order_access(db, order_id, current_user)
+    total_price = await PromocodeService.redeem(db, code, order_id)
+    if total_price is None:
+        raise HTTPException(status_code=404, detail="Заказ не найден")
+    await invalidate_order(order_id)
+    return {"order_id": order_id, "total_price": total_price}
+
+@app.post("/payments/webhook")
+async def payment_webhook(request: Request):
+    # Отвечаем сразу: статус платежа подтвердит сверка пачкой
+    payload = await request.body()
+    try:
+        intent_ids = payment_gateway.provider.parse_webhook(payload, request.headers.get("stripe-signature"))
+    except (PaymentError, ValueError, KeyError):
+        raise HTTPException(status_code=400, detail="Некорректный вебхук")
+    payment_reconciler.track(intent_ids)
+    return {"received": len(intent_ids)}
 
 @app.post("/orders/{order_id}/assign-courier")
 async def assign_courier(
     order_id: int,
-    courier_id: int,
+    courier_id: Optional[int] = None,
+    nearest: bool = False,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Недостаточно прав")
+    if courier_id is None and not nearest:
+        raise HTTPException(status_code=400, detail="Укажите courier_id или nearest=true")
     
-    order = db.query(Order).filter(Order.id == order_id).first()
-    courier = db.query(Courier).filter(Courier.id == courier_id).first()
+    order = await db.get(Order, order_id)
+    if order and courier_id is None:
+        # Автоматический режим: ближайший доступный курьер к адресу доставки
+        if order.delivery_latitude is None or order.delivery_longitude is None:
+            raise HTTPException(status_code=400, detail="У заказа не заданы координаты доставки")
+        candidates = courier_index.nearest(order.delivery_latitude, order.delivery_longitude, k=1)
+        if not candidates:
+            raise HTTPException(status_code=409, detail="Нет доступных курьеров")
+        courier_id = candidates[0][0]
+    courier = await db.get(Courier, courier_id)
     
     if not order or not courier:
         raise HTTPException(status_code=404, detail="Заказ или курьер не найден")
     
-    order.courier_id = courier_id
-    order.status = OrderStatus.ASSIGNED_TO_COURIER
-    db.commit()
+    # Повторное назначение меняет только курьера; остальные статусы проверяет машина состояний
+    status_changed = order.status != OrderStatus.ASSIGNED_TO_COURIER
+    if status_changed and not can_transition(order.status, OrderStatus.ASSIGNED_TO_COURIER):
+        raise HTTPException(status_code=409, detail=f"Нельзя назначить курьера заказу в статусе {order.status}")
+    courier_email = (await db.execute(select(User.email).where(User.id == courier.user_id))).scalar()
+    expected_version = order.version
     
-    # Создаем уведомление для курьера
-    notification = Notification(
-        user_id=courier.user_id,
-        order_id=order_id,
-        type="new_assignment",
-        message=f"Вам назначен новый заказ #{order_id}"
-    )
-    db.add(notification)
-    db.commit()
+    def write(session: Session):
+        db_order = session.get(Order, order_id)
+        # Статус проверялся по прочитанной версии: если заказ с тех пор менялся, назначение не применяем.
+        # Версия проверяется и в самом UPDATE, так что параллельный переход статуса не будет затерт
+        if db_order.version != expected_version:
+            raise StaleDataError(f"Order {order_id} version changed")
+        db_order.courier_id = courier_id
+        db_order.status = OrderStatus.ASSIGNED_TO_COURIER
+        
+        # Создаем уведомление для курьера и задания на доставку в той же транзакции
+        notification = Notification(
+            user_id=courier.user_id,
+            order_id=order_id,
+            type="new_assignment",
+            message=f"Вам назначен новый заказ #{order_id}"
+        )
+        session.add(notification)
+        add_to_outbox(session, outbox_rows(
+            notification.type, notification.message, courier.user_id, order_id, courier_email, courier.phone
+        ))
+        unread_deltas = NotificationService.count_created(session, [courier.user_id])
+        session.flush()
+        return db_order.version, notification, unread_deltas
     
-    return {"status": "success"}
+    try:
+        version, notification, unread_deltas = await run_write(db, write)
+    except StaleDataError:
+        raise HTTPException(status_code=409, detail="Заказ был изменен параллельно, повторите запрос")
+    if status_changed:
+        await order_events.publish(OrderStatusChanged(
+            order_id, OrderStatus.ASSIGNED_TO_COURIER, version, order.total_price,
+            courier_id, order.customer_id, datetime.utcnow()
+        ))
+    else:
+        # Переназначение без смены статуса: события нет, но подписчики слежения переходят к новому курьеру
+        await invalidate_order(order_id)
+        await gps_tracker.on_order_update(order_id, OrderStatus.ASSIGNED_TO_COURIER, courier_id)
+    await NotificationService.adjust_cached_async(unread_deltas)
+    notification_outbox.wake()
+    await notification_hub.publish(courier.user_id, notification_event(
+        notification.type, notification.message, order_id, notification.id, notification.created_at
+    ))
+    
+    route_planner.add_stop(courier_id, order_id, order.delivery_latitude, order.delivery_longitude)
+    return {"status": "success", "courier_id": courier_id}
 
 @app.post("/orders/{order_id}/tracking")
 async def add_tracking_update(
@@ -208,81 +540,336 @@ async def add_tracking_update(
     location: str,
     status: OrderStatus,
     comment: str = None,
+    expected_version: Optional[int] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     if current_user.role not in [UserRole.COURIER, UserRole.ADMIN]:
         raise HTTPException(status_code=403, detail="Недостаточно прав")
     
-    tracking_update = TrackingUpdate(
-        order_id=order_id,
-        status=status,
-        location=location,
-        comment=comment
-    )
-    db.add(tracking_update)
-    
-    order = db.query(Order).filter(Order.id == order_id).first()
-    order.status = status
-    if status == OrderStatus.DELIVERED:
-        order.actual_delivery_time = datetime.utcnow()
+    def write(session: Session):
+        event = OrderStateMachine.transition(session, order_id, status, location, comment, expected_version)
+        if event is None:
+            return None
+        
+        customer = session.execute(
+            select(Customer.email, Customer.phone, User.id.label("user_id"))
+            .select_from(Customer)
+            .outerjoin(User, User.email == Customer.email)
+            .where(Customer.id == event.customer_id)
+        ).first() if event.customer_id else None
+        if not customer:
+            return event, []
+        message = f"Статус заказа #{order_id}: {status.value}"
+        user_id = customer.user_id
+        add_to_outbox(session, outbox_rows("order_status", message, user_id, order_id, customer.email, customer.phone))
+        if user_id is None:
+            # У клиента нет учетной записи: письмо и SMS уходят, а уведомление в приложении показать некому
+            return event, []
+        notification = Notification(user_id=user_id, order_id=order_id, type="order_status", message=message)
+        session.add(notification)
+        NotificationService.count_created(session, [user_id])
+        session.flush()
+        return event, [(user_id, notification_event(
+            notification.type, message, order_id, notification.id, notification.created_at
+        ))]
     
-    db.commit()
+    try:
+        result = await run_write(db, write)
+    except TransitionRejected as e:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Недопустимый переход заказа из статуса {e.current} (версия {e.version}) в {status.value}"
+        )
+    if result is None:
+        raise HTTPException(status_code=404, detail="Заказ не найден")
+    event, events = result
+    await order_events.publish(event)
+    await NotificationService.adjust_cached_async({user_id: 1 for user_id, _ in events})
+    notification_outbox.wake()
+    await notification_hub.publish_many(events)
     
-    return {"status": "success"}
+    return {"status": "success", "version": event.version}
 
 @app.get("/notifications/")
 async def get_notifications(
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    try:
+        return await NotificationService.get_page(db, current_user.id, cursor, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный курсор")
+
+@app.get("/notifications/unread-count")
+async def get_unread_count(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_read_db)
 ):
-    notifications = db.query(Notification)\
-        .filter(Notification.user_id == current_user.id)\
-        .order_by(Notification.created_at.desc())\
-        .all()
-    return notifications 
+    return {"unread": await NotificationService.get_unread_count(db, current_user.id)}
+
+@app.post("/notifications/read")
+async def mark_notifications_read(
+    payload: NotificationsRead,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    updated = await run_write(
+        db, lambda session: NotificationService.mark_read(session, current_user.id, payload.ids)
+    )
+    await NotificationService.adjust_cached_async({current_user.id: -updated})
+    return {"updated": updated}
 
 @app.post("/orders/{order_id}/review")
 async def create_review(
     order_id: int,
     review: ReviewCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    order = db.query(Order).filter(Order.id == order_id).first()
+    await require_order_access(db, order_id, current_user)
+    order = (await db.execute(
+        select(Order.status, Order.customer_id, Order.courier_id).where(Order.id == order_id)
+    )).first()
     if not order:
         raise HTTPException(status_code=404, detail="Заказ не найден")
         
     if order.status != OrderStatus.DELIVERED:
         raise HTTPException(status_code=400, detail="Можно оставить отзыв только о доставленном заказе")
     
-    db_review = Review(
-        order_id=order_id,
-        customer_id=current_user.id,
-        courier_id=order.courier_id,
-        rating=review.rating,
-        comment=review.comment
-    )
-    db.add(db_review)
-    db.commit()
+    def write(session: Session):
+        db_review = Review(
+            order_id=order_id,
+            customer_id=order.customer_id,
+            courier_id=order.courier_id,
+            rating=review.rating,
+            comment=review.comment
+        )
+        session.add(db_review)
+        # Агрегаты рейтинга курьера обновляются в той же транзакции
+        if order.courier_id is not None:
+            CourierRatingService.record_review(session, order.courier_id, review.rating)
+        session.flush()
+        return db_review
     
+    try:
+        db_review = await run_write(db, write)
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Отзыв к заказу уже оставлен")
+    if order.courier_id is not None:
+        courier_ratings.apply(order.courier_id, review.rating)
     return db_review
 
+@app.get("/couriers/ratings")
+async def get_courier_ratings(
+    ids: List[int] = Query(...),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    if len(ids) > settings.RATING_LOOKUP_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"Не более {settings.RATING_LOOKUP_MAX_IDS} курьеров за запрос")
+    return await CourierRatingService.get_many(db, ids, settings.RATING_WINDOW_DAYS)
+
+@app.put("/couriers/{courier_id}/availability")
+async def set_courier_availability(
+    courier_id: int,
+    payload: CourierAvailability,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    courier = await db.get(Courier, courier_id)
+    if not courier:
+        raise HTTPException(status_code=404, detail="Курьер не найден")
+    # Выйти на смену или уйти с нее может сам курьер, администратор — любого курьера
+    if current_user.role != UserRole.ADMIN and courier.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Недостаточно прав")
+    
+    def write(session: Session):
+        session.execute(
+            update(Courier).where(Courier.id == courier_id).values(is_available=payload.is_available)
+        )
+    
+    await run_write(db, write)
+    # Индекс ближайших курьеров должен видеть смену сразу, а не с очередным проходом диспетчера
+    courier_index.set_available(courier_id, payload.is_available)
+    return {"courier_id": courier_id, "is_available": payload.is_available}
+
+def parse_location(data) -> tuple:
+    latitude, longitude = float(data["latitude"]), float(data["longitude"])
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError(f"Coordinates out of range: {latitude}, {longitude}")
+    return latitude, longitude
+
 @app.websocket("/ws/courier/{courier_id}/location")
 async def websocket_courier_location(
     websocket: WebSocket,
     courier_id: int,
-    db: Session = Depends(get_db)
+    token: str
 ):
+    # Позиции питают слежение клиентов, индекс ближайших курьеров и ETA — слать их может только сам курьер
+    try:
+        current_user = await get_current_user(token)
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    async with AsyncReadSessionLocal() as db:
+        courier_user_id = (await db.execute(select(Courier.user_id).where(Courier.id == courier_id))).first()
+    if courier_user_id is None:
+        await websocket.close(code=4404)
+        return
+    if courier_user_id[0] != current_user.id:
+        await websocket.close(code=4403)
+        return
+    
     await gps_tracker.connect(courier_id, websocket)
     try:
         while True:
-            data = await websocket.receive_json()
-            await gps_tracker.update_location(
-                courier_id=courier_id,
-                latitude=data["latitude"],
-                longitude=data["longitude"],
-                db=db
-            )
+            try:
+                latitude, longitude = parse_location(await websocket.receive_json())
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning("Malformed location frame from courier %s: %s", courier_id, e)
+                await websocket.close(code=1007)
+                return
+            await gps_tracker.update_location(courier_id=courier_id, latitude=latitude, longitude=longitude)
     except WebSocketDisconnect:
-        gps_tracker.disconnect(courier_id) 
\ No newline at end of file
+        pass
+    finally:
+        gps_tracker.disconnect(courier_id, websocket)
+
+@app.get("/couriers/{courier_id}/track")
+async def get_courier_track(
+    courier_id: int,
+    start: datetime,
+    end: datetime,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Недостаточно прав")
+    
+    def lines():
+        # Синхронный генератор Starlette выполняет в пуле потоков; отдаем трек кусками по 1000 точек
+        db = SessionLocal()
+        try:
+            chunk = []
+            for timestamp, latitude, longitude in iter_track(db, courier_id, start, end):
+                chunk.append(json.dumps({
+                    "timestamp": timestamp.isoformat(),
+                    "latitude": latitude,
+                    "longitude": longitude
+                }))
+                if len(chunk) >= 1000:
+                    yield "\n".join(chunk) + "\n"
+                    chunk = []
+            if chunk:
+                yield "\n".join(chunk) + "\n"
+        finally:
+            db.close()
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+def log_pump_error(task: asyncio.Task):
+    # Исключение задачи-отправителя иначе не будет прочитано и потеряется
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None and not isinstance(error, WebSocketDisconnect):
+        logger.warning("WebSocket sender failed: %r", error)
+
+@app.websocket("/ws/orders/{order_id}/tracking")
+async def websocket_order_tracking(websocket: WebSocket, order_id: int, token: str):
+    try:
+        current_user = await get_current_user(token)
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    # Сессия БД нужна только на проверку доступа и не держится всё время соединения
+    async with AsyncReadSessionLocal() as db:
+        row = (await db.execute(
+            select(Order.courier_id, Customer.email)
+            .join(Customer, Customer.id == Order.customer_id)
+            .where(Order.id == order_id)
+        )).first()
+    if row is None:
+        await websocket.close(code=4404)
+        return
+    if current_user.role != UserRole.ADMIN and row.email != current_user.email:
+        await websocket.close(code=4403)
+        return
+    if row.courier_id is None:
+        await websocket.close(code=4409)
+        return
+    
+    await websocket.accept()
+    watcher = gps_tracker.watch(order_id, row.courier_id)
+    
+    async def pump():
+        while True:
+            frame = await watcher.next_frame()
+            if frame is None:
+                # Заказ доставлен, отменен или снят с курьера — слежение окончено
+                await websocket.close(code=1000)
+                return
+            await websocket.send_text(frame)
+    
+    sender = asyncio.ensure_future(pump())
+    sender.add_done_callback(log_pump_error)
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        gps_tracker.unwatch(watcher)
+
+@app.websocket("/ws/notifications")
+async def websocket_notifications(websocket: WebSocket, token: str):
+    # Браузер не передает заголовки при открытии WebSocket — токен приходит в query
+    try:
+        current_user = await get_current_user(token)
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    await websocket.accept()
+    subscription = notification_hub.subscribe(current_user.id)
+    
+    async def pump():
+        while True:
+            await websocket.send_text(await subscription.get())
+    
+    sender = asyncio.ensure_future(pump())
+    sender.add_done_callback(log_pump_error)
+    try:
+        # Входящие сообщения не нужны, чтение лишь замечает закрытие соединения
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        notification_hub.unsubscribe(subscription)
+
+@app.get("/notifications/stream")
+async def notifications_stream(current_user: User = Depends(get_current_user)):
+    async def events():
+        subscription = notification_hub.subscribe(current_user.id)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        subscription.get(), timeout=settings.NOTIFICATION_PUSH_HEARTBEAT_SECONDS
+                    )
+                    yield f"event: notification\ndata: {message}\n\n"
+                except asyncio.TimeoutError:
+                    # Комментарий-heartbeat не дает прокси закрыть простаивающее соединение
+                    yield ": ping\n\n"
+        finally:
+            notification_hub.unsubscribe(subscription)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    ) 
\ No newline at end of file
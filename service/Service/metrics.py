@@ -0,0 +1,326 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+from redis import Redis
+from redis.client import Pipeline
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio.client import Pipeline as AsyncPipeline
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import get_settings
+
+settings = get_settings()
+
+perf_counter = time.perf_counter
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Метрики без внешних зависимостей в текстовом формате Prometheus.
+# Значения хранятся в словарях по кортежу меток; обновления из потоков пула
+# (синхронные сессии БД, писатель SQLite) защищены одной блокировкой на метрику.
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in list(self._values.items()):
+            yield self.name, _labels(self.labelnames, labels), value
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # Для каждого набора меток: счетчики по корзинам (не накопительные), сумма и количество
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: tuple = ()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", _labels(self.labelnames, labels, f'le="{_number(bound)}"'), cumulative
+            yield f"{self.name}_sum", _labels(self.labelnames, labels), total
+            yield f"{self.name}_count", _labels(self.labelnames, labels), count
+
+class Registry:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._metrics: List = []
+        self._stats: List[Tuple[str, Callable[[], dict]]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(f"{self.prefix}_{name}", documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(f"{self.prefix}_{name}", documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(f"{self.prefix}_{name}", documentation, labelnames, buckets))
+
+    def register_stats(self, component: str, stats: Callable[[], dict]):
+        # Числовые поля stats() компонентов отдаются при сборе: *_total как counter, остальные как gauge
+        self._stats.append((component, stats))
+
+    @staticmethod
+    def _flatten(prefix: str, values: dict):
+        for key, value in values.items():
+            if isinstance(value, dict):
+                yield from Registry._flatten(f"{prefix}_{key}", value)
+            elif isinstance(value, (int, float)):
+                yield f"{prefix}_{key}", int(value) if isinstance(value, bool) else value
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_number(value)}")
+        for component, stats in self._stats:
+            try:
+                values = stats()
+            except Exception as e:
+                lines.append(f"# {component} stats unavailable: {_escape(e)}")
+                continue
+            for name, value in self._flatten(f"{self.prefix}_{component}", values):
+                lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+                lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry("delivery")
+
+http_requests = registry.counter("http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_duration = registry.histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+http_in_flight = registry.gauge("http_requests_in_flight", "HTTP requests being processed", ("method",))
+request_db_queries = registry.histogram(
+    "http_request_db_queries", "DB queries issued per HTTP request", ("route",), COUNT_BUCKETS
+)
+request_db_seconds = registry.histogram(
+    "http_request_db_seconds", "Time spent in DB queries per HTTP request", ("route",)
+)
+db_queries = registry.histogram("db_query_duration_seconds", "DB query latency", ("operation",), FAST_BUCKETS)
+redis_commands = registry.histogram(
+    "redis_command_duration_seconds", "Redis command latency", ("client", "command"), FAST_BUCKETS
+)
+redis_errors = registry.counter("redis_command_errors_total", "Failed Redis commands", ("client", "command"))
+
+# Счетчики текущего запроса: [число запросов к БД, время в БД].
+# Асинхронный движок выполняет запросы в задаче запроса, поэтому контекст виден и в хуках движка.
+_request_db: ContextVar[Optional[list]] = ContextVar("request_db", default=None)
+
+def _operation(context) -> str:
+    if context.compiled is None:
+        return "raw"
+    if context.isinsert:
+        return "insert"
+    if context.isupdate:
+        return "update"
+    if context.isdelete:
+        return "delete"
+    return "select"
+
+# Время старта хранится на контексте выполнения: он живет ровно один запрос к БД
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_started = perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "metrics_started", None)
+    if started is None:
+        return
+    elapsed = perf_counter() - started
+    db_queries.observe(elapsed, (_operation(context),))
+    current = _request_db.get()
+    if current is not None:
+        current[0] += 1
+        current[1] += elapsed
+
+# Слушатели на классе Engine действуют на все движки, включая синхронный движок под асинхронным
+if settings.METRICS_ENABLED:
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+def _command_name(args: tuple) -> str:
+    name = args[0] if args else "UNKNOWN"
+    return (name.decode() if isinstance(name, bytes) else str(name)).upper()
+
+class InstrumentedPipeline(Pipeline):
+    metrics_name = "redis"
+
+    def execute(self, raise_on_error=True):
+        labels = (self.metrics_name, "PIPELINE")
+        started = perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        except Exception:
+            redis_errors.inc(labels)
+            raise
+        finally:
+            redis_commands.observe(perf_counter() - started, labels)
+
+class InstrumentedRedis(Redis):
+    metrics_name = "redis"
+
+    def execute_command(self, *args, **options):
+        labels = (self.metrics_name, _command_name(args))
+        started = perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        except Exception:
+            redis_errors.inc(labels)
+            raise
+        finally:
+            redis_commands.observe(perf_counter() - started, labels)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.metrics_name = self.metrics_name
+        return pipe
+
+class InstrumentedAsyncPipeline(AsyncPipeline):
+    metrics_name = "redis"
+
+    async def execute(self, raise_on_error: bool = True):
+        labels = (self.metrics_name, "PIPELINE")
+        started = perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        except Exception:
+            redis_errors.inc(labels)
+            raise
+        finally:
+            redis_commands.observe(perf_counter() - started, labels)
+
+class InstrumentedAsyncRedis(AsyncRedis):
+    metrics_name = "redis"
+
+    async def execute_command(self, *args, **options):
+        labels = (self.metrics_name, _command_name(args))
+        started = perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        except Exception:
+            redis_errors.inc(labels)
+            raise
+        finally:
+            redis_commands.observe(perf_counter() - started, labels)
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None):
+        pipe = InstrumentedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.metrics_name = self.metrics_name
+        return pipe
+
+def instrumented_redis(url: str, name: str) -> Redis:
+    if not settings.METRICS_ENABLED:
+        return Redis.from_url(url)
+    client = InstrumentedRedis.from_url(url)
+    client.metrics_name = name
+    return client
+
+def instrumented_async_redis(url: str, name: str) -> AsyncRedis:
+    if not settings.METRICS_ENABLED:
+        return AsyncRedis.from_url(url)
+    client = InstrumentedAsyncRedis.from_url(url)
+    client.metrics_name = name
+    return client
+
+# ASGI-middleware без BaseHTTPMiddleware: ответ не оборачивается, меряется только время
+# до завершения отправки. Метка маршрута — шаблон пути ("/orders/{order_id}"), а не сам путь.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._templates: Optional[Dict[Callable, str]] = None
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self._templates is None:
+            self._templates = {
+                route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")
+            }
+        return self._templates.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        db_usage = [0, 0.0]
+        token = _request_db.set(db_usage)
+        http_in_flight.inc((method,))
+        started = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = perf_counter() - started
+            http_in_flight.dec((method,))
+            _request_db.reset(token)
+            route = self._route(scope)
+            http_requests.inc((method, route, status[0]))
+            http_duration.observe(elapsed, (method, route))
+            request_db_queries.observe(db_usage[0], (route,))
+            request_db_seconds.observe(db_usage[1], (route,))
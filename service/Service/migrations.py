@@ -0,0 +1,80 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from models import Base
+from logger import logger
+
+# create_all создает только недостающие таблицы. Колонки, индексы и уникальные ограничения,
+# добавленные к уже существующим таблицам, доводятся здесь; каждый шаг идемпотентен.
+ADDED_COLUMNS = (
+    ("users", "unread_notifications", "INTEGER NOT NULL DEFAULT 0"),
+    ("orders", "delivery_latitude", "FLOAT"),
+    ("orders", "delivery_longitude", "FLOAT"),
+    ("orders", "version", "INTEGER NOT NULL DEFAULT 1"),
+)
+
+# Уникальные ограничения на существующих таблицах создаются уникальным индексом: SQLite не умеет ADD CONSTRAINT
+ADDED_UNIQUE = (
+    ("promocode_uses", "uq_promocode_use_order", ("order_id",)),
+    ("reviews", "uq_review_order", ("order_id",)),
+)
+
+BACKFILL_UNREAD = text("""
+UPDATE users SET unread_notifications = (
+    SELECT COUNT(*) FROM notifications
+    WHERE notifications.user_id = users.id AND notifications.is_read = :is_read
+)
+""")
+
+def _add_columns(engine: Engine) -> set:
+    added = set()
+    inspector = inspect(engine)
+    for table, column, ddl in ADDED_COLUMNS:
+        if column in {existing["name"] for existing in inspector.get_columns(table)}:
+            continue
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        logger.info("Migration: added column %s.%s", table, column)
+        added.add((table, column))
+    return added
+
+def _sync_indexes(engine: Engine):
+    # Недостающие индексы создаются, индексы с тем же именем, но другим набором колонок — пересоздаются
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"]: index["column_names"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            columns = [column.name for column in index.columns]
+            if existing.get(index.name) == columns:
+                continue
+            with engine.begin() as conn:
+                if index.name in existing:
+                    index.drop(conn)
+                index.create(conn)
+            logger.info("Migration: created index %s on %s", index.name, table.name)
+
+def _add_unique(engine: Engine):
+    inspector = inspect(engine)
+    for table, name, columns in ADDED_UNIQUE:
+        existing = {index["name"] for index in inspector.get_indexes(table)}
+        existing |= {constraint["name"] for constraint in inspector.get_unique_constraints(table)}
+        if name in existing:
+            continue
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"CREATE UNIQUE INDEX {name} ON {table} ({', '.join(columns)})"))
+        except IntegrityError as e:
+            # Дубликаты в данных нужно разобрать вручную; до этого ограничение не действует
+            logger.error("Migration: cannot create %s on %s, duplicate rows: %s", name, table, e)
+            continue
+        logger.info("Migration: created unique index %s on %s", name, table)
+
+def migrate(engine: Engine):
+    added = _add_columns(engine)
+    if ("users", "unread_notifications") in added:
+        # Счетчик непрочитанных ведется в транзакциях уведомлений; для старых пользователей считаем его один раз
+        with engine.begin() as conn:
+            conn.execute(BACKFILL_UNREAD, {"is_read": False})
+        logger.info("Migration: backfilled users.unread_notifications")
+    _sync_indexes(engine)
+    _add_unique(engine)
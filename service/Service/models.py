@@ -1,9 +1,10 @@
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Index
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Date, ForeignKey, Index, Boolean, LargeBinary, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from enum import Enum
 from werkzeug.security import generate_password_hash, check_password_hash
+from password_hasher import password_hasher
 
 Base = declarative_base()
 
@@ -16,6 +17,7 @@ class Customer(Base):
     phone = Column(String(20), nullable=False)
     email = Column(String(100), unique=True)
     orders = relationship("Order", back_populates="customer")
+    reviews = relationship("Review", back_populates="customer")
 
 class UserRole(str, Enum):
     CUSTOMER = "customer"
@@ -38,12 +40,23 @@ class User(Base):
     email = Column(String(100), unique=True, nullable=False)
     password_hash = Column(String(200), nullable=False)
     role = Column(String(20), nullable=False, default=UserRole.CUSTOMER)
+    unread_notifications = Column(Integer, nullable=False, default=0)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, password_hasher.method)
     
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
+    
+    async def set_password_async(self, password):
+        self.password_hash = await password_hasher.hash(password)
+    
+    async def verify_password(self, password):
+        # При устаревших параметрах хэш заменяется; сохранить его должен вызывающий
+        valid, new_hash = await password_hasher.verify(self.password_hash, password)
+        if new_hash is not None:
+            self.password_hash = new_hash
+        return valid
 
 class Courier(Base):
     __tablename__ = 'couriers'
@@ -57,6 +70,8 @@ class Courier(Base):
     
     user = relationship("User")
     deliveries = relationship("Order", back_populates="courier")
+    reviews = relationship("Review", back_populates="courier")
+    locations = relationship("CourierLocation", back_populates="courier")
 
 class Order(Base):
     __tablename__ = 'orders'
@@ -67,21 +82,57 @@ class Order(Base):
     status = Column(String(50), default=OrderStatus.NEW)
     created_at = Column(DateTime, default=datetime.utcnow)
     delivery_address = Column(String(200), nullable=False)
+    delivery_latitude = Column(Float, nullable=True)
+    delivery_longitude = Column(Float, nullable=True)
     total_price = Column(Float, nullable=False)
     payment_status = Column(String(50), default='pending')
     payment_id = Column(String(100), nullable=True)
     estimated_delivery_time = Column(DateTime, nullable=True)
     actual_delivery_time = Column(DateTime, nullable=True)
+    # Версия строки для оптимистичной блокировки: переходы статуса увеличивают ее условным UPDATE,
+    # ORM — при каждом flush заказа с проверкой ожидаемого значения
+    version = Column(Integer, nullable=False, default=1, server_default="1")
     
     customer = relationship("Customer", back_populates="orders")
     courier = relationship("Courier", back_populates="deliveries")
     items = relationship("OrderItem", back_populates="order")
     tracking_updates = relationship("TrackingUpdate", back_populates="order")
+    reviews = relationship("Review", back_populates="order")
     
     __table_args__ = (
         Index('idx_customer_id', 'customer_id'),
         Index('idx_courier_id', 'courier_id'),
         Index('idx_status', 'status'),
+        Index('idx_orders_created_at', 'created_at'),
+        Index('idx_orders_delivered_at', 'actual_delivery_time'),
+    )
+    __mapper_args__ = {"version_id_col": version}
+
+class PaymentAttemptStatus(str, Enum):
+    PROCESSING = "processing"
+    PENDING = "pending"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    ERROR = "error"
+
+class PaymentAttempt(Base):
+    __tablename__ = 'payment_attempts'
+    
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey('orders.id'), nullable=False)
+    idempotency_key = Column(String(100), nullable=False)
+    status = Column(String(20), nullable=False, default=PaymentAttemptStatus.PROCESSING)
+    amount = Column(Float, nullable=False)
+    currency = Column(String(3), nullable=False)
+    provider_payment_id = Column(String(100))
+    error = Column(String(500))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('order_id', 'idempotency_key', name='uq_payment_attempt_key'),
+        Index('idx_payment_attempts_status', 'status', 'updated_at'),
+        Index('idx_payment_attempts_provider_id', 'provider_payment_id'),
     )
 
 class OrderItem(Base):
@@ -93,7 +144,11 @@ class OrderItem(Base):
     quantity = Column(Integer, nullable=False)
     price = Column(Float, nullable=False)
     
-    order = relationship("Order", back_populates="items") 
+    order = relationship("Order", back_populates="items")
+    
+    __table_args__ = (
+        Index('idx_order_items_order_id', 'order_id'),
+    )
 
 class TrackingUpdate(Base):
     __tablename__ = 'tracking_updates'
@@ -106,6 +161,10 @@ class TrackingUpdate(Base):
     comment = Column(String(500))
     
     order = relationship("Order", back_populates="tracking_updates")
+    
+    __table_args__ = (
+        Index('idx_tracking_updates_timestamp', 'timestamp'),
+    )
 
 class Notification(Base):
     __tablename__ = 'notifications'
@@ -119,9 +178,39 @@ class Notification(Base):
     is_read = Column(Boolean, default=False) 
     
     __table_args__ = (
-        Index('idx_user_notifications', 'user_id', 'created_at'),
+        Index('idx_user_notifications', 'user_id', 'created_at', 'id'),
     ) 
 
+class OutboxStatus(str, Enum):
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    DEAD = "dead"
+
+class NotificationOutbox(Base):
+    __tablename__ = 'notification_outbox'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=True)
+    order_id = Column(Integer, ForeignKey('orders.id'), nullable=True)
+    type = Column(String(50), nullable=False)
+    channel = Column(String(10), nullable=False)
+    recipient = Column(String(200), nullable=False)
+    subject = Column(String(200))
+    body = Column(String(500), nullable=False)
+    status = Column(String(20), nullable=False, default=OutboxStatus.PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    claimed_by = Column(String(32))
+    locked_until = Column(DateTime)
+    last_error = Column(String(500))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+    
+    __table_args__ = (
+        Index('idx_outbox_due', 'status', 'next_attempt_at'),
+    )
+
 class Review(Base):
     __tablename__ = 'reviews'
     
@@ -136,6 +225,30 @@ class Review(Base):
     order = relationship("Order", back_populates="reviews")
     customer = relationship("Customer", back_populates="reviews")
     courier = relationship("Courier", back_populates="reviews")
+    
+    __table_args__ = (
+        Index('idx_reviews_created_at', 'created_at'),
+        # Один отзыв на заказ
+        UniqueConstraint('order_id', name='uq_review_order'),
+    )
+
+# Агрегаты оценок курьера: итог и дневные корзины для скользящего окна
+class CourierRating(Base):
+    __tablename__ = 'courier_ratings'
+    
+    courier_id = Column(Integer, ForeignKey('couriers.id'), primary_key=True)
+    review_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class CourierRatingDay(Base):
+    __tablename__ = 'courier_rating_days'
+    
+    courier_id = Column(Integer, ForeignKey('couriers.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    review_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
 
 class CourierLocation(Base):
     __tablename__ = 'courier_locations'
@@ -147,6 +260,26 @@ class CourierLocation(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
     
     courier = relationship("Courier", back_populates="locations")
+    
+    __table_args__ = (
+        Index('idx_courier_locations_courier_time', 'courier_id', 'timestamp'),
+    )
+
+class CourierTrackSegment(Base):
+    __tablename__ = 'courier_track_segments'
+    
+    id = Column(Integer, primary_key=True)
+    courier_id = Column(Integer, ForeignKey('couriers.id'), nullable=False)
+    day = Column(Date, nullable=False)
+    start_time = Column(DateTime, nullable=False)
+    end_time = Column(DateTime, nullable=False)
+    point_count = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    
+    __table_args__ = (
+        UniqueConstraint('courier_id', 'day', name='uq_track_segment_courier_day'),
+        Index('idx_track_segments_courier_time', 'courier_id', 'start_time'),
+    )
 
 class Promocode(Base):
     __tablename__ = 'promocodes'
@@ -167,4 +300,9 @@ class PromoCodeUse(Base):
     id = Column(Integer, primary_key=True)
     promocode_id = Column(Integer, ForeignKey('promocodes.id'))
     order_id = Column(Integer, ForeignKey('orders.id'))
-    used_at = Column(DateTime, default=datetime.utcnow) 
\ No newline at end of file
+    used_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Один промокод на заказ: скидки не складываются
+        UniqueConstraint('order_id', name='uq_promocode_use_order'),
+    ) 
\ No newline at end of file
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from redis.asyncio import Redis as AsyncRedis
+from cache import async_redis_client
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+PUSH_CHANNEL = "notifications:push"
+
+def notification_event(notification_type: str, message: str, order_id: Optional[int] = None,
+                       notification_id: Optional[int] = None,
+                       created_at: Optional[datetime] = None) -> dict:
+    return {
+        "id": notification_id,
+        "type": notification_type,
+        "order_id": order_id,
+        "message": message,
+        "created_at": (created_at or datetime.utcnow()).isoformat(),
+        "is_read": False,
+    }
+
+# Очередь одного соединения: при переполнении отбрасываются самые старые события,
+# медленный клиент не копит память и не тормозит рассылку остальным.
+# Вместо asyncio.Queue — deque и одно ожидающее future: простаивающее соединение почти ничего не стоит.
+class Subscription:
+    __slots__ = ("user_id", "messages", "dropped", "_waiter")
+
+    def __init__(self, user_id: int, maxsize: int):
+        self.user_id = user_id
+        self.messages: deque = deque(maxlen=maxsize)
+        self.dropped = 0
+        self._waiter: Optional[asyncio.Future] = None
+
+    def push(self, message: str) -> bool:
+        dropped = len(self.messages) == self.messages.maxlen
+        if dropped:
+            self.dropped += 1
+        self.messages.append(message)
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+        return dropped
+
+    async def get(self) -> str:
+        while not self.messages:
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self.messages.popleft()
+
+# Рассылка уведомлений по открытым соединениям процесса: user_id -> множество подписок.
+# Событие сериализуется один раз и раскладывается по очередям соединений пользователя.
+# Через Redis pub/sub события доходят до соединений, открытых в других воркерах.
+class NotificationHub:
+    def __init__(self, redis: AsyncRedis, queue_size: int, bridge_enabled: bool):
+        self.redis = redis
+        self.queue_size = queue_size
+        self.bridge_enabled = bridge_enabled
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        self._origin = uuid.uuid4().hex
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._listener: Optional[asyncio.Task] = None
+
+        self.connections = 0
+        self.published_total = 0
+        self.delivered_total = 0
+        self.dropped_total = 0
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(user_id, self.queue_size)
+        self._subscribers.setdefault(user_id, set()).add(subscription)
+        self.connections += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscribers.get(subscription.user_id)
+        if not subscriptions or subscription not in subscriptions:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscribers[subscription.user_id]
+        self.connections -= 1
+
+    def _fan_out(self, user_id: int, message: str):
+        for subscription in self._subscribers.get(user_id, ()):
+            if subscription.push(message):
+                self.dropped_total += 1
+            self.delivered_total += 1
+
+    async def publish_many(self, events: Iterable[Tuple[int, dict]]):
+        bridged = []
+        for user_id, event in events:
+            if user_id is None:
+                continue
+            message = json.dumps(event, default=str)
+            self.published_total += 1
+            self._fan_out(user_id, message)
+            if self.bridge_enabled:
+                bridged.append(json.dumps({"o": self._origin, "u": user_id, "m": message}))
+        if not bridged:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for payload in bridged:
+                pipe.publish(PUSH_CHANNEL, payload)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("Notification push bridge publish failed: %s", e)
+
+    async def publish(self, user_id: int, event: dict):
+        await self.publish_many([(user_id, event)])
+
+    def publish_threadsafe(self, events: List[Tuple[int, dict]]):
+        # Для фоновых потоков: событие уходит в event loop хаба.
+        # Ссылка на loop берется один раз — stop() может обнулить self._loop в любой момент
+        loop = self._loop
+        if loop is None or not events:
+            return
+        try:
+            loop.call_soon_threadsafe(lambda: loop.create_task(self.publish_many(events)))
+        except RuntimeError:
+            # Loop уже закрыт: хаб остановлен, доставлять событие некому
+            logger.warning("Notification hub is stopped, dropped %d push events", len(events))
+
+    async def _listen(self):
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(PUSH_CHANNEL)
+        try:
+            while True:
+                try:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                except Exception as e:
+                    logger.warning("Notification push listener error: %s", e)
+                    await asyncio.sleep(1.0)
+                    continue
+                if not message or message["type"] != "message":
+                    continue
+                envelope = json.loads(message["data"])
+                # Собственные события уже доставлены локально
+                if envelope["o"] != self._origin:
+                    self._fan_out(envelope["u"], envelope["m"])
+        finally:
+            await pubsub.close()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        if self.bridge_enabled and self._listener is None:
+            self._listener = self._loop.create_task(self._listen())
+
+    async def stop(self):
+        self._loop = None
+        if self._listener is None:
+            return
+        self._listener.cancel()
+        try:
+            await self._listener
+        except asyncio.CancelledError:
+            pass
+        self._listener = None
+
+    def stats(self) -> dict:
+        return {
+            "connections": self.connections,
+            "users": len(self._subscribers),
+            "published_total": self.published_total,
+            "delivered_total": self.delivered_total,
+            "dropped_total": self.dropped_total,
+        }
+
+notification_hub = NotificationHub(
+    redis=async_redis_client,
+    queue_size=settings.NOTIFICATION_PUSH_QUEUE_SIZE,
+    bridge_enabled=settings.NOTIFICATION_PUSH_REDIS_BRIDGE
+)
@@ -0,0 +1,255 @@
+import asyncio
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+from sqlalchemy import and_, bindparam, or_, select, update
+from sqlalchemy.orm import Session
+from models import NotificationOutbox, OutboxStatus
+from sqlite_writer import run_background_write
+import email_service
+import sms_service
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+NOTIFICATION_SUBJECTS = {
+    "new_assignment": "Новый заказ",
+    "order_status": "Статус заказа",
+}
+
+def outbox_rows(notification_type: str, message: str, user_id: Optional[int] = None,
+                order_id: Optional[int] = None, email: Optional[str] = None,
+                phone: Optional[str] = None) -> List[dict]:
+    # Строки outbox вставляются в той же транзакции, что и само уведомление
+    now = datetime.utcnow()
+    base = {
+        "user_id": user_id,
+        "order_id": order_id,
+        "type": notification_type,
+        "subject": NOTIFICATION_SUBJECTS.get(notification_type, "Уведомление"),
+        "body": message,
+        "status": OutboxStatus.PENDING.value,
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now,
+    }
+    rows = []
+    if email:
+        rows.append(dict(base, channel="email", recipient=email))
+    if phone:
+        rows.append(dict(base, channel="sms", recipient=phone))
+    return rows
+
+def add_to_outbox(session: Session, rows: List[dict]):
+    if rows:
+        session.execute(NotificationOutbox.__table__.insert(), rows)
+
+def _send_email(recipient: str, subject: str, body: str):
+    email_service.smtp_pool.send(email_service.build_message(recipient, subject, body))
+
+def _send_sms(recipient: str, subject: str, body: str):
+    sms_service.sms_provider.send(recipient, body)
+
+def _is_permanent(error: Exception) -> bool:
+    return email_service.is_permanent_error(error) or sms_service.is_permanent_error(error)
+
+# Доставка из outbox фоновыми воркерами.
+# Пачка строк забирается в аренду (claimed_by + locked_until), поэтому несколько процессов
+# не отправят одно письмо дважды, а строки упавшего процесса вернутся в работу после истечения аренды.
+# Отправка идет параллельно с ограничением concurrency; ошибки повторяются с экспоненциальной
+# задержкой, после max_attempts или при постоянной ошибке строка уходит в dead-letter.
+class OutboxDispatcher:
+    def __init__(self, senders: dict, batch_size: int, concurrency: int, poll_interval: float,
+                 lease_seconds: int, max_attempts: int, backoff_base: float, backoff_max: float,
+                 is_permanent: Callable[[Exception], bool] = _is_permanent):
+        self.senders = senders
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.is_permanent = is_permanent
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+        self.sent_total = 0
+        self.retried_total = 0
+        self.dead_total = 0
+        self.last_batch_size = 0
+        self.last_batch_seconds = 0.0
+
+    def _due(self, table, now: datetime):
+        return or_(
+            and_(table.c.status == OutboxStatus.PENDING.value, table.c.next_attempt_at <= now),
+            and_(table.c.status == OutboxStatus.SENDING.value, table.c.locked_until < now)
+        )
+
+    def claim(self, db: Session) -> Tuple[str, list]:
+        table = NotificationOutbox.__table__
+        now = datetime.utcnow()
+        ids = db.execute(
+            select(table.c.id).where(self._due(table, now))
+            .order_by(table.c.next_attempt_at).limit(self.batch_size)
+        ).scalars().all()
+        if not ids:
+            return "", []
+
+        token = uuid.uuid4().hex
+        # Условие повторяется в UPDATE: строки, перехваченные другим воркером, не попадут в пачку
+        db.execute(
+            update(table)
+            .where(table.c.id.in_(ids), self._due(table, now))
+            .values(
+                status=OutboxStatus.SENDING.value,
+                claimed_by=token,
+                locked_until=now + timedelta(seconds=self.lease_seconds),
+                attempts=table.c.attempts + 1
+            )
+        )
+        rows = db.execute(
+            select(table.c.id, table.c.channel, table.c.recipient, table.c.subject,
+                   table.c.body, table.c.attempts)
+            .where(table.c.id.in_(ids), table.c.claimed_by == token)
+        ).all()
+        return token, rows
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def complete(self, db: Session, token: str, results: list):
+        table = NotificationOutbox.__table__
+        now = datetime.utcnow()
+        sent, failed = [], []
+        for row, error in results:
+            if error is None:
+                sent.append({"row_id": row.id})
+                continue
+            dead = row.attempts >= self.max_attempts or self.is_permanent(error)
+            failed.append({
+                "row_id": row.id,
+                "new_status": OutboxStatus.DEAD.value if dead else OutboxStatus.PENDING.value,
+                "next_at": now + timedelta(seconds=0 if dead else self._backoff(row.attempts)),
+                "error": str(error)[:500],
+            })
+            if dead:
+                self.dead_total += 1
+                logger.error("Notification %s (%s) moved to dead letter after %d attempts: %s", row.id, row.channel, row.attempts, error)
+            else:
+                self.retried_total += 1
+
+        # Строка, аренду которой успел перехватить другой воркер, не перезаписывается
+        claimed = and_(table.c.id == bindparam("row_id"), table.c.claimed_by == token)
+        if sent:
+            db.execute(
+                update(table).where(claimed)
+                .values(status=OutboxStatus.SENT.value, sent_at=now, claimed_by=None,
+                        locked_until=None, last_error=None),
+                sent
+            )
+        if failed:
+            db.execute(
+                update(table).where(claimed)
+                .values(status=bindparam("new_status"), next_attempt_at=bindparam("next_at"),
+                        last_error=bindparam("error"), claimed_by=None, locked_until=None),
+                failed
+            )
+        self.sent_total += len(sent)
+
+    async def _deliver(self, semaphore: asyncio.Semaphore, row):
+        sender = self.senders.get(row.channel)
+        if sender is None:
+            return row, ValueError(f"Unknown channel {row.channel}")
+        async with semaphore:
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    self._executor, sender, row.recipient, row.subject, row.body
+                )
+                return row, None
+            except Exception as e:
+                return row, e
+
+    async def run_once(self) -> int:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="outbox")
+        # Захват и отметка результатов фиксируются run_background_write, доставка идет вне транзакции
+        token, rows = await run_background_write(self.claim)
+        if not rows:
+            return 0
+
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._deliver(semaphore, row) for row in rows))
+        await run_background_write(lambda session: self.complete(session, token, results))
+        self.last_batch_size = len(rows)
+        self.last_batch_seconds = time.perf_counter() - started
+        return len(rows)
+
+    def wake(self):
+        # Вызывается после коммита новых уведомлений, чтобы не ждать следующего опроса
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                processed = await self.run_once()
+            except Exception as e:
+                logger.error("Outbox delivery run failed: %s", e)
+                processed = 0
+            # Полная пачка — сразу берем следующую
+            if processed >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._wakeup = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        email_service.smtp_pool.close()
+
+    def stats(self) -> dict:
+        return {
+            "sent_total": self.sent_total,
+            "retried_total": self.retried_total,
+            "dead_total": self.dead_total,
+            "last_batch_size": self.last_batch_size,
+            "last_batch_seconds": self.last_batch_seconds,
+            "smtp": email_service.smtp_pool.stats(),
+        }
+
+notification_outbox = OutboxDispatcher(
+    senders={"email": _send_email, "sms": _send_sms},
+    batch_size=settings.OUTBOX_BATCH_SIZE,
+    concurrency=settings.OUTBOX_CONCURRENCY,
+    poll_interval=settings.OUTBOX_POLL_INTERVAL_SECONDS,
+    lease_seconds=settings.OUTBOX_LEASE_SECONDS,
+    max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+    backoff_base=settings.OUTBOX_BACKOFF_BASE_SECONDS,
+    backoff_max=settings.OUTBOX_BACKOFF_MAX_SECONDS
+)
@@ -0,0 +1,158 @@
+import base64
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import and_, bindparam, or_, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Notification, User
+from cache import redis_client, async_redis_client, cache_key
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+# Счетчик непрочитанных хранится в users.unread_notifications и меняется в тех же транзакциях,
+# что создают или читают уведомления. Redis держит его копию, промах читает одну строку users по первичному ключу.
+# После коммита изменения копия удаляется, а версия счетчика увеличивается. Прогрев записывает
+# прочитанное из БД значение, только если версия не изменилась с момента промаха: иначе оно могло
+# быть прочитано до коммита. Инкремент копии здесь не годится — прогрев, прочитавший БД уже после
+# коммита, но до инкремента, учел бы изменение дважды.
+_FILL_SCRIPT = async_redis_client.register_script("""
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+if redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3], 'NX') then
+    return 1
+end
+return 0
+""")
+
+def _unread_key(user_id: int) -> str:
+    return cache_key("notifications", "unread", user_id)
+
+def _unread_version_key(user_id: int) -> str:
+    return cache_key("notifications", "unread", user_id, "ver")
+
+def encode_cursor(created_at: datetime, notification_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{notification_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    created_at, notification_id = raw.split("|", 1)
+    return datetime.fromisoformat(created_at), int(notification_id)
+
+class NotificationService:
+    @staticmethod
+    async def get_page(db: AsyncSession, user_id: int, cursor: Optional[str], limit: int) -> dict:
+        # Keyset-пагинация по (created_at, id): каждая страница — диапазон по индексу idx_user_notifications
+        query = (
+            select(
+                Notification.id, Notification.order_id, Notification.type,
+                Notification.message, Notification.created_at, Notification.is_read
+            )
+            .where(Notification.user_id == user_id)
+            .order_by(Notification.created_at.desc(), Notification.id.desc())
+            .limit(limit + 1)
+        )
+        if cursor:
+            created_at, notification_id = decode_cursor(cursor)
+            query = query.where(or_(
+                Notification.created_at < created_at,
+                and_(Notification.created_at == created_at, Notification.id < notification_id)
+            ))
+        rows = (await db.execute(query)).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+        return {"items": [dict(row._mapping) for row in rows], "next_cursor": next_cursor}
+
+    @staticmethod
+    def count_created(session: Session, user_ids: Iterable[Optional[int]]) -> Dict[int, int]:
+        # Вызывается в транзакции, создающей уведомления; возвращает приращения для adjust_cached
+        counts = Counter(user_id for user_id in user_ids if user_id is not None)
+        if counts:
+            session.execute(
+                update(User.__table__)
+                .where(User.__table__.c.id == bindparam("user_id"))
+                .values(unread_notifications=User.__table__.c.unread_notifications + bindparam("delta")),
+                [{"user_id": user_id, "delta": delta} for user_id, delta in counts.items()]
+            )
+        return dict(counts)
+
+    @staticmethod
+    def mark_read(session: Session, user_id: int, notification_ids: Optional[List[int]] = None) -> int:
+        # Один UPDATE по уведомлениям; rowcount — ровно столько, сколько стало прочитанными
+        query = update(Notification.__table__).where(
+            Notification.__table__.c.user_id == user_id,
+            Notification.__table__.c.is_read == False
+        )
+        if notification_ids is not None:
+            query = query.where(Notification.__table__.c.id.in_(notification_ids))
+        updated = session.execute(query.values(is_read=True)).rowcount
+        if updated:
+            session.execute(
+                update(User.__table__)
+                .where(User.__table__.c.id == user_id)
+                .values(unread_notifications=User.__table__.c.unread_notifications - updated)
+            )
+        return updated
+
+    @staticmethod
+    async def get_unread_count(db: AsyncSession, user_id: int) -> int:
+        try:
+            cached, version = await async_redis_client.mget(_unread_key(user_id), _unread_version_key(user_id))
+            if cached is not None:
+                return max(int(cached), 0)
+        except Exception as e:
+            logger.warning("Unread counter read failed for user %s: %s", user_id, e)
+            return max((await db.execute(
+                select(User.unread_notifications).where(User.id == user_id)
+            )).scalar() or 0, 0)
+
+        count = max((await db.execute(
+            select(User.unread_notifications).where(User.id == user_id)
+        )).scalar() or 0, 0)
+        try:
+            # Если счетчик изменился, пока читали БД, не прогреваем: следующий промах прочитает свежее значение.
+            # NX: не затираем значение, которое уже прогрел другой запрос
+            await _FILL_SCRIPT(
+                keys=[_unread_key(user_id), _unread_version_key(user_id)],
+                args=[version.decode() if version else "0", count, settings.NOTIFICATION_UNREAD_CACHE_TTL_SECONDS]
+            )
+        except Exception as e:
+            logger.warning("Unread counter write failed for user %s: %s", user_id, e)
+        return count
+
+    @staticmethod
+    def _queue_invalidation(pipe, deltas: Dict[int, int]) -> bool:
+        queued = False
+        for user_id, delta in deltas.items():
+            if delta:
+                pipe.incr(_unread_version_key(user_id))
+                pipe.expire(_unread_version_key(user_id), settings.NOTIFICATION_UNREAD_CACHE_TTL_SECONDS)
+                pipe.delete(_unread_key(user_id))
+                queued = True
+        return queued
+
+    @staticmethod
+    def adjust_cached(deltas: Dict[int, int]):
+        # Синхронный вариант для фоновых потоков; вызывать после коммита
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            if NotificationService._queue_invalidation(pipe, deltas):
+                pipe.execute()
+        except Exception as e:
+            logger.error("Unread counter update failed: %s", e)
+
+    @staticmethod
+    async def adjust_cached_async(deltas: Dict[int, int]):
+        try:
+            pipe = async_redis_client.pipeline(transaction=False)
+            if NotificationService._queue_invalidation(pipe, deltas):
+                await pipe.execute()
+        except Exception as e:
+            logger.error("Unread counter update failed: %s", e)
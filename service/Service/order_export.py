@@ -0,0 +1,115 @@
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime
+from typing import Iterator
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import Order, OrderItem, TrackingUpdate, Review
+from config import get_settings
+
+settings = get_settings()
+
+def _orders(start: datetime, end: datetime):
+    table = Order.__table__
+    return (
+        select(
+            table.c.id, table.c.customer_id, table.c.courier_id, table.c.status, table.c.created_at,
+            table.c.delivery_address, table.c.delivery_latitude, table.c.delivery_longitude,
+            table.c.total_price, table.c.payment_status, table.c.payment_id,
+            table.c.estimated_delivery_time, table.c.actual_delivery_time
+        )
+        .where(table.c.created_at >= start, table.c.created_at < end)
+        .order_by(table.c.created_at, table.c.id)
+    )
+
+def _items(start: datetime, end: datetime):
+    # Позиции выгружаются за заказы, созданные в периоде, в порядке заказов
+    items, orders = OrderItem.__table__, Order.__table__
+    return (
+        select(items.c.id, items.c.order_id, items.c.product_name, items.c.quantity, items.c.price)
+        .select_from(items.join(orders, orders.c.id == items.c.order_id))
+        .where(orders.c.created_at >= start, orders.c.created_at < end)
+        .order_by(orders.c.created_at, orders.c.id, items.c.id)
+    )
+
+def _tracking(start: datetime, end: datetime):
+    table = TrackingUpdate.__table__
+    return (
+        select(table.c.id, table.c.order_id, table.c.status, table.c.location, table.c.timestamp, table.c.comment)
+        .where(table.c.timestamp >= start, table.c.timestamp < end)
+        .order_by(table.c.timestamp, table.c.id)
+    )
+
+def _reviews(start: datetime, end: datetime):
+    table = Review.__table__
+    return (
+        select(table.c.id, table.c.order_id, table.c.customer_id, table.c.courier_id,
+               table.c.rating, table.c.comment, table.c.created_at)
+        .where(table.c.created_at >= start, table.c.created_at < end)
+        .order_by(table.c.created_at, table.c.id)
+    )
+
+# Сортировка идет по индексу отметки времени (id — хвост индекса), поэтому БД
+# не строит временное дерево сортировки размером с выгрузку
+DATASETS = {
+    "orders": _orders,
+    "items": _items,
+    "tracking": _tracking,
+    "reviews": _reviews,
+}
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+def _plain(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def _ndjson(columns, rows) -> str:
+    return "".join(
+        json.dumps(dict(zip(columns, map(_plain, row))), ensure_ascii=False) + "\n" for row in rows
+    )
+
+def _csv(columns, rows, with_header: bool) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if with_header:
+        writer.writerow(columns)
+    writer.writerows([_plain(value) for value in row] for row in rows)
+    return buffer.getvalue()
+
+def iter_export(db: Session, dataset: str, start: datetime, end: datetime, fmt: str,
+                chunk_size: int) -> Iterator[str]:
+    # Серверный курсор (stream_results) и пачки yield_per: в памяти не больше одной пачки строк
+    result = db.execute(
+        DATASETS[dataset](start, end).execution_options(stream_results=True)
+    ).yield_per(chunk_size)
+    columns = list(result.keys())
+    if fmt == "csv":
+        yield _csv(columns, (), with_header=True)
+    for rows in result.partitions():
+        yield _ndjson(columns, rows) if fmt == "ndjson" else _csv(columns, rows, with_header=False)
+
+def export_stream(dataset: str, start: datetime, end: datetime, fmt: str, compress: bool) -> Iterator[bytes]:
+    # Синхронный генератор Starlette выполняет в пуле потоков; сессия живет до конца выгрузки
+    db = SessionLocal()
+    try:
+        compressor = zlib.compressobj(settings.EXPORT_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+        for chunk in iter_export(db, dataset, start, end, fmt, settings.EXPORT_CHUNK_SIZE):
+            data = chunk.encode()
+            if compressor is None:
+                yield data
+                continue
+            data = compressor.compress(data)
+            if data:
+                yield data
+        if compressor is not None:
+            yield compressor.flush()
+    finally:
+        db.close()
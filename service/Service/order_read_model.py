@@ -0,0 +1,148 @@
+from datetime import datetime
+from typing import Iterable, Optional
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Order
+from cache import redis_client, async_redis_client, cache, cache_key
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+# Ключи версионированы: view лежит под order:{id}:v{n}, текущая версия — в order:{id}:ver.
+# Любая мутация заказа после коммита увеличивает версию, и старый view становится недостижим.
+# Скрипт читает версию и view за один сетевой запрос.
+_READ_VIEW_SCRIPT = async_redis_client.register_script("""
+local version = redis.call('GET', KEYS[1]) or '0'
+return {version, redis.call('GET', KEYS[2] .. version)}
+""")
+
+def _version_key(order_id: int) -> str:
+    return cache_key("order", order_id, "ver")
+
+def _view_prefix(order_id: int) -> str:
+    return cache_key("order", order_id, "v")
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+def serialize_order(order: Order) -> dict:
+    return {
+        "id": order.id,
+        "status": order.status,
+        "created_at": _iso(order.created_at),
+        "delivery_address": order.delivery_address,
+        "delivery_latitude": order.delivery_latitude,
+        "delivery_longitude": order.delivery_longitude,
+        "total_price": order.total_price,
+        "payment_status": order.payment_status,
+        "payment_id": order.payment_id,
+        "estimated_delivery_time": _iso(order.estimated_delivery_time),
+        "actual_delivery_time": _iso(order.actual_delivery_time),
+        "version": order.version,
+        "customer": {
+            "id": order.customer.id,
+            "name": order.customer.name,
+            "address": order.customer.address,
+            "phone": order.customer.phone,
+        } if order.customer else None,
+        "courier": {
+            "id": order.courier.id,
+            "name": order.courier.name,
+            "phone": order.courier.phone,
+        } if order.courier else None,
+        "items": [
+            {
+                "id": item.id,
+                "product_name": item.product_name,
+                "quantity": item.quantity,
+                "price": item.price,
+            }
+            for item in order.items
+        ],
+        "tracking_updates": [
+            {
+                "id": update.id,
+                "status": update.status,
+                "location": update.location,
+                "timestamp": _iso(update.timestamp),
+                "comment": update.comment,
+            }
+            for update in sorted(order.tracking_updates, key=lambda update: update.timestamp or datetime.min)
+        ],
+    }
+
+async def load_order_view(db: AsyncSession, order_id: int) -> Optional[dict]:
+    # Один запрос на заказ с клиентом и курьером (JOIN) и по одному на коллекции (IN)
+    result = await db.execute(
+        select(Order)
+        .options(
+            joinedload(Order.customer),
+            joinedload(Order.courier),
+            selectinload(Order.items),
+            selectinload(Order.tracking_updates)
+        )
+        .where(Order.id == order_id)
+    )
+    order = result.scalars().first()
+    return serialize_order(order) if order else None
+
+async def get_order_view(db: AsyncSession, order_id: int) -> Optional[dict]:
+    try:
+        version, cached = await _READ_VIEW_SCRIPT(keys=[_version_key(order_id), _view_prefix(order_id)])
+    except Exception as e:
+        logger.warning("Order cache read failed for %s: %s", order_id, e)
+        return await load_order_view(db, order_id)
+    if cached:
+        return cache.serializer.loads(cached)
+
+    view = await load_order_view(db, order_id)
+    if view is not None:
+        # Если заказ успели изменить, версия уже другая и этот view никто не прочитает
+        version = version.decode() if isinstance(version, bytes) else version
+        try:
+            await async_redis_client.setex(
+                _view_prefix(order_id) + version,
+                settings.ORDER_CACHE_TTL_SECONDS,
+                cache.serializer.dumps(view)
+            )
+        except Exception as e:
+            logger.warning("Order cache write failed for %s: %s", order_id, e)
+    return view
+
+def invalidate_orders(order_ids: Iterable[int]):
+    # Вызывается строго после коммита мутации; синхронный вариант для фоновых потоков
+    order_ids = list(order_ids)
+    if not order_ids:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for order_id in order_ids:
+            pipe.incr(_version_key(order_id))
+            pipe.expire(_version_key(order_id), settings.ORDER_CACHE_VERSION_TTL_SECONDS)
+        pipe.execute()
+    except Exception as e:
+        logger.error("Order cache invalidation failed for %d orders: %s", len(order_ids), e)
+
+async def invalidate_order(order_id: int):
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        pipe.incr(_version_key(order_id))
+        pipe.expire(_version_key(order_id), settings.ORDER_CACHE_VERSION_TTL_SECONDS)
+        await pipe.execute()
+    except Exception as e:
+        logger.error("Order cache invalidation failed for order %s: %s", order_id, e)
+
+async def invalidate_orders_async(order_ids: Iterable[int]):
+    order_ids = list(order_ids)
+    if not order_ids:
+        return
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        for order_id in order_ids:
+            pipe.incr(_version_key(order_id))
+            pipe.expire(_version_key(order_id), settings.ORDER_CACHE_VERSION_TTL_SECONDS)
+        await pipe.execute()
+    except Exception as e:
+        logger.error("Order cache invalidation failed for %d orders: %s", len(order_ids), e)
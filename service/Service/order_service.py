@@ -0,0 +1,75 @@
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Courier, Customer, Order, OrderItem, OrderStatus, UserRole
+
+class OrderService:
+    @staticmethod
+    async def can_access(db: AsyncSession, order_id: int, user) -> Optional[bool]:
+        # None — заказа нет. Заказ принадлежит пользователю, если клиент заказа заведен на его email;
+        # назначенному курьеру и администратору заказ тоже доступен
+        row = (await db.execute(
+            select(Customer.email, Courier.user_id.label("courier_user_id"))
+            .select_from(Order)
+            .outerjoin(Customer, Customer.id == Order.customer_id)
+            .outerjoin(Courier, Courier.id == Order.courier_id)
+            .where(Order.id == order_id)
+        )).first()
+        if row is None:
+            return None
+        return (
+            user.role == UserRole.ADMIN
+            or (row.email is not None and row.email == user.email)
+            or (row.courier_user_id is not None and row.courier_user_id == user.id)
+        )
+
+    @staticmethod
+    def bulk_insert(session: Session, orders: list) -> List[int]:
+        # Заказы и позиции вставляются пачками в рамках одной транзакции вызывающего
+        order_table = Order.__table__
+        now = datetime.utcnow()
+        rows = [
+            {
+                "customer_id": order.customer_id,
+                "delivery_address": order.delivery_address,
+                "delivery_latitude": order.delivery_latitude,
+                "delivery_longitude": order.delivery_longitude,
+                "total_price": sum(item["price"] * item["quantity"] for item in order.items),
+                "status": OrderStatus.NEW.value,
+                "payment_status": "pending",
+                "created_at": now,
+            }
+            for order in orders
+        ]
+        if not rows:
+            return []
+
+        if session.get_bind().dialect.name == "postgresql":
+            # id заранее берутся из последовательности одним запросом: заказы вставляются одним executemany
+            # на любом драйвере (asyncpg не поддерживает executemany с RETURNING), а позиции привязываются
+            # к заказам по собственным id, без расчета на порядок строк в RETURNING
+            order_ids = list(session.execute(
+                select(func.nextval(func.pg_get_serial_sequence(order_table.name, order_table.c.id.name)))
+                .select_from(func.generate_series(1, len(rows)))
+            ).scalars())
+            for row, order_id in zip(rows, order_ids):
+                row["id"] = order_id
+            session.execute(order_table.insert(), rows)
+        else:
+            # SQLite не умеет executemany с RETURNING — вставляем построчно, но без ORM и в той же транзакции
+            order_ids = [session.execute(order_table.insert(), row).inserted_primary_key[0] for row in rows]
+
+        item_rows = [
+            {
+                "order_id": order_id,
+                "product_name": item["product_name"],
+                "quantity": item["quantity"],
+                "price": item["price"],
+            }
+            for order_id, order in zip(order_ids, orders)
+            for item in order.items
+        ]
+        session.execute(OrderItem.__table__.insert(), item_rows)
+        return order_ids
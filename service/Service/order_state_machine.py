@@ -0,0 +1,127 @@
+import asyncio
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple, Union
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+from models import Order, OrderStatus, TrackingUpdate
+from logger import logger
+
+# Допустимые переходы статуса заказа. Переходов в тот же статус нет,
+# поэтому успешный условный UPDATE всегда означает реальную смену статуса.
+TRANSITIONS: Dict[OrderStatus, FrozenSet[OrderStatus]] = {
+    OrderStatus.NEW: frozenset({OrderStatus.PAID, OrderStatus.ASSIGNED_TO_COURIER, OrderStatus.CANCELLED}),
+    OrderStatus.PAID: frozenset({OrderStatus.PREPARING, OrderStatus.ASSIGNED_TO_COURIER, OrderStatus.CANCELLED}),
+    OrderStatus.PREPARING: frozenset({OrderStatus.ASSIGNED_TO_COURIER, OrderStatus.CANCELLED}),
+    OrderStatus.ASSIGNED_TO_COURIER: frozenset({OrderStatus.IN_DELIVERY, OrderStatus.CANCELLED}),
+    OrderStatus.IN_DELIVERY: frozenset({OrderStatus.DELIVERED, OrderStatus.CANCELLED}),
+    OrderStatus.DELIVERED: frozenset(),
+    OrderStatus.CANCELLED: frozenset(),
+}
+
+_PREDECESSORS: Dict[OrderStatus, Tuple[str, ...]] = {
+    status: tuple(source.value for source, targets in TRANSITIONS.items() if status in targets)
+    for status in OrderStatus
+}
+
+def can_transition(current: str, status: OrderStatus) -> bool:
+    return status in TRANSITIONS.get(OrderStatus(current), ())
+
+class TransitionRejected(Exception):
+    def __init__(self, order_id: int, current: Optional[str], version: Optional[int], status: OrderStatus):
+        self.order_id = order_id
+        self.current = current
+        self.version = version
+        self.status = status
+        super().__init__(f"Order {order_id} cannot move from {current} (v{version}) to {status.value}")
+
+class OrderStatusChanged:
+    __slots__ = ("order_id", "status", "version", "total_price", "courier_id", "customer_id", "occurred_at")
+
+    def __init__(self, order_id: int, status: OrderStatus, version: int, total_price: float,
+                 courier_id: Optional[int], customer_id: Optional[int], occurred_at: datetime):
+        self.order_id = order_id
+        self.status = status
+        self.version = version
+        self.total_price = total_price
+        self.courier_id = courier_id
+        self.customer_id = customer_id
+        self.occurred_at = occurred_at
+
+class OrderStateMachine:
+    @staticmethod
+    def transition(session: Session, order_id: int, status: OrderStatus, location: Optional[str] = None,
+                   comment: Optional[str] = None, expected_version: Optional[int] = None) -> Optional[OrderStatusChanged]:
+        # Один условный UPDATE без предварительного чтения: статус сравнивается с допустимыми
+        # предшественниками, версия — с ожидаемой клиентом. Блокировка строки держится до коммита,
+        # поэтому параллельные переходы одного заказа выстраиваются и не затирают друг друга.
+        orders = Order.__table__
+        now = datetime.utcnow()
+        conditions = [orders.c.id == order_id, orders.c.status.in_(_PREDECESSORS[status])]
+        if expected_version is not None:
+            conditions.append(orders.c.version == expected_version)
+        values = {"status": status.value, "version": orders.c.version + 1}
+        if status == OrderStatus.DELIVERED:
+            values["actual_delivery_time"] = now
+        updated = session.execute(update(orders).where(*conditions).values(**values)).rowcount
+
+        if not updated:
+            # Медленный путь только при отказе: отличаем отсутствующий заказ от конфликта
+            current = session.execute(
+                select(orders.c.status, orders.c.version).where(orders.c.id == order_id)
+            ).first()
+            if current is None:
+                return None
+            raise TransitionRejected(order_id, current.status, current.version, status)
+
+        session.execute(TrackingUpdate.__table__.insert().values(
+            order_id=order_id, status=status.value, location=location, comment=comment, timestamp=now
+        ))
+        row = session.execute(
+            select(orders.c.version, orders.c.total_price, orders.c.courier_id, orders.c.customer_id)
+            .where(orders.c.id == order_id)
+        ).one()
+        return OrderStatusChanged(
+            order_id, status, row.version, row.total_price, row.courier_id, row.customer_id, now
+        )
+
+Handler = Callable[[OrderStatusChanged], Union[None, Awaitable[None]]]
+BatchHandler = Callable[[List[OrderStatusChanged]], Union[None, Awaitable[None]]]
+
+# Доменные события заказа внутри процесса: публикуются после коммита,
+# ошибка одного обработчика не мешает остальным. Пакетные пути (диспетчер) публикуют пачку событий:
+# обработчик с пакетным вариантом вызывается на нее один раз, остальные — на каждое событие
+class OrderEventBus:
+    def __init__(self):
+        self._handlers: List[Tuple[Handler, Optional[BatchHandler]]] = []
+        self.published_total = 0
+        self.handler_errors_total = 0
+
+    def subscribe(self, handler: Handler, batch_handler: Optional[BatchHandler] = None):
+        self._handlers.append((handler, batch_handler))
+
+    async def _call(self, handler, argument, order_id: int):
+        try:
+            result = handler(argument)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            self.handler_errors_total += 1
+            logger.error("Order event handler failed for order %s: %s", order_id, e)
+
+    async def publish(self, event: OrderStatusChanged):
+        self.published_total += 1
+        for handler, _ in self._handlers:
+            await self._call(handler, event, event.order_id)
+
+    async def publish_many(self, events: List[OrderStatusChanged]):
+        if not events:
+            return
+        self.published_total += len(events)
+        for handler, batch_handler in self._handlers:
+            if batch_handler is not None:
+                await self._call(batch_handler, events, events[0].order_id)
+                continue
+            for event in events:
+                await self._call(handler, event, event.order_id)
+
+order_events = OrderEventBus()
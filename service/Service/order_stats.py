@@ -0,0 +1,272 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import distinct, func, select
+from sqlalchemy.orm import Session
+from database import SessionLocal, IS_SQLITE
+from models import Courier, Order, OrderStatus, PaymentAttempt, PaymentAttemptStatus, TrackingUpdate
+from cache import redis_client, async_redis_client, cache_key
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+COUNT_FIELDS = ("orders_created", "orders_paid", "orders_assigned", "orders_delivered", "orders_cancelled")
+SUM_FIELDS = ("paid_amount", "revenue")
+GRANULARITIES = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+_TOTAL_KEY = cache_key("stats", "total")
+_LOCK_KEY = cache_key("stats", "reconcile_lock")
+
+def bucket_start(at: datetime, granularity: str) -> datetime:
+    if granularity == "day":
+        return at.replace(hour=0, minute=0, second=0, microsecond=0)
+    return at.replace(minute=0, second=0, microsecond=0)
+
+def _bucket_key(granularity: str, start: datetime) -> str:
+    return cache_key("stats", granularity, start.strftime("%Y%m%d%H"))
+
+def _bucket_column(column, granularity: str):
+    if IS_SQLITE:
+        return func.strftime("%Y-%m-%d %H:00:00" if granularity == "hour" else "%Y-%m-%d 00:00:00", column)
+    return func.date_trunc(granularity, column)
+
+def _as_datetime(value) -> datetime:
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+def _parse(values: dict) -> dict:
+    values = {(field.decode() if isinstance(field, bytes) else field): value for field, value in values.items()}
+    result = {field: int(float(values.get(field, 0))) for field in COUNT_FIELDS}
+    result.update({field: round(float(values.get(field, 0)), 2) for field in SUM_FIELDS})
+    if "active_couriers" in values:
+        result["active_couriers"] = int(values["active_couriers"])
+    return result
+
+def transition_deltas(previous: Optional[str], status: OrderStatus, total_price: float) -> Dict[str, float]:
+    # Приращения счетчиков при смене статуса заказа; повтор того же статуса ничего не добавляет
+    if previous == status:
+        return {}
+    if status == OrderStatus.DELIVERED:
+        return {"orders_delivered": 1, "revenue": total_price or 0}
+    if status == OrderStatus.CANCELLED:
+        return {"orders_cancelled": 1}
+    if status == OrderStatus.ASSIGNED_TO_COURIER:
+        return {"orders_assigned": 1}
+    return {}
+
+# Статистика админки без агрегатов по orders на запрос: пути смены статуса после коммита
+# добавляют приращения в Redis — общий итог и корзины по часу и дню. Периодическая сверка
+# (один воркер за интервал) пересчитывает итоги и корзины последних окон из БД, так что
+# потерянные или задвоенные приращения живут не дольше интервала сверки.
+class OrderStats:
+    def __init__(self, reconcile_interval_seconds: float, reconcile_window_hours: int,
+                 hour_retention_days: int, day_retention_days: int, max_range_buckets: int):
+        self.reconcile_interval_seconds = reconcile_interval_seconds
+        self.reconcile_window_hours = reconcile_window_hours
+        self.retention = {
+            "hour": int(timedelta(days=hour_retention_days).total_seconds()),
+            "day": int(timedelta(days=day_retention_days).total_seconds()),
+        }
+        self.max_range_buckets = max_range_buckets
+        self._origin = uuid.uuid4().hex
+        self._task: Optional[asyncio.Task] = None
+
+        self.reconcile_runs = 0
+        self.record_errors_total = 0
+        self.last_reconcile_seconds = 0.0
+
+    def _queue_increments(self, pipe, deltas: Dict[str, float], at: Optional[datetime]):
+        at = at or datetime.utcnow()
+        keys = [(_TOTAL_KEY, None)] + [
+            (_bucket_key(granularity, bucket_start(at, granularity)), granularity) for granularity in GRANULARITIES
+        ]
+        for key, granularity in keys:
+            for field, value in deltas.items():
+                if field in SUM_FIELDS:
+                    pipe.hincrbyfloat(key, field, float(value))
+                else:
+                    pipe.hincrby(key, field, int(value))
+            if granularity is not None:
+                pipe.expire(key, self.retention[granularity])
+
+    async def record(self, deltas: Dict[str, float], at: Optional[datetime] = None):
+        # Вызывать после коммита; сбой Redis не влияет на запрос, расхождение исправит сверка
+        if not deltas:
+            return
+        try:
+            pipe = async_redis_client.pipeline(transaction=False)
+            self._queue_increments(pipe, deltas, at)
+            await pipe.execute()
+        except Exception as e:
+            self.record_errors_total += 1
+            logger.warning("Order stats update failed: %s", e)
+
+    async def summary(self) -> dict:
+        values = await async_redis_client.hgetall(_TOTAL_KEY)
+        if not values:
+            # Холодный старт: итоги еще ни разу не считались
+            await asyncio.get_running_loop().run_in_executor(None, self._run_in_session, True)
+            values = await async_redis_client.hgetall(_TOTAL_KEY)
+        return _parse(values)
+
+    async def series(self, start: datetime, end: datetime, granularity: str) -> List[dict]:
+        step = GRANULARITIES[granularity]
+        buckets = []
+        current = bucket_start(start, granularity)
+        while current <= end:
+            buckets.append(current)
+            current += step
+        if len(buckets) > self.max_range_buckets:
+            raise ValueError(f"Range spans {len(buckets)} buckets, limit is {self.max_range_buckets}")
+
+        pipe = async_redis_client.pipeline(transaction=False)
+        for bucket in buckets:
+            pipe.hgetall(_bucket_key(granularity, bucket))
+        values = await pipe.execute()
+        return [{"bucket": bucket.isoformat(), **_parse(value)} for bucket, value in zip(buckets, values)]
+
+    @staticmethod
+    def _totals(db: Session) -> dict:
+        delivered, revenue = db.execute(
+            select(func.count(), func.coalesce(func.sum(Order.total_price), 0))
+            .where(Order.status == OrderStatus.DELIVERED)
+        ).one()
+        paid, paid_amount = db.execute(
+            select(func.count(distinct(PaymentAttempt.order_id)), func.coalesce(func.sum(PaymentAttempt.amount), 0))
+            .where(PaymentAttempt.status == PaymentAttemptStatus.SUCCEEDED.value)
+        ).one()
+        return {
+            "orders_created": db.execute(select(func.count()).select_from(Order)).scalar(),
+            "orders_paid": paid,
+            "orders_assigned": db.execute(
+                select(func.count()).select_from(Order).where(Order.courier_id.isnot(None))
+            ).scalar(),
+            "orders_delivered": delivered,
+            "orders_cancelled": db.execute(
+                select(func.count()).select_from(Order).where(Order.status == OrderStatus.CANCELLED)
+            ).scalar(),
+            "revenue": float(revenue),
+            "paid_amount": float(paid_amount),
+            "active_couriers": db.execute(
+                select(func.count()).select_from(Courier).where(Courier.is_available == True)
+            ).scalar(),
+        }
+
+    @staticmethod
+    def _buckets(db: Session, granularity: str, since: datetime) -> Dict[datetime, dict]:
+        # Назначения не оставляют отметки времени, поэтому orders_assigned в корзинах не сверяется
+        buckets: Dict[datetime, dict] = {}
+
+        def collect(query, fields):
+            for row in db.execute(query):
+                bucket = buckets.setdefault(_as_datetime(row[0]), {})
+                for field, value in zip(fields, row[1:]):
+                    bucket[field] = value or 0
+
+        created = _bucket_column(Order.created_at, granularity)
+        collect(
+            select(created, func.count()).where(Order.created_at >= since).group_by(created),
+            ("orders_created",)
+        )
+        delivered = _bucket_column(Order.actual_delivery_time, granularity)
+        collect(
+            select(delivered, func.count(), func.sum(Order.total_price))
+            .where(Order.status == OrderStatus.DELIVERED, Order.actual_delivery_time >= since)
+            .group_by(delivered),
+            ("orders_delivered", "revenue")
+        )
+        paid = _bucket_column(PaymentAttempt.updated_at, granularity)
+        collect(
+            select(paid, func.count(distinct(PaymentAttempt.order_id)), func.sum(PaymentAttempt.amount))
+            .where(PaymentAttempt.status == PaymentAttemptStatus.SUCCEEDED.value, PaymentAttempt.updated_at >= since)
+            .group_by(paid),
+            ("orders_paid", "paid_amount")
+        )
+        cancelled = _bucket_column(TrackingUpdate.timestamp, granularity)
+        collect(
+            select(cancelled, func.count(distinct(TrackingUpdate.order_id)))
+            .where(TrackingUpdate.status == OrderStatus.CANCELLED, TrackingUpdate.timestamp >= since)
+            .group_by(cancelled),
+            ("orders_cancelled",)
+        )
+        return buckets
+
+    def reconcile_once(self, db: Session, now: Optional[datetime] = None, force: bool = False) -> bool:
+        # Блокировка на весь интервал: из нескольких воркеров сверку выполняет один
+        if not force and not redis_client.set(_LOCK_KEY, self._origin, nx=True,
+                                              ex=max(int(self.reconcile_interval_seconds), 1)):
+            return False
+        started = time.perf_counter()
+        now = now or datetime.utcnow()
+        totals = self._totals(db)
+
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(_TOTAL_KEY)
+        pipe.hset(_TOTAL_KEY, mapping=totals)
+        for granularity, step in GRANULARITIES.items():
+            # Дневное окно начинается с полуночи, чтобы первая корзина не оказалась неполной
+            since = bucket_start(now - timedelta(hours=self.reconcile_window_hours), granularity)
+            buckets = self._buckets(db, granularity, since)
+            current = since
+            while current <= now:
+                values = {field: 0 for field in COUNT_FIELDS + SUM_FIELDS if field != "orders_assigned"}
+                values.update(buckets.get(current, {}))
+                key = _bucket_key(granularity, current)
+                pipe.hset(key, mapping={field: float(value) if field in SUM_FIELDS else int(value)
+                                        for field, value in values.items()})
+                pipe.expire(key, self.retention[granularity])
+                current += step
+        pipe.execute()
+
+        self.reconcile_runs += 1
+        self.last_reconcile_seconds = time.perf_counter() - started
+        logger.info("Order stats reconciled in %.3fs", self.last_reconcile_seconds)
+        return True
+
+    def _run_in_session(self, force: bool = False):
+        # Сверка только читает БД и пишет в Redis, поэтому идет мимо писателя SQLite
+        db = SessionLocal()
+        try:
+            return self.reconcile_once(db, force=force)
+        finally:
+            db.close()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self._run_in_session)
+            except Exception as e:
+                logger.error("Order stats reconciliation failed: %s", e)
+            await asyncio.sleep(self.reconcile_interval_seconds)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "reconcile_runs": self.reconcile_runs,
+            "record_errors_total": self.record_errors_total,
+            "last_reconcile_seconds": self.last_reconcile_seconds,
+        }
+
+order_stats = OrderStats(
+    reconcile_interval_seconds=settings.STATS_RECONCILE_INTERVAL_SECONDS,
+    reconcile_window_hours=settings.STATS_RECONCILE_WINDOW_HOURS,
+    hour_retention_days=settings.STATS_HOUR_RETENTION_DAYS,
+    day_retention_days=settings.STATS_DAY_RETENTION_DAYS,
+    max_range_buckets=settings.STATS_RANGE_MAX_BUCKETS
+)
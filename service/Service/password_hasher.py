@@ -0,0 +1,123 @@
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+from werkzeug.security import generate_password_hash, check_password_hash
+from config import get_settings
+
+settings = get_settings()
+
+class PasswordHasherBusy(Exception):
+    pass
+
+# PBKDF2 занимает десятки миллисекунд CPU, поэтому выполняется вне event loop.
+# Одновременно считается не больше max_workers хэшей, еще max_waiting запросов ждут своей очереди,
+# остальные сразу получают отказ — волна логинов не останавливает WebSocket и остальные запросы.
+class PasswordHasher:
+    def __init__(self, method: str, max_workers: int, max_waiting: int,
+                 wait_timeout: float, use_processes: bool):
+        self.method = method
+        self.max_workers = max_workers
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.use_processes = use_processes
+        self._executor: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed_total = 0
+        self.rejected_total = 0
+        self.rehashed_total = 0
+        self.wait_seconds_total = 0.0
+        self.hash_seconds_total = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                # hashlib отпускает GIL на время PBKDF2, потоков достаточно
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="password-hasher")
+        return self._executor
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        return self._semaphore
+
+    async def _run(self, fn, *args):
+        if self.waiting >= self.max_waiting:
+            self.rejected_total += 1
+            raise PasswordHasherBusy()
+
+        semaphore = self._get_semaphore()
+        queued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.rejected_total += 1
+            raise PasswordHasherBusy()
+        finally:
+            self.waiting -= 1
+
+        started = time.perf_counter()
+        wait_seconds = started - queued
+        self.wait_seconds_total += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed_total += 1
+            self.hash_seconds_total += time.perf_counter() - started
+            semaphore.release()
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        # Метод и параметры хранятся в префиксе хэша: pbkdf2:sha256:260000$соль$хэш
+        return password_hash.split("$", 1)[0] != self.method
+
+    async def hash(self, password: str) -> str:
+        return await self._run(generate_password_hash, password, self.method)
+
+    async def verify(self, password_hash: str, password: str) -> Tuple[bool, Optional[str]]:
+        # Возвращает результат проверки и новый хэш, если параметры хэширования устарели
+        if not await self._run(check_password_hash, password_hash, password):
+            return False, None
+        if not self.needs_rehash(password_hash):
+            return True, None
+        try:
+            new_hash = await self.hash(password)
+        except PasswordHasherBusy:
+            # Перехэшируем при следующем входе, сам логин не страдает
+            return True, None
+        self.rehashed_total += 1
+        return True, new_hash
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "completed_total": self.completed_total,
+            "rejected_total": self.rejected_total,
+            "rehashed_total": self.rehashed_total,
+            "wait_seconds_total": self.wait_seconds_total,
+            "hash_seconds_total": self.hash_seconds_total,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+password_hasher = PasswordHasher(
+    method=settings.PASSWORD_HASH_METHOD,
+    max_workers=settings.PASSWORD_HASH_WORKERS,
+    max_waiting=settings.PASSWORD_HASH_MAX_WAITING,
+    wait_timeout=settings.PASSWORD_HASH_WAIT_TIMEOUT_SECONDS,
+    use_processes=settings.PASSWORD_HASH_USE_PROCESSES
+)
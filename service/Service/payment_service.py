@@ -1,7 +1,25 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from enum import Enum
-from typing import Optional
+from typing import Iterable, List, Optional, Set, Tuple
+from sqlalchemy import and_, bindparam, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from models import Order, PaymentAttempt, PaymentAttemptStatus
+from sqlite_writer import run_background_write, run_write
+from order_read_model import invalidate_order, invalidate_orders
+from order_stats import order_stats
+from config import get_settings
 from logger import logger
 
+settings = get_settings()
+
 class PaymentStatus(str, Enum):
     PENDING = "pending"
     COMPLETED = "completed"
@@ -13,33 +31,475 @@ class PaymentError(Exception):
         self.error_code = error_code
         super().__init__(self.message)
 
+class PaymentInProgress(Exception):
+    pass
+
+# Ошибки, после которых повтор с тем же ключом идемпотентности безопасен:
+# провайдер получает тот же ключ и не проведет платеж второй раз
+TRANSIENT_ERRORS = {"PROVIDER_UNAVAILABLE", "PROVIDER_TIMEOUT", "PROVIDER_ERROR"}
+
+ORDER_PAYMENT_STATUS = {
+    PaymentAttemptStatus.SUCCEEDED: PaymentStatus.COMPLETED,
+    PaymentAttemptStatus.FAILED: PaymentStatus.FAILED,
+    PaymentAttemptStatus.PENDING: PaymentStatus.PENDING,
+}
+
+def map_intent_status(status: str) -> PaymentAttemptStatus:
+    # requires_payment_method / requires_confirmation / requires_action ждут подтверждения клиентом
+    # по client_secret, а processing — ответа банка: все это еще не отказ
+    if status == "succeeded":
+        return PaymentAttemptStatus.SUCCEEDED
+    if status == "canceled":
+        return PaymentAttemptStatus.FAILED
+    return PaymentAttemptStatus.PENDING
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._probe_in_flight = False
+        if self.state == "half_open":
+            # Пока провайдер не ответил на пробный запрос, остальные сразу получают отказ
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def release_probe(self):
+        # Пробный запрос отменен без ответа провайдера: следующий вызов снова сможет проверить связь
+        self._probe_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self.state = "closed"
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning("Payment provider circuit opened after %d failures", self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+# Вызовы провайдера выполняются в отдельном пуле потоков с общим таймаутом и через circuit breaker
+class PaymentGateway:
+    def __init__(self, provider, pool_size: int, timeout: float, breaker: CircuitBreaker):
+        self.provider = provider
+        self.timeout = timeout
+        self.breaker = breaker
+        self.pool_size = pool_size
+        self._executor = self._create_executor()
+
+        self.calls_total = 0
+        self.failures_total = 0
+        self.rejected_total = 0
+
+    async def call(self, fn, *args):
+        if not self.breaker.allow():
+            self.rejected_total += 1
+            raise PaymentError("Payment provider is temporarily unavailable", "PROVIDER_UNAVAILABLE")
+        self.calls_total += 1
+        loop = asyncio.get_running_loop()
+        try:
+            result = await asyncio.wait_for(loop.run_in_executor(self._executor, fn, *args), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self.failures_total += 1
+            self.breaker.record_failure()
+            raise PaymentError("Payment provider timed out", "PROVIDER_TIMEOUT")
+        except asyncio.CancelledError:
+            self.breaker.release_probe()
+            raise
+        except PaymentError:
+            # Провайдер ответил отказом — со связью все в порядке
+            self.breaker.record_success()
+            raise
+        except Exception as e:
+            self.failures_total += 1
+            if self.provider.is_transient(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise PaymentError(str(e), "PROVIDER_ERROR")
+        self.breaker.record_success()
+        return result
+
+    def _create_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="payment-provider")
+
+    def shutdown(self):
+        # Пул заменяется новым (потоки в нем стартуют только при первом вызове), чтобы шлюз пережил перезапуск приложения
+        self._executor.shutdown(wait=False)
+        self._executor = self._create_executor()
+
+    def stats(self) -> dict:
+        return {
+            "provider": self.provider.name,
+            "circuit_state": self.breaker.state,
+            "calls_total": self.calls_total,
+            "failures_total": self.failures_total,
+            "rejected_total": self.rejected_total,
+        }
+
+# Локальная заглушка провайдера для разработки и тестов. Повтор с тем же ключом возвращает тот же платеж;
+# payment_method="delayed" оставляет платеж в processing до следующей проверки статуса (как после вебхука).
+class StubPaymentProvider:
+    name = "stub"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._intents = {}
+        self._by_key = {}
+        self.charges_total = 0
+
+    def create_intent(self, amount: float, currency: str, order_id: int,
+                      payment_method: str, idempotency_key: str) -> Tuple[str, str, Optional[str]]:
+        if amount <= 0:
+            raise PaymentError("Invalid amount", "INVALID_AMOUNT")
+        with self._lock:
+            intent_id = self._by_key.get(idempotency_key)
+            if intent_id is None:
+                intent_id = f"PAY-{order_id}-{uuid.uuid4().hex[:12]}"
+                self._by_key[idempotency_key] = intent_id
+                self._intents[intent_id] = "processing" if payment_method == "delayed" else "succeeded"
+                self.charges_total += 1
+            return intent_id, self._intents[intent_id], None
+
+    def retrieve(self, intent_id: str) -> str:
+        with self._lock:
+            if self._intents.get(intent_id) == "processing":
+                self._intents[intent_id] = "succeeded"
+            return self._intents.get(intent_id, "canceled")
+
+    def client_secret(self, intent_id: str) -> Optional[str]:
+        return None
+
+    def parse_webhook(self, payload: bytes, signature: Optional[str]) -> List[str]:
+        return [json.loads(payload)["payment_intent"]]
+
+    @staticmethod
+    def is_transient(error: Exception) -> bool:
+        return isinstance(error, (ConnectionError, TimeoutError))
+
+def create_provider(name: str):
+    if name == "stripe":
+        from stripe_provider import stripe_provider
+        return stripe_provider
+    return StubPaymentProvider()
+
+payment_gateway = PaymentGateway(
+    provider=create_provider(settings.PAYMENT_PROVIDER),
+    pool_size=settings.PAYMENT_PROVIDER_POOL_SIZE,
+    timeout=settings.PAYMENT_PROVIDER_TIMEOUT_SECONDS,
+    breaker=CircuitBreaker(
+        failure_threshold=settings.PAYMENT_BREAKER_FAILURE_THRESHOLD,
+        reset_timeout=settings.PAYMENT_BREAKER_RESET_SECONDS
+    )
+)
+
 class PaymentService:
     @staticmethod
-    async def process_payment(
-        amount: float,
-        currency: str,
-        payment_method: str,
-        order_id: str
-    ) -> tuple[PaymentStatus, Optional[str]]:
+    def _find_attempt(session: Session, order_id: int, idempotency_key: str):
+        return session.execute(
+            select(PaymentAttempt.id, PaymentAttempt.status, PaymentAttempt.provider_payment_id)
+            .where(PaymentAttempt.order_id == order_id, PaymentAttempt.idempotency_key == idempotency_key)
+        ).first()
+
+    @staticmethod
+    def begin_attempt(session: Session, order_id: int, idempotency_key: str, amount: float, currency: str):
+        # Возвращает (id попытки, None), если платеж нужно провести, или (id, строка) для повтора ответа
+        existing = PaymentService._find_attempt(session, order_id, idempotency_key)
+        if existing is None:
+            try:
+                with session.begin_nested():
+                    attempt_id = session.execute(PaymentAttempt.__table__.insert().values(
+                        order_id=order_id,
+                        idempotency_key=idempotency_key,
+                        status=PaymentAttemptStatus.PROCESSING.value,
+                        amount=amount,
+                        currency=currency
+                    )).inserted_primary_key[0]
+                return attempt_id, None
+            except IntegrityError:
+                existing = PaymentService._find_attempt(session, order_id, idempotency_key)
+        if existing.status == PaymentAttemptStatus.ERROR:
+            # Прошлая попытка упала на связи с провайдером — забираем ее условным UPDATE
+            claimed = session.execute(
+                update(PaymentAttempt.__table__)
+                .where(
+                    PaymentAttempt.__table__.c.id == existing.id,
+                    PaymentAttempt.__table__.c.status == PaymentAttemptStatus.ERROR.value
+                )
+                .values(status=PaymentAttemptStatus.PROCESSING.value, error=None, updated_at=datetime.utcnow())
+            ).rowcount
+            if claimed:
+                return existing.id, None
+            existing = PaymentService._find_attempt(session, order_id, idempotency_key)
+        return existing.id, existing
+
+    @staticmethod
+    def finish_attempt(session: Session, attempt_id: int, order_id: int, status: PaymentAttemptStatus,
+                       provider_payment_id: Optional[str], error: Optional[str]) -> bool:
+        # True, если этот вызов перевел заказ в оплаченные
+        session.execute(
+            update(PaymentAttempt.__table__)
+            .where(PaymentAttempt.__table__.c.id == attempt_id)
+            .values(status=status.value, provider_payment_id=provider_payment_id,
+                    error=error[:500] if error else None, updated_at=datetime.utcnow())
+        )
+        if status not in ORDER_PAYMENT_STATUS:
+            return False
+        updated = session.execute(
+            update(Order.__table__)
+            .where(Order.__table__.c.id == order_id, Order.__table__.c.payment_status != PaymentStatus.COMPLETED.value)
+            .values(payment_status=ORDER_PAYMENT_STATUS[status].value,
+                    payment_id=provider_payment_id or Order.__table__.c.payment_id)
+        ).rowcount
+        return bool(updated) and status == PaymentAttemptStatus.SUCCEEDED
+
+    @staticmethod
+    async def _default_key(db: AsyncSession, order_id: int) -> str:
+        # Без Idempotency-Key повторы схлопываются в одну попытку, но после отказа
+        # следующая попытка получает новый ключ — и у нас, и у провайдера
+        failed = (await db.execute(
+            select(func.count()).select_from(PaymentAttempt)
+            .where(
+                PaymentAttempt.order_id == order_id,
+                PaymentAttempt.idempotency_key.like("default-%"),
+                PaymentAttempt.status == PaymentAttemptStatus.FAILED.value
+            )
+        )).scalar()
+        return f"default-{failed}"
+
+    @staticmethod
+    def _response(status: PaymentAttemptStatus, payment_id: Optional[str], client_secret: Optional[str]) -> dict:
+        response = {"status": ORDER_PAYMENT_STATUS.get(status, PaymentStatus.FAILED), "payment_id": payment_id}
+        if client_secret is not None:
+            response["client_secret"] = client_secret
+        return response
+
+    @staticmethod
+    async def pay_order(db: AsyncSession, order_id: int, currency: str,
+                        payment_method: str, idempotency_key: Optional[str]) -> Optional[dict]:
+        # Сумма берется из заказа (с учетом промокода), а не из запроса клиента
+        order = (await db.execute(
+            select(Order.total_price, Order.payment_status, Order.payment_id).where(Order.id == order_id)
+        )).first()
+        if order is None:
+            return None
+        if order.payment_status == PaymentStatus.COMPLETED:
+            return {"status": PaymentStatus.COMPLETED, "payment_id": order.payment_id}
+        amount = order.total_price
+        if idempotency_key is None:
+            idempotency_key = await PaymentService._default_key(db, order_id)
+
+        attempt_id, existing = await run_write(
+            db, lambda session: PaymentService.begin_attempt(session, order_id, idempotency_key, amount, currency)
+        )
+        if existing is not None:
+            if existing.status == PaymentAttemptStatus.PROCESSING:
+                raise PaymentInProgress()
+            status = PaymentAttemptStatus(existing.status)
+            client_secret = None
+            if status == PaymentAttemptStatus.PENDING and existing.provider_payment_id:
+                # Повтор запроса, ответ на который потерялся: клиенту все еще нужно подтвердить платеж
+                client_secret = await payment_gateway.call(
+                    payment_gateway.provider.client_secret, existing.provider_payment_id
+                )
+            return PaymentService._response(status, existing.provider_payment_id, client_secret)
+
+        logger.info("Processing payment for order %s", order_id, extra={"order_id": order_id})
         try:
-            # Здесь должна быть интеграция с реальной платежной системой
-            # Например, Stripe или PayPal
-            
-            logger.info(f"Processing payment for order {order_id}")
-            
-            # Имитация обработки платежа
-            if amount <= 0:
-                raise PaymentError("Invalid amount", "INVALID_AMOUNT")
-                
-            # Успешный платеж
-            payment_id = f"PAY-{order_id}-{int(time.time())}"
-            logger.info(f"Payment successful: {payment_id}")
-            
-            return PaymentStatus.COMPLETED, payment_id
-            
+            intent_id, intent_status, client_secret = await payment_gateway.call(
+                payment_gateway.provider.create_intent,
+                amount, currency, order_id, payment_method, f"order-{order_id}-{idempotency_key}"
+            )
         except PaymentError as e:
-            logger.error(f"Payment error: {str(e)}")
+            status = PaymentAttemptStatus.ERROR if e.error_code in TRANSIENT_ERRORS else PaymentAttemptStatus.FAILED
+            error_message = e.message
+            await run_write(db, lambda session: PaymentService.finish_attempt(
+                session, attempt_id, order_id, status, None, error_message
+            ))
+            if status == PaymentAttemptStatus.FAILED:
+                await invalidate_order(order_id)
             raise
-        except Exception as e:
-            logger.error(f"Unexpected payment error: {str(e)}")
-            raise PaymentError("Payment processing failed", "SYSTEM_ERROR") 
\ No newline at end of file
+
+        status = map_intent_status(intent_status)
+        paid = await run_write(db, lambda session: PaymentService.finish_attempt(
+            session, attempt_id, order_id, status, intent_id, None
+        ))
+        await invalidate_order(order_id)
+        if paid:
+            await order_stats.record({"orders_paid": 1, "paid_amount": amount})
+        if status == PaymentAttemptStatus.PENDING:
+            payment_reconciler.track([intent_id])
+        logger.info("Payment %s for order %s: %s", intent_id, order_id, status.value, extra={"order_id": order_id})
+        return PaymentService._response(status, intent_id, client_secret)
+
+# Сверка платежей: вебхук лишь сообщает id платежа, статус перепроверяется у провайдера пачкой,
+# а результаты пишутся одной транзакцией. Попытки, зависшие без вебхука, периодически поднимаются из БД.
+class PaymentReconciler:
+    def __init__(self, gateway: PaymentGateway, interval_seconds: float, batch_size: int, stale_seconds: int):
+        self.gateway = gateway
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self.stale_seconds = stale_seconds
+        self._pending: Set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.confirmed_total = 0
+        self.last_batch_size = 0
+
+    def track(self, intent_ids: Iterable[str]):
+        self._pending.update(intent_ids)
+        if self._wakeup is not None and len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    @staticmethod
+    def _apply(session: Session, results: List[Tuple[str, PaymentAttemptStatus]]) -> Tuple[List[int], int, float]:
+        # Возвращает id обновленных заказов, число заказов, которые эта пачка перевела в оплаченные, и их сумму
+        attempts = PaymentAttempt.__table__
+        open_statuses = or_(
+            attempts.c.status == PaymentAttemptStatus.PENDING.value,
+            attempts.c.status == PaymentAttemptStatus.PROCESSING.value
+        )
+        found = session.execute(
+            select(attempts.c.provider_payment_id, attempts.c.order_id, attempts.c.amount)
+            .where(attempts.c.provider_payment_id.in_([intent_id for intent_id, _ in results]), open_statuses)
+        ).all()
+        order_ids = {row.provider_payment_id: row.order_id for row in found}
+        rows = [
+            {"intent_id": intent_id, "order_id": order_ids[intent_id], "new_status": status.value,
+             "order_status": ORDER_PAYMENT_STATUS[status].value}
+            for intent_id, status in results if intent_id in order_ids
+        ]
+        if not rows:
+            return [], 0, 0.0
+        succeeded = {row["order_id"] for row in rows if row["new_status"] == PaymentAttemptStatus.SUCCEEDED.value}
+        newly_paid = set(session.execute(
+            select(Order.id).where(Order.id.in_(succeeded), Order.payment_status != PaymentStatus.COMPLETED.value)
+        ).scalars()) if succeeded else set()
+        now = datetime.utcnow()
+        session.execute(
+            update(attempts)
+            .where(and_(attempts.c.provider_payment_id == bindparam("intent_id"), open_statuses))
+            .values(status=bindparam("new_status"), updated_at=now),
+            rows
+        )
+        orders = Order.__table__
+        session.execute(
+            update(orders)
+            .where(and_(orders.c.id == bindparam("order_id"), orders.c.payment_status != PaymentStatus.COMPLETED.value))
+            .values(payment_status=bindparam("order_status"), payment_id=bindparam("intent_id")),
+            rows
+        )
+        paid_amount = sum(row.amount for row in found if row.order_id in newly_paid)
+        return [row["order_id"] for row in rows], len(newly_paid), paid_amount
+
+    async def reconcile(self, intent_ids: List[str]) -> int:
+        statuses = await asyncio.gather(
+            *(self.gateway.call(self.gateway.provider.retrieve, intent_id) for intent_id in intent_ids),
+            return_exceptions=True
+        )
+        results = []
+        for intent_id, status in zip(intent_ids, statuses):
+            if isinstance(status, Exception):
+                # Провайдер недоступен — проверим в следующей пачке
+                self._pending.add(intent_id)
+                continue
+            mapped = map_intent_status(status)
+            if mapped != PaymentAttemptStatus.PENDING:
+                results.append((intent_id, mapped))
+        if not results:
+            return 0
+        order_ids, paid_count, paid_amount = await run_background_write(
+            lambda session: self._apply(session, results)
+        )
+        if order_ids:
+            await asyncio.get_running_loop().run_in_executor(None, invalidate_orders, order_ids)
+        if paid_count:
+            await order_stats.record({"orders_paid": paid_count, "paid_amount": paid_amount})
+        self.confirmed_total += len(order_ids)
+        return len(order_ids)
+
+    def _sweep(self, session: Session) -> List[str]:
+        # Зависшие в processing попытки (процесс упал во время вызова) становятся повторяемыми,
+        # а pending без вебхука отправляются на перепроверку
+        attempts = PaymentAttempt.__table__
+        stale_before = datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+        session.execute(
+            update(attempts)
+            .where(attempts.c.status == PaymentAttemptStatus.PROCESSING.value, attempts.c.updated_at < stale_before)
+            .values(status=PaymentAttemptStatus.ERROR.value, error="Stale processing attempt", updated_at=datetime.utcnow())
+        )
+        return session.execute(
+            select(attempts.c.provider_payment_id)
+            .where(attempts.c.status == PaymentAttemptStatus.PENDING.value, attempts.c.updated_at < stale_before)
+            .limit(self.batch_size)
+        ).scalars().all()
+
+    async def _run(self):
+        last_sweep = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                if time.monotonic() - last_sweep >= self.stale_seconds:
+                    last_sweep = time.monotonic()
+                    self._pending.update(await run_background_write(self._sweep))
+                # Неудачные проверки возвращаются в _pending и ждут следующего цикла
+                intent_ids, self._pending = list(self._pending), set()
+                for start in range(0, len(intent_ids), self.batch_size):
+                    if self.gateway.breaker.state == "open":
+                        self._pending.update(intent_ids[start:])
+                        break
+                    batch = intent_ids[start:start + self.batch_size]
+                    self.last_batch_size = len(batch)
+                    await self.reconcile(batch)
+            except Exception as e:
+                logger.error("Payment reconciliation failed: %s", e)
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._wakeup = None
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "confirmed_total": self.confirmed_total,
+            "last_batch_size": self.last_batch_size,
+        }
+
+payment_reconciler = PaymentReconciler(
+    gateway=payment_gateway,
+    interval_seconds=settings.PAYMENT_RECONCILE_INTERVAL_SECONDS,
+    batch_size=settings.PAYMENT_RECONCILE_BATCH_SIZE,
+    stale_seconds=settings.PAYMENT_RECONCILE_STALE_SECONDS
+)
@@ -1,28 +1,139 @@
 from datetime import datetime
+from typing import Optional
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from models import Promocode, PromoCodeUse
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Order, PaymentAttempt, PaymentAttemptStatus, Promocode, PromoCodeUse
+from cache import cache, cache_key
+from sqlite_writer import run_write
+from payment_service import PaymentStatus
 from fastapi import HTTPException
+from config import get_settings
 
+settings = get_settings()
+
+def _promocode_key(code: str) -> str:
+    return cache_key("promocode", code)
+
+def _discounted(promocode: dict, order_total: float) -> float:
+    # Рассчитываем скидку
+    if promocode["discount_percent"]:
+        discount = order_total * (promocode["discount_percent"] / 100)
+    else:
+        discount = promocode["discount_amount"] or 0
+    return max(0, order_total - discount)
+
+# Карточка промокода кэшируется в локальном уровне и Redis на короткий TTL, включая отсутствующие коды.
+# Счетчик использований в кэш не попадает: лимит проверяет только условный UPDATE при погашении.
 class PromocodeService:
     @staticmethod
-    async def apply_promocode(code: str, order_total: float, db: Session) -> float:
-        promocode = db.query(Promocode).filter(
-            Promocode.code == code,
-            Promocode.is_active == True,
-            Promocode.valid_from <= datetime.utcnow(),
-            Promocode.valid_to >= datetime.utcnow()
-        ).first()
-        
-        if not promocode:
+    async def _load(db: AsyncSession, code: str) -> dict:
+        row = (await db.execute(
+            select(
+                Promocode.id, Promocode.discount_percent, Promocode.discount_amount, Promocode.valid_from,
+                Promocode.valid_to, Promocode.max_uses, Promocode.current_uses, Promocode.is_active
+            ).where(Promocode.code == code)
+        )).first()
+        if row is None:
+            return {"id": None}
+        return {
+            "id": row.id,
+            "discount_percent": row.discount_percent,
+            "discount_amount": row.discount_amount,
+            "valid_from": row.valid_from.isoformat(),
+            "valid_to": row.valid_to.isoformat(),
+            "is_active": bool(row.is_active),
+            "exhausted": bool(row.max_uses) and (row.current_uses or 0) >= row.max_uses,
+        }
+
+    @staticmethod
+    async def get_promocode(db: AsyncSession, code: str) -> dict:
+        promocode = await cache.get_or_load(
+            _promocode_key(code), lambda: PromocodeService._load(db, code), settings.PROMOCODE_CACHE_TTL_SECONDS
+        )
+        now = datetime.utcnow()
+        if (
+            promocode["id"] is None
+            or not promocode["is_active"]
+            or datetime.fromisoformat(promocode["valid_from"]) > now
+            or datetime.fromisoformat(promocode["valid_to"]) < now
+        ):
             raise HTTPException(status_code=404, detail="Промокод не найден или истек")
-            
-        if promocode.max_uses and promocode.current_uses >= promocode.max_uses:
+        if promocode["exhausted"]:
             raise HTTPException(status_code=400, detail="Промокод больше не действителен")
-        
-        # Рассчитываем скидку
-        if promocode.discount_percent:
-            discount = order_total * (promocode.discount_percent / 100)
-        else:
-            discount = promocode.discount_amount
-            
-        return max(0, order_total - discount) 
\ No newline at end of file
+        return promocode
+
+    @staticmethod
+    async def invalidate(code: str):
+        await cache.delete(_promocode_key(code))
+
+    @staticmethod
+    async def apply_promocode(code: str, order_total: float, db: AsyncSession) -> float:
+        # Предварительный расчет без записи: горячий код не обращается к БД
+        promocode = await PromocodeService.get_promocode(db, code)
+        return _discounted(promocode, order_total)
+
+    @staticmethod
+    def reserve(session: Session, promocode: dict, order_id: int) -> Optional[float]:
+        # Использование занимается одним условным UPDATE: параллельные погашения упираются
+        # в блокировку строки и не могут вывести current_uses за max_uses
+        order = session.execute(
+            select(Order.total_price, Order.payment_status).where(Order.id == order_id).with_for_update()
+        ).first()
+        if order is None:
+            return None
+        # Пока по заказу идет или прошел платеж, сумма меняться не должна
+        payment_started = session.execute(
+            select(PaymentAttempt.id).where(
+                PaymentAttempt.order_id == order_id,
+                PaymentAttempt.status.in_((
+                    PaymentAttemptStatus.PROCESSING.value,
+                    PaymentAttemptStatus.PENDING.value,
+                    PaymentAttemptStatus.SUCCEEDED.value,
+                ))
+            ).limit(1)
+        ).first()
+        if order.payment_status == PaymentStatus.COMPLETED or payment_started is not None:
+            raise HTTPException(status_code=409, detail="Промокод можно применить только к неоплаченному заказу")
+
+        now = datetime.utcnow()
+        table = Promocode.__table__
+        current_uses = func.coalesce(table.c.current_uses, 0)
+        try:
+            with session.begin_nested():
+                reserved = session.execute(
+                    update(table)
+                    .where(
+                        table.c.id == promocode["id"],
+                        table.c.is_active == True,
+                        table.c.valid_from <= now,
+                        table.c.valid_to >= now,
+                        or_(table.c.max_uses.is_(None), current_uses < table.c.max_uses)
+                    )
+                    .values(current_uses=current_uses + 1)
+                ).rowcount
+                if not reserved:
+                    raise HTTPException(status_code=400, detail="Промокод больше не действителен")
+                session.execute(PromoCodeUse.__table__.insert().values(
+                    promocode_id=promocode["id"], order_id=order_id, used_at=now
+                ))
+        except IntegrityError:
+            raise HTTPException(status_code=409, detail="К заказу уже применен промокод")
+
+        total_price = _discounted(promocode, order.total_price)
+        session.execute(
+            update(Order.__table__).where(Order.__table__.c.id == order_id).values(total_price=total_price)
+        )
+        return total_price
+
+    @staticmethod
+    async def redeem(db: AsyncSession, code: str, order_id: int) -> Optional[float]:
+        promocode = await PromocodeService.get_promocode(db, code)
+        try:
+            return await run_write(db, lambda session: PromocodeService.reserve(session, promocode, order_id))
+        except HTTPException as e:
+            if e.status_code == 400:
+                # Лимит исчерпан: перечитываем карточку, чтобы следующие попытки отсекались из кэша
+                await PromocodeService.invalidate(code)
+            raise
@@ -1,26 +1,154 @@
-from fastapi import HTTPException, Request
-from redis import Redis
+from fastapi import Request
+from metrics import instrumented_async_redis
+from auth import principal_cache, token_hash
+from collections import OrderedDict
 from config import get_settings
+from logger import logger
+from typing import Optional, Tuple
 import time
 
 settings = get_settings()
-redis_client = Redis.from_url(settings.REDIS_URL)
-
-async def rate_limit(request: Request):
-    client_ip = request.client.host
-    key = f"rate_limit:{client_ip}"
-    
-    # Получаем текущее количество запросов
-    requests = redis_client.get(key)
-    
-    if requests is None:
-        # Первый запрос
-        redis_client.setex(key, 60, 1)
-    else:
-        requests = int(requests)
-        if requests >= settings.RATE_LIMIT_PER_MINUTE:
-            raise HTTPException(
-                status_code=429,
-                detail="Too many requests"
-            )
-        redis_client.incr(key) 
\ No newline at end of file
+redis_client = instrumented_async_redis(settings.REDIS_URL, "rate_limiter")
+
+# Скользящее окно как взвешенная сумма текущего и предыдущего фиксированных окон.
+# Проверка и инкремент выполняются атомарно за один запрос к Redis.
+SLIDING_WINDOW_SCRIPT = redis_client.register_script("""
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+local limit = tonumber(ARGV[1])
+local weight = tonumber(ARGV[2])
+local estimated = previous * weight + current
+if estimated >= limit then
+    return {0, 0}
+end
+current = redis.call('INCR', KEYS[1])
+if current == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return {1, math.floor(limit - previous * weight - current)}
+""")
+
+TOKEN_BUCKET_SCRIPT = redis_client.register_script("""
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return {allowed, math.floor(tokens)}
+""")
+
+class RateLimitDecision:
+    __slots__ = ("allowed", "limit", "remaining", "retry_after")
+
+    def __init__(self, allowed: bool, limit: int, remaining: int, retry_after: int):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = max(remaining, 0)
+        self.retry_after = retry_after
+
+# Локальный token bucket на случай недоступности Redis: лимит соблюдается в пределах процесса
+class LocalTokenBucket:
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    def take(self, key: str, capacity: int, rate: float) -> Tuple[bool, int]:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(capacity), now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True, int(bucket[0])
+        return False, 0
+
+class RateLimiter:
+    def __init__(self, algorithm: str, limit: int, window_seconds: int, route_limits: dict,
+                 burst: Optional[int], redis_retry_seconds: float, local_max_keys: int):
+        self.algorithm = algorithm
+        self.limit = limit
+        self.window_seconds = window_seconds
+        # Самые длинные префиксы проверяются первыми
+        self.route_limits = sorted(route_limits.items(), key=lambda item: len(item[0]), reverse=True)
+        self.burst = burst
+        self.redis_retry_seconds = redis_retry_seconds
+        self.local = LocalTokenBucket(local_max_keys)
+        self._redis_down_until = 0.0
+
+    def _route(self, path: str) -> Tuple[str, int]:
+        for prefix, limit in self.route_limits:
+            if path.startswith(prefix):
+                return prefix, limit
+        return "*", self.limit
+
+    @staticmethod
+    def identity(request: Request) -> str:
+        authorization = request.headers.get("authorization")
+        if authorization and authorization.lower().startswith("bearer "):
+            # Ключ по пользователю только для уже проверенного токена (он есть в кэше принципалов).
+            # Непроверенный или случайный токен не дает отдельного счетчика — лимит по IP.
+            principal = principal_cache.peek(token_hash(authorization[7:]))
+            if principal is not None:
+                return f"user:{principal.id}"
+        return "ip:" + (request.client.host if request.client else "unknown")
+
+    async def check(self, request: Request) -> RateLimitDecision:
+        route, limit = self._route(request.url.path)
+        key = f"rate_limit:{route}:{self.identity(request)}"
+        capacity = self.burst or limit
+        rate = limit / self.window_seconds
+
+        if time.monotonic() >= self._redis_down_until:
+            try:
+                if self.algorithm == "token_bucket":
+                    allowed, remaining = await TOKEN_BUCKET_SCRIPT(
+                        keys=[key],
+                        args=[capacity, rate, time.time(), self.window_seconds * 2]
+                    )
+                    retry_after = 1 if allowed else max(int(1 / rate), 1)
+                    return RateLimitDecision(bool(allowed), capacity, int(remaining), retry_after)
+
+                now = time.time()
+                window = int(now // self.window_seconds)
+                weight = 1 - (now % self.window_seconds) / self.window_seconds
+                allowed, remaining = await SLIDING_WINDOW_SCRIPT(
+                    keys=[f"{key}:{window}", f"{key}:{window - 1}"],
+                    args=[limit, weight, self.window_seconds * 2]
+                )
+                retry_after = int(self.window_seconds - now % self.window_seconds) + 1
+                return RateLimitDecision(bool(allowed), limit, int(remaining), retry_after)
+            except Exception as e:
+                # Не дергаем Redis на каждом запросе, пока он недоступен
+                self._redis_down_until = time.monotonic() + self.redis_retry_seconds
+                logger.warning("Rate limiter falls back to local buckets: %s", e)
+
+        allowed, remaining = self.local.take(key, capacity, rate)
+        return RateLimitDecision(allowed, capacity, remaining, max(int(1 / rate), 1))
+
+rate_limiter = RateLimiter(
+    algorithm=settings.RATE_LIMIT_ALGORITHM,
+    limit=settings.RATE_LIMIT_PER_MINUTE,
+    window_seconds=settings.RATE_LIMIT_WINDOW_SECONDS,
+    route_limits=settings.RATE_LIMIT_ROUTE_LIMITS,
+    burst=settings.RATE_LIMIT_BURST,
+    redis_retry_seconds=settings.RATE_LIMIT_REDIS_RETRY_SECONDS,
+    local_max_keys=settings.RATE_LIMIT_LOCAL_MAX_KEYS
+)
+
+async def rate_limit(request: Request) -> RateLimitDecision:
+    return await rate_limiter.check(request)
@@ -0,0 +1,278 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+from sqlalchemy import bindparam, update
+from sqlalchemy.orm import Session
+from models import Order, OrderStatus
+from spatial_index import CourierSpatialIndex, courier_index, haversine_km
+from order_read_model import invalidate_orders
+from sqlite_writer import run_background_write
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+ROUTED_STATUSES = (OrderStatus.ASSIGNED_TO_COURIER, OrderStatus.IN_DELIVERY)
+
+class Stop:
+    __slots__ = ("order_id", "latitude", "longitude")
+
+    def __init__(self, order_id: int, latitude: float, longitude: float):
+        self.order_id = order_id
+        self.latitude = latitude
+        self.longitude = longitude
+
+class CourierRoute:
+    __slots__ = ("courier_id", "stops", "needs_reorder", "needs_eta")
+
+    def __init__(self, courier_id: int):
+        self.courier_id = courier_id
+        self.stops: List[Stop] = []
+        self.needs_reorder = False
+        self.needs_eta = True
+
+def nearest_neighbour_order(origin: Tuple[float, float], stops: List[Stop]) -> List[Stop]:
+    remaining = list(stops)
+    ordered = []
+    current = origin
+    while remaining:
+        best = min(remaining, key=lambda stop: haversine_km(*current, stop.latitude, stop.longitude))
+        remaining.remove(best)
+        ordered.append(best)
+        current = (best.latitude, best.longitude)
+    return ordered
+
+def two_opt(origin: Tuple[float, float], stops: List[Stop], max_passes: int = 3) -> List[Stop]:
+    # Маршрут открытый: начинается в точке курьера и заканчивается на последней остановке
+    route = list(stops)
+    n = len(route)
+    if n < 3:
+        return route
+
+    def point(index: int) -> Tuple[float, float]:
+        if index < 0:
+            return origin
+        return route[index].latitude, route[index].longitude
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(0, n - 1):
+            a, b = point(i - 1), point(i)
+            for j in range(i + 1, n):
+                c = point(j)
+                if j + 1 < n:
+                    d = point(j + 1)
+                    delta = (haversine_km(*a, *c) + haversine_km(*b, *d)
+                             - haversine_km(*a, *b) - haversine_km(*c, *d))
+                else:
+                    delta = haversine_km(*a, *c) - haversine_km(*a, *b)
+                if delta < -1e-9:
+                    route[i:j + 1] = reversed(route[i:j + 1])
+                    b = point(i)
+                    improved = True
+        if not improved:
+            break
+    return route
+
+def plan_route(origin: Tuple[float, float], stops: List[Stop], reorder: bool, now: datetime,
+               speed_kmh: float, stop_service_minutes: float) -> Tuple[List[Stop], List[Tuple[int, datetime]]]:
+    if reorder:
+        stops = two_opt(origin, nearest_neighbour_order(origin, stops))
+    hours_per_km = 1.0 / speed_kmh
+    elapsed = timedelta()
+    current = origin
+    etas = []
+    for stop in stops:
+        distance = haversine_km(*current, stop.latitude, stop.longitude)
+        elapsed += timedelta(hours=distance * hours_per_km)
+        etas.append((stop.order_id, now + elapsed))
+        elapsed += timedelta(minutes=stop_service_minutes)
+        current = (stop.latitude, stop.longitude)
+    return stops, etas
+
+# Планировщик многоточечных маршрутов и ETA.
+# Пересчет инкрементальный: GPS-фикс помечает маршрут курьера для пересчета ETA,
+# изменение набора остановок — для переупорядочивания; на каждом тике
+# обрабатываются только помеченные маршруты.
+# Состояние маршрутов меняется только на event loop; упорядочивание и ETA считаются
+# в пуле потоков по копиям, а результат для маршрута, остановки которого за это время поменялись, отбрасывается.
+class RoutePlanner:
+    def __init__(self, index: CourierSpatialIndex, speed_kmh: float, stop_service_minutes: float,
+                 tick_seconds: float, min_eta_change_seconds: float):
+        self.index = index
+        self.speed_kmh = speed_kmh
+        self.stop_service_minutes = stop_service_minutes
+        self.tick_seconds = tick_seconds
+        self.min_eta_change_seconds = min_eta_change_seconds
+        self.routes: Dict[int, CourierRoute] = {}
+        self._order_courier: Dict[int, int] = {}
+        self._dirty: Set[int] = set()
+        self._etas: Dict[int, datetime] = {}
+        self._pending_writes: Dict[int, datetime] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        self.last_tick_seconds = 0.0
+        self.last_tick_routes = 0
+
+    def _route(self, courier_id: int) -> CourierRoute:
+        route = self.routes.get(courier_id)
+        if route is None:
+            route = self.routes[courier_id] = CourierRoute(courier_id)
+        return route
+
+    def _mark(self, route: CourierRoute, reorder: bool = False):
+        route.needs_eta = True
+        route.needs_reorder = route.needs_reorder or reorder
+        self._dirty.add(route.courier_id)
+
+    def add_stop(self, courier_id: int, order_id: int, latitude: Optional[float], longitude: Optional[float]):
+        if latitude is None or longitude is None:
+            return
+        if self._order_courier.get(order_id) is not None:
+            self.remove_stop(order_id)
+        route = self._route(courier_id)
+        # Список остановок всегда заменяется целиком: по ссылке на него тик узнает, что маршрут поменялся
+        route.stops = route.stops + [Stop(order_id, latitude, longitude)]
+        self._order_courier[order_id] = courier_id
+        self._mark(route, reorder=True)
+
+    def remove_stop(self, order_id: int):
+        courier_id = self._order_courier.pop(order_id, None)
+        self._etas.pop(order_id, None)
+        self._pending_writes.pop(order_id, None)
+        if courier_id is None:
+            return
+        route = self.routes.get(courier_id)
+        if route is None:
+            return
+        # Удаление остановки не портит порядок оставшихся — достаточно пересчитать ETA
+        route.stops = [stop for stop in route.stops if stop.order_id != order_id]
+        if route.stops:
+            self._mark(route)
+        else:
+            del self.routes[courier_id]
+            self._dirty.discard(courier_id)
+
+    def on_location(self, courier_id: int):
+        route = self.routes.get(courier_id)
+        if route is not None:
+            self._mark(route)
+
+    def on_status(self, order_id: int, status: str):
+        if status in (OrderStatus.DELIVERED, OrderStatus.CANCELLED):
+            self.remove_stop(order_id)
+
+    def eta(self, order_id: int) -> Optional[datetime]:
+        return self._etas.get(order_id)
+
+    def _origin(self, route: CourierRoute) -> Optional[Tuple[float, float]]:
+        position = self.index.get(route.courier_id)
+        if position is None:
+            return None
+        return position.latitude, position.longitude
+
+    def _collect(self) -> Tuple[list, int]:
+        dirty, self._dirty = self._dirty, set()
+        jobs = []
+        for courier_id in dirty:
+            route = self.routes.get(courier_id)
+            if route is None or not route.needs_eta:
+                continue
+            origin = self._origin(route)
+            if origin is None:
+                # Без координат курьера считать ETA не от чего — ждем первый фикс
+                continue
+            jobs.append((route, route.stops, origin, route.needs_reorder))
+            route.needs_eta = route.needs_reorder = False
+        return jobs, len(dirty)
+
+    def _plan(self, jobs: list, now: datetime) -> list:
+        return [
+            plan_route(origin, stops, reorder, now, self.speed_kmh, self.stop_service_minutes)
+            for _, stops, origin, reorder in jobs
+        ]
+
+    def _apply(self, jobs: list, plans: list):
+        for (route, stops, _, reorder), (ordered, etas) in zip(jobs, plans):
+            if self.routes.get(route.courier_id) is not route or route.stops is not stops:
+                # Остановки поменялись, пока считался маршрут: пересчитаем его на следующем тике
+                if self.routes.get(route.courier_id) is route:
+                    self._mark(route, reorder=reorder)
+                continue
+            route.stops = ordered
+            for order_id, eta in etas:
+                previous = self._etas.get(order_id)
+                if previous is None or abs((eta - previous).total_seconds()) >= self.min_eta_change_seconds:
+                    self._etas[order_id] = eta
+                    self._pending_writes[order_id] = eta
+
+    async def tick(self, now: Optional[datetime] = None) -> int:
+        now = now or datetime.utcnow()
+        started = time.perf_counter()
+        jobs, dirty = self._collect()
+        if jobs:
+            plans = await asyncio.get_running_loop().run_in_executor(None, self._plan, jobs, now)
+            self._apply(jobs, plans)
+        self.last_tick_seconds = time.perf_counter() - started
+        self.last_tick_routes = dirty
+        return dirty
+
+    def take_pending_writes(self) -> Dict[int, datetime]:
+        pending, self._pending_writes = self._pending_writes, {}
+        return pending
+
+    def load(self, db: Session):
+        self.routes.clear()
+        self._order_courier.clear()
+        self._dirty.clear()
+        rows = db.query(Order.id, Order.courier_id, Order.delivery_latitude, Order.delivery_longitude).filter(
+            Order.status.in_(ROUTED_STATUSES),
+            Order.courier_id.isnot(None)
+        )
+        for order_id, courier_id, latitude, longitude in rows:
+            self.add_stop(courier_id, order_id, latitude, longitude)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.tick_seconds)
+            try:
+                await self.tick()
+                pending = self.take_pending_writes()
+                if pending:
+                    await run_background_write(lambda session: _write_etas(session, pending))
+                    await loop.run_in_executor(None, invalidate_orders, list(pending))
+            except Exception as e:
+                logger.error("Route planner tick failed: %s", e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+def _write_etas(db: Session, etas: Dict[int, datetime]):
+    table = Order.__table__
+    db.execute(
+        update(table)
+        .where(table.c.id == bindparam("order_id"))
+        .values(estimated_delivery_time=bindparam("eta")),
+        [{"order_id": order_id, "eta": eta} for order_id, eta in etas.items()]
+    )
+
+route_planner = RoutePlanner(
+    index=courier_index,
+    speed_kmh=settings.ROUTE_AVERAGE_SPEED_KMH,
+    stop_service_minutes=settings.ROUTE_STOP_SERVICE_MINUTES,
+    tick_seconds=settings.ROUTE_TICK_SECONDS,
+    min_eta_change_seconds=settings.ROUTE_MIN_ETA_CHANGE_SECONDS
+)
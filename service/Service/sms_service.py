@@ -1,21 +1,53 @@
-from twilio.rest import Client
+import asyncio
+from typing import Optional
 from config import get_settings
 from logger import logger
 
 settings = get_settings()
-client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+
+class TwilioSMSProvider:
+    def __init__(self, account_sid: Optional[str], auth_token: Optional[str], from_number: Optional[str]):
+        self.account_sid = account_sid
+        self.auth_token = auth_token
+        self.from_number = from_number
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            if not self.account_sid or not self.auth_token:
+                raise RuntimeError("Twilio credentials are not configured")
+            from twilio.rest import Client
+            self._client = Client(self.account_sid, self.auth_token)
+        return self._client
+
+    def send(self, phone_number: str, message: str) -> str:
+        # Блокирующий HTTP-вызов: выполнять только вне event loop
+        result = self._get_client().messages.create(
+            body=message,
+            from_=self.from_number,
+            to=phone_number
+        )
+        return result.sid
+
+def is_permanent_error(error: Exception) -> bool:
+    # Ошибки Twilio 4xx (неверный номер, запрет отправки) не исправятся повтором
+    status = getattr(error, "status", None)
+    return isinstance(status, int) and 400 <= status < 500 and status != 429
+
+sms_provider = TwilioSMSProvider(
+    account_sid=settings.TWILIO_ACCOUNT_SID,
+    auth_token=settings.TWILIO_AUTH_TOKEN,
+    from_number=settings.TWILIO_PHONE_NUMBER
+)
 
 class SMSService:
     @staticmethod
     async def send_sms(phone_number: str, message: str):
         try:
-            message = client.messages.create(
-                body=message,
-                from_=settings.TWILIO_PHONE_NUMBER,
-                to=phone_number
-            )
-            logger.info(f"SMS sent successfully: {message.sid}")
-            return message.sid
+            loop = asyncio.get_running_loop()
+            sid = await loop.run_in_executor(None, sms_provider.send, phone_number, message)
+            logger.info("SMS sent successfully: %s", sid)
+            return sid
         except Exception as e:
-            logger.error(f"Failed to send SMS: {str(e)}")
-            raise 
\ No newline at end of file
+            logger.error("Failed to send SMS: %s", e)
+            raise
\ No newline at end of file
@@ -0,0 +1,228 @@
+import heapq
+import math
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy.orm import Session
+from models import Courier, CourierLocation
+from sqlalchemy import func
+
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+class CourierPosition:
+    __slots__ = ("courier_id", "latitude", "longitude", "timestamp", "cell")
+
+    def __init__(self, courier_id: int, latitude: float, longitude: float, timestamp: datetime, cell: Tuple[int, int]):
+        self.courier_id = courier_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.timestamp = timestamp
+        self.cell = cell
+
+# Сеточный индекс последних координат курьеров.
+# Ячейка ~ cell_size_deg по широте и долготе; поиск идет кольцами от ячейки запроса.
+class CourierSpatialIndex:
+    def __init__(self, cell_size_deg: float = 0.01):
+        self.cell_size_deg = cell_size_deg
+        self._positions: Dict[int, CourierPosition] = {}
+        self._cells: Dict[Tuple[int, int], Set[int]] = {}
+        self._available: Set[int] = set()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return (int(math.floor(latitude / self.cell_size_deg)),
+                int(math.floor(longitude / self.cell_size_deg)))
+
+    def update(self, courier_id: int, latitude: float, longitude: float, timestamp: Optional[datetime] = None):
+        timestamp = timestamp or datetime.utcnow()
+        cell = self._cell(latitude, longitude)
+        position = self._positions.get(courier_id)
+        if position is not None:
+            # Старые фиксы, пришедшие не по порядку, не перетирают свежие
+            if position.timestamp > timestamp:
+                return
+            if position.cell != cell:
+                self._discard_from_cell(courier_id, position.cell)
+                self._cells.setdefault(cell, set()).add(courier_id)
+            position.latitude = latitude
+            position.longitude = longitude
+            position.timestamp = timestamp
+            position.cell = cell
+        else:
+            self._positions[courier_id] = CourierPosition(courier_id, latitude, longitude, timestamp, cell)
+            self._cells.setdefault(cell, set()).add(courier_id)
+
+    def remove(self, courier_id: int):
+        position = self._positions.pop(courier_id, None)
+        if position is not None:
+            self._discard_from_cell(courier_id, position.cell)
+        self._available.discard(courier_id)
+
+    def _discard_from_cell(self, courier_id: int, cell: Tuple[int, int]):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(courier_id)
+            if not members:
+                del self._cells[cell]
+
+    def set_available(self, courier_id: int, is_available: bool):
+        if is_available:
+            self._available.add(courier_id)
+        else:
+            self._available.discard(courier_id)
+
+    def sync_available(self, courier_ids):
+        self._available = set(courier_ids)
+
+    def is_available(self, courier_id: int) -> bool:
+        return courier_id in self._available
+
+    def get(self, courier_id: int) -> Optional[CourierPosition]:
+        return self._positions.get(courier_id)
+
+    def snapshot(self, courier_ids: Iterable[int]) -> "CourierSpatialIndex":
+        # Копия с указанными курьерами (все доступны) для поиска в пуле потоков:
+        # сам индекс меняется на event loop при каждой GPS-точке
+        copy = CourierSpatialIndex(self.cell_size_deg)
+        for courier_id in courier_ids:
+            position = self._positions.get(courier_id)
+            if position is None:
+                continue
+            copy._positions[courier_id] = CourierPosition(
+                courier_id, position.latitude, position.longitude, position.timestamp, position.cell
+            )
+            copy._cells.setdefault(position.cell, set()).add(courier_id)
+        copy._available = set(copy._positions)
+        return copy
+
+    def _ring_cells(self, cell: Tuple[int, int], ring: int):
+        row, col = cell
+        if ring == 0:
+            yield cell
+            return
+        # Обходим только границу кольца — внутренние ячейки уже просмотрены
+        for dc in range(-ring, ring + 1):
+            yield (row - ring, col + dc)
+            yield (row + ring, col + dc)
+        for dr in range(-ring + 1, ring):
+            yield (row + dr, col - ring)
+            yield (row + dr, col + ring)
+
+    def _candidates(self, cell: Tuple[int, int], ring: int, available_only: bool):
+        cells = self._cells
+        for key in self._ring_cells(cell, ring):
+            members = cells.get(key)
+            if not members:
+                continue
+            for courier_id in members:
+                if available_only and courier_id not in self._available:
+                    continue
+                yield self._positions[courier_id]
+
+    def _ring_distance_km(self, latitude: float, ring: int) -> float:
+        # Гарантированное минимальное расстояние до ячеек за пределами кольца
+        lat_km = ring * self.cell_size_deg * 111.32
+        lon_km = lat_km * max(math.cos(math.radians(min(abs(latitude) + ring * self.cell_size_deg, 89.9))), 0.0)
+        return min(lat_km, lon_km)
+
+    def _scan_is_cheaper(self, ring: int) -> bool:
+        # Если курьеры далеко, полный перебор дешевле обхода пустых колец;
+        # заодно это ограничивает число колец сверху
+        return (2 * ring + 1) ** 2 > 4 * len(self._positions)
+
+    def _all_candidates(self, available_only: bool):
+        for courier_id, position in self._positions.items():
+            if available_only and courier_id not in self._available:
+                continue
+            yield position
+
+    def nearest(self, latitude: float, longitude: float, k: int = 1,
+                available_only: bool = True, max_distance_km: Optional[float] = None) -> List[Tuple[int, float]]:
+        if k <= 0 or not self._positions:
+            return []
+        cell = self._cell(latitude, longitude)
+        heap: List[Tuple[float, int]] = []  # max-heap по расстоянию через отрицательные значения
+
+        def offer(position: CourierPosition):
+            distance = haversine_km(latitude, longitude, position.latitude, position.longitude)
+            if max_distance_km is not None and distance > max_distance_km:
+                return
+            if len(heap) < k:
+                heapq.heappush(heap, (-distance, position.courier_id))
+            elif distance < -heap[0][0]:
+                heapq.heapreplace(heap, (-distance, position.courier_id))
+
+        ring = 0
+        while True:
+            if self._scan_is_cheaper(ring):
+                heap.clear()
+                for position in self._all_candidates(available_only):
+                    offer(position)
+                break
+            for position in self._candidates(cell, ring, available_only):
+                offer(position)
+            bound = self._ring_distance_km(latitude, ring)
+            if len(heap) == k and -heap[0][0] <= bound:
+                break
+            if max_distance_km is not None and bound > max_distance_km:
+                break
+            ring += 1
+        return sorted(((courier_id, -neg) for neg, courier_id in heap), key=lambda item: item[1])
+
+    def within_radius(self, latitude: float, longitude: float, radius_km: float,
+                      available_only: bool = True) -> List[Tuple[int, float]]:
+        if not self._positions:
+            return []
+        cell = self._cell(latitude, longitude)
+        result = []
+        ring = 0
+        while True:
+            scan_all = self._scan_is_cheaper(ring)
+            if scan_all:
+                result = []
+                candidates = self._all_candidates(available_only)
+            else:
+                candidates = self._candidates(cell, ring, available_only)
+            for position in candidates:
+                distance = haversine_km(latitude, longitude, position.latitude, position.longitude)
+                if distance <= radius_km:
+                    result.append((position.courier_id, distance))
+            if scan_all or self._ring_distance_km(latitude, ring) > radius_km:
+                break
+            ring += 1
+        result.sort(key=lambda item: item[1])
+        return result
+
+    def load(self, db: Session):
+        # Первичное заполнение: доступность курьеров и их последняя известная точка
+        self._positions.clear()
+        self._cells.clear()
+        self._available = {
+            courier_id for courier_id, in db.query(Courier.id).filter(Courier.is_available == True)
+        }
+        latest = db.query(
+            CourierLocation.courier_id,
+            func.max(CourierLocation.timestamp).label("timestamp")
+        ).group_by(CourierLocation.courier_id).subquery()
+        rows = db.query(
+            CourierLocation.courier_id,
+            CourierLocation.latitude,
+            CourierLocation.longitude,
+            CourierLocation.timestamp
+        ).join(
+            latest,
+            (CourierLocation.courier_id == latest.c.courier_id)
+            & (CourierLocation.timestamp == latest.c.timestamp)
+        )
+        for courier_id, latitude, longitude, timestamp in rows:
+            self.update(courier_id, latitude, longitude, timestamp)
+
+courier_index = CourierSpatialIndex()
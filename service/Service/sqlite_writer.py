@@ -0,0 +1,188 @@
+import asyncio
+import queue
+import threading
+import time
+from typing import Callable, Optional
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import DATABASE_URL, SessionLocal, apply_sqlite_pragmas
+from config import get_settings
+from logger import logger
+
+settings = get_settings()
+
+_STOP = object()
+
+# Единственный писатель SQLite: все записи идут через один поток и одно соединение.
+# Задания из очереди собираются в пачку и фиксируются одним COMMIT (group commit);
+# каждое задание выполняется в своем SAVEPOINT, поэтому ошибка одного не откатывает остальные.
+class SQLiteWriter:
+    def __init__(self, url: str, batch_size: int, max_queue_size: int):
+        self.url = url
+        self.batch_size = batch_size
+        self.max_queue_size = max_queue_size
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._session_factory = None
+
+        self.jobs_total = 0
+        self.failed_total = 0
+        self.commits_total = 0
+        self.last_batch_size = 0
+        self.last_commit_seconds = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _create_session_factory(self):
+        engine = create_engine(
+            self.url,
+            poolclass=QueuePool,
+            pool_size=1,
+            max_overflow=0,
+            connect_args={"check_same_thread": False}
+        )
+
+        @event.listens_for(engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            apply_sqlite_pragmas(dbapi_connection, connection_record)
+            # Управляем транзакциями сами: иначе pysqlite ломает SAVEPOINT
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, "begin")
+        def on_begin(connection):
+            # Сразу берем блокировку записи, чтобы не получить SQLITE_BUSY посреди пачки
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+        return sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._session_factory = self._create_session_factory()
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._thread is None:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._queue.put, _STOP)
+        await loop.run_in_executor(None, self._thread.join)
+        self._thread = None
+
+    async def submit(self, fn: Callable[[Session], object]):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        job = (fn, future, loop)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            # Очередь переполнена — ждем места вне event loop
+            await loop.run_in_executor(None, self._queue.put, job)
+        return await future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            job = self._queue.get()
+            if job is _STOP:
+                break
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stopping = True
+                    break
+                batch.append(job)
+            self._execute_batch(batch)
+
+    def _execute_batch(self, batch):
+        started = time.perf_counter()
+        session = self._session_factory()
+        results = []
+        try:
+            for fn, future, loop in batch:
+                try:
+                    with session.begin_nested():
+                        results.append((future, loop, fn(session), None))
+                except Exception as e:
+                    results.append((future, loop, None, e))
+            session.commit()
+            self.commits_total += 1
+        except Exception as e:
+            session.rollback()
+            logger.error("SQLite writer commit failed for %d jobs: %s", len(batch), e)
+            results = [(future, loop, None, e) for future, loop, _, _ in results]
+        finally:
+            session.close()
+
+        for future, loop, result, error in results:
+            self.jobs_total += 1
+            if error is not None:
+                self.failed_total += 1
+            loop.call_soon_threadsafe(_resolve, future, result, error)
+        self.last_batch_size = len(batch)
+        self.last_commit_seconds = time.perf_counter() - started
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "jobs_total": self.jobs_total,
+            "failed_total": self.failed_total,
+            "commits_total": self.commits_total,
+            "last_batch_size": self.last_batch_size,
+            "last_commit_seconds": self.last_commit_seconds,
+        }
+
+def _resolve(future: asyncio.Future, result, error: Optional[Exception]):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+async def run_write(db: AsyncSession, fn: Callable[[Session], object]):
+    # В режиме SQLite запись уходит единственному писателю, иначе выполняется в сессии запроса
+    if sqlite_writer.running:
+        return await sqlite_writer.submit(fn)
+    result = await db.run_sync(fn)
+    await db.commit()
+    return result
+
+def _write_in_session(fn: Callable[[Session], object]):
+    db = SessionLocal()
+    try:
+        result = fn(db)
+        db.commit()
+        return result
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+async def run_background_write(fn: Callable[[Session], object]):
+    # Запись фоновых задач без сессии запроса: через писателя SQLite либо в отдельной сессии в пуле потоков.
+    # fn не фиксирует транзакцию сам — у писателя она общая на пачку заданий.
+    # Повторов здесь нет: ошибка уходит вызывающему, фоновые циклы повторяют запись на следующем проходе
+    if sqlite_writer.running:
+        return await sqlite_writer.submit(fn)
+    return await asyncio.get_running_loop().run_in_executor(None, _write_in_session, fn)
+
+sqlite_writer = SQLiteWriter(
+    url=DATABASE_URL,
+    batch_size=settings.SQLITE_WRITER_BATCH_SIZE,
+    max_queue_size=settings.SQLITE_WRITER_QUEUE_SIZE
+)
@@ -1,31 +1,73 @@
+import json
+from typing import List, Optional, Tuple
+import requests
 import stripe
+from requests.adapters import HTTPAdapter
+from payment_service import PaymentError
 from config import get_settings
 from logger import logger
 
 settings = get_settings()
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
+# Синхронный клиент Stripe: методы блокируют поток и вызываются только через PaymentGateway.
+# HTTP-соединения переиспользуются из пула requests, у каждого запроса есть таймаут.
 class StripePaymentProvider:
-    @staticmethod
-    async def create_payment_intent(amount: float, currency: str, order_id: str):
+    name = "stripe"
+
+    def __init__(self, timeout: float, pool_size: int, max_network_retries: int,
+                 webhook_secret: Optional[str]):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        stripe.default_http_client = stripe.http_client.RequestsClient(timeout=timeout, session=session)
+        stripe.max_network_retries = max_network_retries
+        self.webhook_secret = webhook_secret
+
+    def create_intent(self, amount: float, currency: str, order_id: int,
+                      payment_method: str, idempotency_key: str) -> Tuple[str, str, Optional[str]]:
+        # Платеж подтверждает клиент по client_secret: до этого намерение в requires_payment_method
         try:
             intent = stripe.PaymentIntent.create(
                 amount=int(amount * 100),  # Stripe использует центы
-                currency=currency,
-                metadata={'order_id': order_id},
-                automatic_payment_methods={'enabled': True}
+                currency=currency.lower(),
+                metadata={'order_id': str(order_id)},
+                automatic_payment_methods={'enabled': True},
+                idempotency_key=idempotency_key
             )
-            return intent.client_secret
-            
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe error: {str(e)}")
-            raise PaymentError(str(e), "STRIPE_ERROR")
+        except (stripe.error.CardError, stripe.error.InvalidRequestError) as e:
+            logger.error("Stripe rejected payment for order %s: %s", order_id, e, extra={"order_id": order_id})
+            raise PaymentError(str(e), "PAYMENT_DECLINED")
+        return intent.id, intent.status, intent.client_secret
+
+    def retrieve(self, intent_id: str) -> str:
+        return stripe.PaymentIntent.retrieve(intent_id).status
+
+    def client_secret(self, intent_id: str) -> Optional[str]:
+        return stripe.PaymentIntent.retrieve(intent_id).client_secret
+
+    def parse_webhook(self, payload: bytes, signature: Optional[str]) -> List[str]:
+        if self.webhook_secret:
+            try:
+                event = stripe.Webhook.construct_event(payload, signature, self.webhook_secret)
+            except (ValueError, stripe.error.SignatureVerificationError) as e:
+                raise PaymentError(str(e), "INVALID_WEBHOOK")
+        else:
+            event = json.loads(payload)
+        if not event.get("type", "").startswith("payment_intent."):
+            return []
+        return [event["data"]["object"]["id"]]
 
     @staticmethod
-    async def confirm_payment(payment_intent_id: str):
-        try:
-            intent = stripe.PaymentIntent.retrieve(payment_intent_id)
-            return intent.status == 'succeeded'
-        except stripe.error.StripeError as e:
-            logger.error(f"Stripe confirmation error: {str(e)}")
-            raise PaymentError(str(e), "STRIPE_ERROR") 
\ No newline at end of file
+    def is_transient(error: Exception) -> bool:
+        # В circuit breaker считаются только сбои связи и 5xx, а не отказы по карте
+        return isinstance(error, (stripe.error.APIConnectionError, stripe.error.RateLimitError)) or (
+            isinstance(error, stripe.error.StripeError) and (error.http_status or 500) >= 500
+        )
+
+stripe_provider = StripePaymentProvider(
+    timeout=settings.PAYMENT_PROVIDER_TIMEOUT_SECONDS,
+    pool_size=settings.PAYMENT_PROVIDER_POOL_SIZE,
+    max_network_retries=settings.PAYMENT_PROVIDER_MAX_RETRIES,
+    webhook_secret=settings.STRIPE_WEBHOOK_SECRET
+)
\ No newline at end of file
@@ -0,0 +1,79 @@
+import os
+import sys
+import tempfile
+
+# Настройки читаются при импорте модулей сервиса, поэтому окружение задается до них.
+# Нужен доступный Redis (REDIS_URL, по умолчанию локальная база 15 — она очищается).
+_workdir = tempfile.mkdtemp(prefix="delivery-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_workdir}/test.db")
+os.environ.setdefault("REDIS_URL", "redis://127.0.0.1:6379/15")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("REFRESH_TOKEN_EXPIRE_DAYS", "7")
+os.environ.setdefault("SMTP_SERVER", "127.0.0.1")
+os.environ.setdefault("SMTP_PORT", "2525")
+os.environ.setdefault("SMTP_USER", "test")
+os.environ.setdefault("SMTP_PASSWORD", "test")
+os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "100000")
+os.environ.setdefault("PAYMENT_PROVIDER", "stub")
+os.environ.setdefault("OUTBOX_ENABLED", "false")
+os.environ.setdefault("LOG_JSON", "false")
+os.chdir(_workdir)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import redis
+
+def _redis_available() -> bool:
+    try:
+        return redis.Redis.from_url(os.environ["REDIS_URL"]).ping()
+    except redis.RedisError:
+        return False
+
+if not _redis_available():
+    pytest.skip(f"Redis недоступен по {os.environ['REDIS_URL']}", allow_module_level=True)
+
+from fastapi.testclient import TestClient
+import main
+from auth import create_access_token, token_claims
+from database import SessionLocal, engine
+from models import Base, Customer, Order, User, UserRole
+
+@pytest.fixture
+def client():
+    Base.metadata.drop_all(bind=engine)
+    redis.Redis.from_url(os.environ["REDIS_URL"]).flushdb()
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+@pytest.fixture
+def make_user():
+    def create(email: str, role: UserRole = UserRole.CUSTOMER):
+        db = SessionLocal()
+        try:
+            user = User(email=email, password_hash="-", role=role.value)
+            db.add(user)
+            customer = None
+            if role == UserRole.CUSTOMER:
+                customer = Customer(name=email, address="ул. Ленина, 1", phone="+70000000000", email=email)
+                db.add(customer)
+            db.commit()
+            headers = {"Authorization": f"Bearer {create_access_token(token_claims(user))}"}
+            return user.id, customer.id if customer else None, headers
+        finally:
+            db.close()
+    return create
+
+@pytest.fixture
+def make_order():
+    def create(customer_id: int, total_price: float = 100.0, **values) -> int:
+        db = SessionLocal()
+        try:
+            order = Order(customer_id=customer_id, delivery_address="ул. Ленина, 1", total_price=total_price, **values)
+            db.add(order)
+            db.commit()
+            return order.id
+        finally:
+            db.close()
+    return create
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from jose import jwt
+from starlette.requests import Request
+from auth import create_access_token, create_refresh_token, invalidate_user, principal_cache
+from config import get_settings
+from database import SessionLocal
+from metrics import request_db_queries
+from models import User
+from rate_limiter import RateLimiter
+
+settings = get_settings()
+
+def create_login(email: str, password: str):
+    db = SessionLocal()
+    try:
+        user = User(email=email, role="customer")
+        user.set_password(password)
+        db.add(user)
+        db.commit()
+    finally:
+        db.close()
+
+def test_login_returns_token(client):
+    create_login("login@example.com", "secret-password")
+    response = client.post("/token", data={"username": "login@example.com", "password": "secret-password"})
+    assert response.status_code == 200
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    assert client.get("/notifications/unread-count", headers=headers).status_code == 200
+
+def test_login_rejects_bad_credentials(client):
+    create_login("wrong@example.com", "secret-password")
+    response = client.post("/token", data={"username": "wrong@example.com", "password": "nope"})
+    assert response.status_code == 401
+    response = client.post("/token", data={"username": "missing@example.com", "password": "nope"})
+    assert response.status_code == 401
+
+def test_rate_limit_key_ignores_unverified_tokens(client, make_user):
+    def identity(token: str) -> str:
+        return RateLimiter.identity(Request({
+            "type": "http",
+            "headers": [(b"authorization", f"Bearer {token}".encode())],
+            "client": ("10.0.0.1", 50000),
+        }))
+
+    assert identity("random-1") == identity("random-2") == "ip:10.0.0.1"
+    user_id, _, headers = make_user("limited@example.com")
+    token = headers["Authorization"][7:]
+    assert identity(token) == "ip:10.0.0.1"
+    assert client.get("/notifications/unread-count", headers=headers).status_code == 200
+    assert identity(token) == f"user:{user_id}"
+
+def fresh_worker_cache():
+    # Состояние нового воркера: в памяти процесса ничего нет, остается только Redis
+    principal_cache._entries.clear()
+    principal_cache._revoked.clear()
+    principal_cache._user_not_before.clear()
+
+def test_logout_is_visible_to_new_workers(client, make_user):
+    _, _, headers = make_user("logout@example.com")
+    assert client.get("/notifications/unread-count", headers=headers).status_code == 200
+    assert client.post("/logout", headers=headers).status_code == 200
+    fresh_worker_cache()
+    assert client.get("/notifications/unread-count", headers=headers).status_code == 401
+
+def test_user_invalidation_rejects_earlier_tokens(client, make_user):
+    user_id, _, headers = make_user("invalidated@example.com")
+    asyncio.get_event_loop().run_until_complete(invalidate_user(user_id))
+    fresh_worker_cache()
+    assert client.get("/notifications/unread-count", headers=headers).status_code == 401
+
+def test_tokens_are_signed_with_shared_key(client, make_user):
+    user_id, _, _ = make_user("shared-key@example.com")
+    # Токен, выпущенный другим воркером (или до перезапуска), подписан тем же ключом из настроек
+    foreign = jwt.encode(
+        {"sub": "shared-key@example.com", "uid": user_id, "role": "customer", "exp": int(time.time()) + 600,
+         "iat": int(time.time())},
+        settings.SECRET_KEY, algorithm=settings.ALGORITHM
+    )
+    assert client.get("/notifications/unread-count", headers={"Authorization": f"Bearer {foreign}"}).status_code == 200
+
+    refresh = create_refresh_token({"sub": "shared-key@example.com"})
+    assert client.get("/notifications/unread-count", headers={"Authorization": f"Bearer {refresh}"}).status_code == 401
+    response = client.post("/refresh-token", params={"refresh_token": refresh})
+    assert response.status_code == 200
+    assert client.post("/refresh-token", params={"refresh_token": response.json()["access_token"]}).status_code == 401
+
+def db_queries(route: str):
+    # (число запросов к маршруту, сумма запросов к БД по ним) из гистограммы http_request_db_queries
+    state = request_db_queries._values.get((route,))
+    return (state[2], state[1]) if state else (0, 0)
+
+def test_warm_authenticated_request_makes_no_db_queries(client, make_user):
+    make_user("warm@example.com")
+    # Токен старого формата без uid/role: холодный запрос один раз сверяется с БД
+    token = create_access_token({"sub": "warm@example.com"})
+    headers = {"Authorization": f"Bearer {token}"}
+    route = "/notifications/unread-count"
+
+    requests, queries = db_queries(route)
+    assert client.get(route, headers=headers).status_code == 200
+    cold_requests, cold_queries = db_queries(route)
+    assert cold_requests == requests + 1 and cold_queries > queries
+
+    for _ in range(3):
+        assert client.get(route, headers=headers).status_code == 200
+    assert db_queries(route) == (cold_requests + 3, cold_queries)
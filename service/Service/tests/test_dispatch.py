@@ -0,0 +1,118 @@
+import asyncio
+from courier_ratings import courier_ratings
+from database import SessionLocal
+from dispatch import DispatchEngine
+from models import Courier, Notification, Order, OrderStatus, UserRole
+from order_state_machine import order_events
+from spatial_index import CourierSpatialIndex, courier_index
+
+def make_engine(index: CourierSpatialIndex, candidates_per_order: int = 1) -> DispatchEngine:
+    return DispatchEngine(
+        index=index,
+        ratings=courier_ratings,
+        interval_seconds=3600,
+        batch_size=100,
+        candidates_per_order=candidates_per_order,
+        max_orders_per_courier=1,
+        max_distance_km=15.0,
+        rating_weight_km=0.0
+    )
+
+def test_match_skips_couriers_without_free_slots():
+    index = CourierSpatialIndex()
+    index.update(1, 55.750, 37.610)
+    index.update(2, 55.760, 37.620)
+    index.sync_available([1, 2])
+    engine = make_engine(index)
+    # Ближайший курьер занят: единственный кандидат должен быть из свободных
+    capacity = {2: 1}
+    assignments = engine.match(index.snapshot(capacity), [(10, 55.750, 37.610)], capacity)
+    assert [(order_id, courier_id) for order_id, courier_id, _ in assignments] == [(10, 2)]
+
+def test_snapshot_is_independent_of_live_updates():
+    index = CourierSpatialIndex()
+    index.update(1, 55.750, 37.610)
+    snapshot = index.snapshot([1])
+    index.update(1, 59.930, 30.360)
+    index.remove(1)
+    assert snapshot.nearest(55.750, 37.610, k=1)[0][0] == 1
+    assert snapshot.get(1).latitude == 55.750
+
+def test_availability_change_reaches_index(client, make_user):
+    user_id, _, headers = make_user("shift@example.com", UserRole.COURIER)
+    _, _, stranger = make_user("other-courier@example.com", UserRole.COURIER)
+    db = SessionLocal()
+    try:
+        courier = Courier(user_id=user_id, name="Курьер", phone="+70000000000", is_available=False)
+        db.add(courier)
+        db.commit()
+        courier_id = courier.id
+    finally:
+        db.close()
+    courier_index.update(courier_id, 55.750, 37.610)
+    assert courier_index.nearest(55.750, 37.610, k=1) == []
+    url = f"/couriers/{courier_id}/availability"
+    assert client.put(url, json={"is_available": True}, headers=stranger).status_code == 403
+    assert client.put(url, json={"is_available": True}, headers=headers).status_code == 200
+    assert courier_index.nearest(55.750, 37.610, k=1)[0][0] == courier_id
+    client.put(url, json={"is_available": False}, headers=headers)
+    assert courier_index.nearest(55.750, 37.610, k=1) == []
+    courier_index.remove(courier_id)
+
+def test_run_once_writes_assignments(client, make_user, make_order, monkeypatch):
+    courier_user, _, _ = make_user("dispatch-courier@example.com", UserRole.COURIER)
+    _, customer_id, _ = make_user("dispatch-customer@example.com")
+    order_id = make_order(customer_id, status=OrderStatus.PAID, delivery_latitude=55.751, delivery_longitude=37.611)
+    db = SessionLocal()
+    try:
+        courier = Courier(user_id=courier_user, name="Курьер", phone="+70000000000", is_available=True)
+        db.add(courier)
+        db.commit()
+        courier_id = courier.id
+    finally:
+        db.close()
+    index = CourierSpatialIndex()
+    index.update(courier_id, 55.750, 37.610)
+    received = []
+    monkeypatch.setattr(order_events, "_handlers", order_events._handlers + [(received.append, received.extend)])
+    assigned = asyncio.get_event_loop().run_until_complete(make_engine(index).run_once())
+    assert assigned == [(order_id, courier_id, 55.751, 37.611)]
+    (event,) = received
+    assert (event.order_id, event.status, event.courier_id, event.customer_id, event.version) == (
+        order_id, OrderStatus.ASSIGNED_TO_COURIER, courier_id, customer_id, 2
+    )
+    db = SessionLocal()
+    try:
+        order = db.get(Order, order_id)
+        assert (order.courier_id, order.status) == (courier_id, OrderStatus.ASSIGNED_TO_COURIER)
+        assert db.query(Notification).filter(Notification.user_id == courier_user).count() == 1
+    finally:
+        db.close()
+
+def test_assign_skips_orders_taken_after_load(client, make_user, make_order):
+    courier_user, _, _ = make_user("race-courier@example.com", UserRole.COURIER)
+    _, customer_id, _ = make_user("race-customer@example.com")
+    taken = make_order(customer_id, status=OrderStatus.PAID)
+    free = make_order(customer_id, status=OrderStatus.PAID)
+    db = SessionLocal()
+    try:
+        courier = Courier(user_id=courier_user, name="Курьер", phone="+70000000000", is_available=True)
+        manual = Courier(name="Другой курьер", phone="+70000000001", is_available=True)
+        db.add_all([courier, manual])
+        db.flush()
+        # Ручное назначение успело после load_batch, но до записи пачки
+        db.get(Order, taken).courier_id = manual.id
+        db.get(Order, taken).status = OrderStatus.ASSIGNED_TO_COURIER
+        db.flush()
+        couriers = {courier.id: courier_user}
+        contacts = {courier.id: ("+70000000000", "race-courier@example.com")}
+        assignments, _, events = make_engine(CourierSpatialIndex()).assign(
+            db, couriers, contacts, [(taken, courier.id, 0.1), (free, courier.id, 0.2)]
+        )
+        db.commit()
+        assert assignments == [(free, courier.id, 0.2)]
+        assert [event.order_id for event in events] == [free]
+        assert db.get(Order, taken).courier_id == manual.id
+        assert [n.order_id for n in db.query(Notification).filter(Notification.user_id == courier_user)] == [free]
+    finally:
+        db.close()
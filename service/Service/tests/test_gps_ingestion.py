@@ -0,0 +1,60 @@
+import asyncio
+from gps_ingestion import LocationIngestionBuffer
+
+def make_buffer(max_attempts: int = 3) -> LocationIngestionBuffer:
+    return LocationIngestionBuffer(
+        batch_size=10,
+        flush_interval=0.01,
+        max_queue_size=100,
+        max_attempts=max_attempts,
+        backoff_base=0.001,
+        backoff_max=0.01
+    )
+
+def run_buffer(buffer: LocationIngestionBuffer, points: int):
+    async def scenario():
+        buffer.start()
+        for _ in range(points):
+            await buffer.submit(1, 55.75, 37.61)
+        await buffer.stop()
+    asyncio.get_event_loop().run_until_complete(scenario())
+
+def test_failed_flush_is_retried():
+    buffer = make_buffer()
+    written, failures = [], [RuntimeError("database is locked")] * 2
+
+    async def write(rows):
+        if failures:
+            raise failures.pop()
+        written.extend(rows)
+
+    buffer._write = write
+    run_buffer(buffer, 5)
+    assert len(written) == 5
+    assert buffer.stats()["retried_total"] == 2
+    assert buffer.stats()["failed_total"] == 0
+
+def test_batch_is_dropped_after_last_attempt():
+    buffer = make_buffer(max_attempts=2)
+
+    async def write(rows):
+        raise RuntimeError("database is down")
+
+    buffer._write = write
+    run_buffer(buffer, 3)
+    assert buffer.stats()["failed_total"] == 3
+    assert buffer.stats()["flushed_total"] == 0
+
+def test_stop_detaches_queue():
+    buffer = make_buffer()
+    written = []
+
+    async def write(rows):
+        written.extend(rows)
+
+    buffer._write = write
+    run_buffer(buffer, 1)
+    assert buffer._queue is None
+    # После остановки точки пишутся напрямую, а не в очередь, которую никто не читает
+    asyncio.get_event_loop().run_until_complete(buffer.submit(1, 55.75, 37.61))
+    assert len(written) == 2
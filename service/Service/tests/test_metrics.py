@@ -0,0 +1,6 @@
+def test_metrics_endpoint_is_not_rate_limited(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "X-RateLimit-Limit" not in response.headers
+    assert "delivery_http_requests_total" in response.text
@@ -0,0 +1,46 @@
+from sqlalchemy import create_engine, inspect, text
+from migrations import migrate
+from models import Base
+
+# Таблицы в том виде, в каком они были до счетчиков, координат, версий и уникальных ограничений
+OLD_SCHEMA = (
+    "CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR(100) NOT NULL UNIQUE, "
+    "password_hash VARCHAR(200) NOT NULL, role VARCHAR(20) NOT NULL)",
+    "CREATE TABLE orders (id INTEGER PRIMARY KEY, customer_id INTEGER, courier_id INTEGER, status VARCHAR(50), "
+    "created_at DATETIME, delivery_address VARCHAR(200) NOT NULL, total_price FLOAT NOT NULL, "
+    "payment_status VARCHAR(50), payment_id VARCHAR(100), estimated_delivery_time DATETIME, "
+    "actual_delivery_time DATETIME)",
+    "CREATE TABLE notifications (id INTEGER PRIMARY KEY, user_id INTEGER, order_id INTEGER, type VARCHAR(50) NOT NULL, "
+    "message VARCHAR(500) NOT NULL, created_at DATETIME, is_read BOOLEAN)",
+    "CREATE INDEX idx_user_notifications ON notifications (user_id, created_at)",
+    "CREATE TABLE reviews (id INTEGER PRIMARY KEY, order_id INTEGER, customer_id INTEGER, courier_id INTEGER, "
+    "rating INTEGER NOT NULL, comment VARCHAR(500), created_at DATETIME)",
+    "CREATE TABLE promocode_uses (id INTEGER PRIMARY KEY, promocode_id INTEGER, order_id INTEGER, used_at DATETIME)",
+)
+
+def test_migrate_upgrades_existing_tables(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    with engine.begin() as conn:
+        for statement in OLD_SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO users (id, email, password_hash, role) VALUES (1, 'a@example.com', '-', 'customer')"))
+        conn.execute(text("INSERT INTO orders (id, delivery_address, total_price) VALUES (1, 'ул. Ленина', 100)"))
+        for is_read in (0, 0, 1):
+            conn.execute(text(
+                "INSERT INTO notifications (user_id, type, message, is_read) VALUES (1, 'info', 'Привет', :is_read)"
+            ), {"is_read": is_read})
+
+    Base.metadata.create_all(bind=engine)
+    migrate(engine)
+    migrate(engine)
+
+    inspector = inspect(engine)
+    assert {"delivery_latitude", "delivery_longitude", "version"} <= {c["name"] for c in inspector.get_columns("orders")}
+    indexes = {index["name"]: index for index in inspector.get_indexes("notifications")}
+    assert indexes["idx_user_notifications"]["column_names"] == ["user_id", "created_at", "id"]
+    assert any(index["name"] == "idx_orders_created_at" for index in inspector.get_indexes("orders"))
+    for table, name in (("reviews", "uq_review_order"), ("promocode_uses", "uq_promocode_use_order")):
+        assert [index["unique"] for index in inspector.get_indexes(table) if index["name"] == name] == [1]
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT unread_notifications FROM users WHERE id = 1")).scalar() == 2
+        assert conn.execute(text("SELECT version FROM orders WHERE id = 1")).scalar() == 1
@@ -0,0 +1,62 @@
+import asyncio
+from cache import redis_client
+from database import AsyncSessionLocal, SessionLocal
+from models import User
+from notification_hub import NotificationHub
+from notification_service import NotificationService, _FILL_SCRIPT, _unread_key, _unread_version_key
+
+def unread_count(user_id: int) -> int:
+    async def read():
+        async with AsyncSessionLocal() as db:
+            return await NotificationService.get_unread_count(db, user_id)
+    return asyncio.get_event_loop().run_until_complete(read())
+
+def set_counter(user_id: int, value: int):
+    db = SessionLocal()
+    try:
+        db.query(User).filter(User.id == user_id).update({"unread_notifications": value})
+        db.commit()
+    finally:
+        db.close()
+
+def test_unread_counter_is_refreshed_after_change(client, make_user):
+    user_id, _, _ = make_user("unread@example.com")
+    assert unread_count(user_id) == 0
+    assert redis_client.get(_unread_key(user_id)) == b"0"
+    set_counter(user_id, 2)
+    NotificationService.adjust_cached({user_id: 2})
+    assert redis_client.get(_unread_key(user_id)) is None
+    assert unread_count(user_id) == 2
+
+def test_stale_fill_is_rejected(client, make_user):
+    user_id, _, _ = make_user("stale@example.com")
+    # Промах прочитал версию и значение из БД, а до прогрева счетчик успели изменить
+    version = redis_client.get(_unread_version_key(user_id))
+    NotificationService.adjust_cached({user_id: 1})
+    filled = asyncio.get_event_loop().run_until_complete(_FILL_SCRIPT(
+        keys=[_unread_key(user_id), _unread_version_key(user_id)],
+        args=[version.decode() if version else "0", 0, 60]
+    ))
+    assert filled == 0
+    assert redis_client.get(_unread_key(user_id)) is None
+
+async def start(hub: NotificationHub):
+    hub.start()
+
+def test_publish_threadsafe_after_stop_is_dropped():
+    hub = NotificationHub(redis=None, queue_size=4, bridge_enabled=False)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(start(hub))
+        subscription = hub.subscribe(1)
+        hub.publish_threadsafe([(1, {"message": "first"})])
+        loop.run_until_complete(asyncio.sleep(0.01))
+        assert len(subscription.messages) == 1
+        loop.run_until_complete(hub.stop())
+        hub.publish_threadsafe([(1, {"message": "second"})])
+    finally:
+        loop.close()
+    # Хаб запущен на уже закрытом loop: событие отбрасывается без исключения
+    hub._loop = loop
+    hub.publish_threadsafe([(1, {"message": "third"})])
+    assert len(subscription.messages) == 1
@@ -0,0 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from database import SessionLocal
+from models import Courier, Notification, Order, OrderStatus, TrackingUpdate, UserRole
+from order_state_machine import OrderStateMachine, TransitionRejected
+from sqlite_writer import sqlite_writer
+
+def test_order_view_requires_participant(client, make_user, make_order):
+    _, customer_id, headers = make_user("viewer@example.com")
+    _, _, stranger = make_user("stranger@example.com")
+    order_id = make_order(customer_id)
+    assert client.get(f"/orders/{order_id}").status_code == 401
+    assert client.get(f"/orders/{order_id}", headers=stranger).status_code == 403
+    response = client.get(f"/orders/{order_id}", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["customer"]["phone"] == "+70000000000"
+
+def test_admin_writes_go_through_single_writer(client, make_user, make_order):
+    _, _, admin = make_user("admin@example.com", UserRole.ADMIN)
+    courier_user, _, _ = make_user("manual-courier@example.com", UserRole.COURIER)
+    jobs = sqlite_writer.jobs_total
+
+    response = client.post("/customers/", json={
+        "name": "Клиент", "address": "ул. Ленина, 2", "phone": "+70000000002", "email": "new-client@example.com"
+    })
+    assert response.status_code == 200
+    customer_id = response.json()["id"]
+    response = client.post("/admin/promocodes", headers=admin, json={
+        "code": "WRITER10", "discount_percent": 10, "valid_from": "2024-01-01T00:00:00", "valid_to": "2099-01-01T00:00:00"
+    })
+    assert response.status_code == 200
+
+    order_id = make_order(customer_id, status=OrderStatus.PAID)
+    db = SessionLocal()
+    try:
+        courier = Courier(user_id=courier_user, name="Курьер", phone="+70000000000", is_available=True)
+        db.add(courier)
+        db.commit()
+        courier_id = courier.id
+    finally:
+        db.close()
+    response = client.post(f"/orders/{order_id}/assign-courier", params={"courier_id": courier_id}, headers=admin)
+    assert response.json() == {"status": "success", "courier_id": courier_id}
+    assert sqlite_writer.jobs_total == jobs + 3
+    db = SessionLocal()
+    try:
+        order = db.get(Order, order_id)
+        assert (order.courier_id, order.status, order.version) == (courier_id, OrderStatus.ASSIGNED_TO_COURIER, 2)
+        assert db.query(Notification).filter(Notification.user_id == courier_user).count() == 1
+    finally:
+        db.close()
+
+def test_concurrent_transitions_lose_no_updates(client, make_user, make_order):
+    _, customer_id, _ = make_user("contended@example.com")
+    order_ids = [make_order(customer_id, status=OrderStatus.PAID) for _ in range(5)]
+    path = [OrderStatus.PREPARING, OrderStatus.ASSIGNED_TO_COURIER, OrderStatus.IN_DELIVERY, OrderStatus.DELIVERED]
+    accepted = []
+
+    def transition(index: int):
+        # Каждый заказ получает каждый переход пути четырежды, с отдельных потоков и сессий
+        order_id = order_ids[index % len(order_ids)]
+        status = path[index // (len(order_ids) * 4) % len(path)]
+        db = SessionLocal()
+        try:
+            event = OrderStateMachine.transition(db, order_id, status, "склад")
+            db.commit()
+            accepted.append((order_id, event.version, event.status))
+        except TransitionRejected:
+            db.rollback()
+        finally:
+            db.close()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(transition, range(len(order_ids) * 4 * len(path))))
+
+    db = SessionLocal()
+    try:
+        for order_id in order_ids:
+            chain = sorted((version, status) for accepted_id, version, status in accepted if accepted_id == order_id)
+            order = db.get(Order, order_id)
+            tracking = db.query(TrackingUpdate).filter(TrackingUpdate.order_id == order_id).count()
+            assert [version for version, _ in chain] == list(range(2, 2 + len(chain)))
+            assert (order.version, tracking) == (1 + len(chain), len(chain))
+            assert chain and order.status == chain[-1][1]
+    finally:
+        db.close()
@@ -0,0 +1,157 @@
+import asyncio
+import socketserver
+import threading
+from email import message_from_bytes, policy
+import pytest
+import email_service
+import sms_service
+from database import SessionLocal
+from email_service import SMTPSessionPool
+from models import Customer, Notification, NotificationOutbox, Order, OutboxStatus, UserRole
+from notification_outbox import notification_outbox
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    # Минимальный SMTP-сервер: принимает письма в server.messages, адреса bounce@ отклоняет навсегда
+    def reply(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost ready")
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().strip()
+            command = line[:4].upper()
+            if not line or command == "QUIT":
+                self.reply("221 bye")
+                return
+            if command in ("EHLO", "HELO"):
+                self.reply("250 localhost")
+            elif command == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif command == "RCPT":
+                if "bounce@" in line:
+                    self.reply("550 mailbox unavailable")
+                else:
+                    recipients.append(line.split(":", 1)[1].strip(" <>"))
+                    self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 end with .")
+                data = []
+                while True:
+                    chunk = self.rfile.readline()
+                    if chunk in (b".\r\n", b""):
+                        break
+                    data.append(chunk)
+                self.server.messages.append((recipients, message_from_bytes(b"".join(data), policy=policy.default)))
+                self.server.connections.add(id(self.request))
+                self.reply("250 queued")
+            else:
+                self.reply("250 OK")
+
+class FakeSMSError(Exception):
+    def __init__(self, status: int):
+        super().__init__(f"SMS provider returned {status}")
+        self.status = status
+
+class FakeSMSProvider:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, phone_number: str, message: str) -> str:
+        if phone_number.endswith("000"):
+            raise FakeSMSError(400)
+        self.sent.append((phone_number, message))
+        return f"SM{len(self.sent)}"
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPHandler)
+    server.daemon_threads = True
+    server.messages, server.connections = [], set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def channels(smtp_server, monkeypatch):
+    pool = SMTPSessionPool(host="127.0.0.1", port=smtp_server.server_address[1], user="", password="",
+                           use_tls=False, timeout=5, size=2, max_messages=100, idle_seconds=60)
+    provider = FakeSMSProvider()
+    monkeypatch.setattr(email_service, "smtp_pool", pool)
+    monkeypatch.setattr(sms_service, "sms_provider", provider)
+    yield pool, provider
+    pool.close()
+
+def test_smtp_pool_reuses_session(smtp_server):
+    pool = SMTPSessionPool(host="127.0.0.1", port=smtp_server.server_address[1], user="", password="",
+                           use_tls=False, timeout=5, size=1, max_messages=100, idle_seconds=60)
+    try:
+        for i in range(3):
+            pool.send(email_service.build_message("client@example.com", f"Письмо {i}", "текст"))
+    finally:
+        pool.close()
+    assert [recipients for recipients, _ in smtp_server.messages] == [["client@example.com"]] * 3
+    assert pool.stats()["connects_total"] == 1
+    assert len(smtp_server.connections) == 1
+
+def outbox_rows_for(order_id: int):
+    db = SessionLocal()
+    try:
+        rows = db.query(NotificationOutbox).filter(NotificationOutbox.order_id == order_id)
+        return sorted((row.channel, row.recipient, row.status) for row in rows)
+    finally:
+        db.close()
+
+def test_status_update_is_delivered_by_email_and_sms(client, make_user, make_order, channels, smtp_server):
+    _, provider = channels
+    _, customer_id, _ = make_user("client@example.com")
+    _, _, courier = make_user("status-courier@example.com", UserRole.COURIER)
+    order_id = make_order(customer_id)
+    response = client.post(f"/orders/{order_id}/tracking", params={"location": "склад", "status": "cancelled"},
+                           headers=courier)
+    assert response.status_code == 200
+
+    assert asyncio.get_event_loop().run_until_complete(notification_outbox.run_once()) == 2
+    assert outbox_rows_for(order_id) == [
+        ("email", "client@example.com", OutboxStatus.SENT.value),
+        ("sms", "+70000000000", OutboxStatus.DEAD.value),
+    ]
+    (recipients, message), = smtp_server.messages
+    assert recipients == ["client@example.com"]
+    assert message["Subject"] == "Статус заказа"
+    assert provider.sent == []
+
+def test_guest_customer_gets_no_in_app_notification(client, make_user, channels, smtp_server):
+    _, provider = channels
+    _, _, courier = make_user("guest-courier@example.com", UserRole.COURIER)
+    db = SessionLocal()
+    try:
+        # Клиент без учетной записи: сопоставить e-mail с пользователем не получится
+        customer = Customer(name="Гость", address="ул. Ленина, 1", phone="+79001234567", email="bounce@example.com")
+        db.add(customer)
+        db.flush()
+        order = Order(customer_id=customer.id, delivery_address="ул. Ленина, 1", total_price=100.0)
+        db.add(order)
+        db.commit()
+        order_id = order.id
+    finally:
+        db.close()
+    response = client.post(f"/orders/{order_id}/tracking", params={"location": "склад", "status": "cancelled"},
+                           headers=courier)
+    assert response.status_code == 200
+
+    db = SessionLocal()
+    try:
+        assert db.query(Notification).filter(Notification.order_id == order_id).count() == 0
+    finally:
+        db.close()
+    asyncio.get_event_loop().run_until_complete(notification_outbox.run_once())
+    assert outbox_rows_for(order_id) == [
+        ("email", "bounce@example.com", OutboxStatus.DEAD.value),
+        ("sms", "+79001234567", OutboxStatus.SENT.value),
+    ]
+    assert smtp_server.messages == []
+    assert provider.sent == [("+79001234567", f"Статус заказа #{order_id}: cancelled")]
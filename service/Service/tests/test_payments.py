@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import stripe
+from database import SessionLocal
+from models import Order, PaymentAttempt
+from payment_service import CircuitBreaker, PaymentGateway, StubPaymentProvider, payment_gateway, payment_reconciler
+from stripe_provider import stripe_provider
+
+def pay(client, order_id: int, headers: dict, payment_method: str = "card", key: str = None, **extra):
+    if key:
+        headers = {**headers, "Idempotency-Key": key}
+    return client.post(
+        f"/orders/{order_id}/pay",
+        json={"order_id": order_id, "payment_method": payment_method, **extra},
+        headers=headers
+    )
+
+def order_payment(order_id: int):
+    db = SessionLocal()
+    try:
+        order = db.get(Order, order_id)
+        attempts = db.query(PaymentAttempt).filter(PaymentAttempt.order_id == order_id).all()
+        return order.payment_status, [(attempt.status, attempt.amount) for attempt in attempts]
+    finally:
+        db.close()
+
+def test_payment_charges_order_total(client, make_user, make_order):
+    _, customer_id, headers = make_user("payer@example.com")
+    order_id = make_order(customer_id, total_price=250.0)
+    response = pay(client, order_id, headers, amount=1.0)
+    assert response.status_code == 200
+    assert response.json()["status"] == "completed"
+    assert order_payment(order_id) == ("completed", [("succeeded", 250.0)])
+
+def test_payment_rejects_foreign_order(client, make_user, make_order):
+    _, customer_id, _ = make_user("owner@example.com")
+    _, _, stranger = make_user("stranger@example.com")
+    order_id = make_order(customer_id)
+    assert pay(client, order_id, stranger).status_code == 403
+    assert pay(client, 10 ** 6, stranger).status_code == 404
+    assert order_payment(order_id) == ("pending", [])
+
+def test_payment_retry_is_idempotent(client, make_user, make_order):
+    _, customer_id, headers = make_user("retry@example.com")
+    order_id = make_order(customer_id)
+    charges = payment_gateway.provider.charges_total
+    first = pay(client, order_id, headers, key="retry").json()
+    second = pay(client, order_id, headers, key="retry").json()
+    assert first == second
+    assert payment_gateway.provider.charges_total == charges + 1
+
+def test_delayed_payment_is_confirmed_by_reconciler(client, make_user, make_order):
+    _, customer_id, headers = make_user("delayed@example.com")
+    order_id = make_order(customer_id, total_price=80.0)
+    response = pay(client, order_id, headers, payment_method="delayed", key="delayed")
+    assert response.json()["status"] == "pending"
+    confirmed = asyncio.get_event_loop().run_until_complete(payment_reconciler.reconcile([response.json()["payment_id"]]))
+    assert confirmed == 1
+    assert order_payment(order_id) == ("completed", [("succeeded", 80.0)])
+
+def test_stripe_intent_awaiting_confirmation_stays_pending(client, make_user, make_order, monkeypatch):
+    created = []
+
+    def create(**params):
+        created.append(params)
+        return stripe.PaymentIntent.construct_from({
+            "id": "pi_test_1", "object": "payment_intent", "status": "requires_payment_method",
+            "client_secret": "pi_test_1_secret_abc", "amount": params["amount"], "currency": params["currency"]
+        }, "sk_test")
+
+    def retrieve(intent_id):
+        return stripe.PaymentIntent.construct_from({
+            "id": intent_id, "object": "payment_intent", "status": "requires_action",
+            "client_secret": "pi_test_1_secret_abc"
+        }, "sk_test")
+
+    monkeypatch.setattr(stripe.PaymentIntent, "create", create)
+    monkeypatch.setattr(stripe.PaymentIntent, "retrieve", retrieve)
+    monkeypatch.setattr(payment_gateway, "provider", stripe_provider)
+    _, customer_id, headers = make_user("stripe@example.com")
+    order_id = make_order(customer_id, total_price=120.0)
+
+    expected = {"status": "pending", "payment_id": "pi_test_1", "client_secret": "pi_test_1_secret_abc"}
+    assert pay(client, order_id, headers, key="stripe").json() == expected
+    assert created[0]["amount"] == 12000
+    assert order_payment(order_id) == ("pending", [("pending", 120.0)])
+    # Повтор с тем же ключом отдает client_secret, не создавая второе намерение
+    assert pay(client, order_id, headers, key="stripe").json() == expected
+    assert len(created) == 1
+    assert asyncio.get_event_loop().run_until_complete(payment_reconciler.reconcile(["pi_test_1"])) == 0
+    assert order_payment(order_id) == ("pending", [("pending", 120.0)])
+
+def test_payment_without_key_can_be_retried_after_decline(client, make_user, make_order):
+    _, customer_id, headers = make_user("declined@example.com")
+    order_id = make_order(customer_id, total_price=0.0)
+    assert pay(client, order_id, headers).status_code == 400
+    assert order_payment(order_id) == ("failed", [("failed", 0.0)])
+    db = SessionLocal()
+    try:
+        db.get(Order, order_id).total_price = 90.0
+        db.commit()
+    finally:
+        db.close()
+    response = pay(client, order_id, headers)
+    assert response.json()["status"] == "completed"
+    assert order_payment(order_id) == ("completed", [("failed", 0.0), ("succeeded", 90.0)])
+    # Повтор уже после успеха не проводит платеж заново
+    assert pay(client, order_id, headers).json() == {"status": "completed", "payment_id": response.json()["payment_id"]}
+
+def test_cancelled_half_open_probe_releases_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    gateway = PaymentGateway(provider=StubPaymentProvider(), pool_size=1, timeout=5, breaker=breaker)
+    breaker.record_failure()
+    release = threading.Event()
+
+    async def scenario():
+        probe = asyncio.ensure_future(gateway.call(release.wait))
+        await asyncio.sleep(0.05)
+        assert breaker.state == "half_open"
+        probe.cancel()
+        try:
+            await probe
+        except asyncio.CancelledError:
+            pass
+        release.set()
+        return await gateway.call(lambda: "ok")
+
+    try:
+        assert asyncio.get_event_loop().run_until_complete(scenario()) == "ok"
+        assert breaker.state == "closed"
+    finally:
+        gateway.shutdown()
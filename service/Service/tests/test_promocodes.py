@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from fastapi import HTTPException
+from database import AsyncSessionLocal, SessionLocal
+from models import PaymentAttempt, Promocode, PromoCodeUse
+from promocode_service import PromocodeService
+
+def create_promocode(code: str, max_uses=None, discount_percent=10.0) -> int:
+    db = SessionLocal()
+    try:
+        promocode = Promocode(
+            code=code, discount_percent=discount_percent, max_uses=max_uses, current_uses=0,
+            valid_from=datetime.utcnow() - timedelta(days=1), valid_to=datetime.utcnow() + timedelta(days=1)
+        )
+        db.add(promocode)
+        db.commit()
+        return promocode.id
+    finally:
+        db.close()
+
+def test_parallel_redemptions_do_not_overshoot_limit(client, make_user, make_order):
+    _, customer_id, _ = make_user("buyer@example.com")
+    order_ids = [make_order(customer_id) for _ in range(1000)]
+    promocode_id = create_promocode("RUSH100", max_uses=100)
+
+    async def redeem(order_id: int) -> bool:
+        async with AsyncSessionLocal() as db:
+            try:
+                await PromocodeService.redeem(db, "RUSH100", order_id)
+                return True
+            except HTTPException:
+                return False
+
+    async def run_all():
+        # Первое погашение прогревает карточку промокода, дальше 999 параллельных
+        first = await redeem(order_ids[0])
+        return [first] + await asyncio.gather(*(redeem(order_id) for order_id in order_ids[1:]))
+
+    # TestClient исполняет приложение (и писатель SQLite) в текущем цикле событий
+    results = asyncio.get_event_loop().run_until_complete(run_all())
+
+    db = SessionLocal()
+    try:
+        assert sum(results) == 100
+        assert db.get(Promocode, promocode_id).current_uses == 100
+        assert db.execute(select(func.count()).select_from(PromoCodeUse)).scalar() == 100
+    finally:
+        db.close()
+
+def test_promocode_requires_order_owner(client, make_user, make_order):
+    _, customer_id, _ = make_user("owner@example.com")
+    _, _, stranger = make_user("stranger@example.com")
+    order_id = make_order(customer_id)
+    create_promocode("OWNER10")
+
+    response = client.post(f"/orders/{order_id}/promocode", params={"code": "OWNER10"}, headers=stranger)
+    assert response.status_code == 403
+
+def test_one_promocode_per_order(client, make_user, make_order):
+    _, customer_id, headers = make_user("stack@example.com")
+    order_id = make_order(customer_id, total_price=100.0)
+    create_promocode("FIRST10")
+    create_promocode("SECOND10")
+
+    response = client.post(f"/orders/{order_id}/promocode", params={"code": "FIRST10"}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["total_price"] == 90.0
+    response = client.post(f"/orders/{order_id}/promocode", params={"code": "SECOND10"}, headers=headers)
+    assert response.status_code == 409
+
+def test_promocode_rejected_once_payment_started(client, make_user, make_order):
+    _, customer_id, headers = make_user("paid@example.com")
+    paid_order = make_order(customer_id, payment_status="completed")
+    processing_order = make_order(customer_id)
+    create_promocode("LATE10")
+    db = SessionLocal()
+    try:
+        db.add(PaymentAttempt(order_id=processing_order, idempotency_key="k", status="processing", amount=100.0, currency="RUB"))
+        db.commit()
+    finally:
+        db.close()
+
+    for order_id in (paid_order, processing_order):
+        response = client.post(f"/orders/{order_id}/promocode", params={"code": "LATE10"}, headers=headers)
+        assert response.status_code == 409
@@ -0,0 +1,48 @@
+from cache import redis_client
+from courier_ratings import MAINTENANCE_LOCK_KEY, CourierRatingSnapshot
+from database import SessionLocal
+from models import Courier, CourierRating, Review
+
+def review(client, order_id: int, headers: dict, rating: int = 5):
+    return client.post(f"/orders/{order_id}/review", json={"rating": rating, "comment": "Отлично"}, headers=headers)
+
+def test_review_requires_order_owner(client, make_user, make_order):
+    _, customer_id, headers = make_user("reviewer@example.com")
+    _, _, stranger = make_user("stranger@example.com")
+    order_id = make_order(customer_id, status="delivered")
+    assert review(client, order_id, stranger).status_code == 403
+    assert review(client, order_id, headers).status_code == 200
+    db = SessionLocal()
+    try:
+        assert db.query(Review.customer_id).filter(Review.order_id == order_id).all() == [(customer_id,)]
+    finally:
+        db.close()
+
+def test_one_review_per_order(client, make_user, make_order):
+    _, customer_id, headers = make_user("twice@example.com")
+    order_id = make_order(customer_id, status="delivered")
+    assert review(client, order_id, headers).status_code == 200
+    assert review(client, order_id, headers, rating=1).status_code == 409
+
+def test_snapshot_rebuild_runs_under_lock(client):
+    db = SessionLocal()
+    try:
+        courier = Courier(name="Курьер", phone="+70000000000")
+        db.add(courier)
+        db.flush()
+        db.add(Review(courier_id=courier.id, rating=4))
+        db.commit()
+        snapshot = CourierRatingSnapshot(refresh_interval_seconds=60, window_days=30, prior_mean=4.5, prior_weight=5)
+        # Пока блокировку держит другой воркер, агрегаты не пересобираются
+        lock = redis_client.lock(MAINTENANCE_LOCK_KEY, timeout=60)
+        assert lock.acquire()
+        try:
+            snapshot.load(db)
+        finally:
+            lock.release()
+        assert db.query(CourierRating).count() == 0
+        snapshot.load(db)
+        assert db.query(CourierRating.courier_id, CourierRating.review_count).all() == [(courier.id, 1)]
+        assert snapshot.get(courier.id).count == 1
+    finally:
+        db.close()
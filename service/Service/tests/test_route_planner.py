@@ -0,0 +1,35 @@
+import asyncio
+from datetime import datetime
+from spatial_index import CourierSpatialIndex
+from route_planner import RoutePlanner
+
+def make_planner() -> RoutePlanner:
+    index = CourierSpatialIndex()
+    index.update(1, 55.750, 37.610)
+    return RoutePlanner(index=index, speed_kmh=25.0, stop_service_minutes=5.0,
+                        tick_seconds=3600, min_eta_change_seconds=30.0)
+
+def tick(planner: RoutePlanner) -> int:
+    return asyncio.get_event_loop().run_until_complete(planner.tick())
+
+def test_tick_orders_stops_and_sets_etas():
+    planner = make_planner()
+    planner.add_stop(1, 10, 55.800, 37.610)
+    planner.add_stop(1, 11, 55.760, 37.610)
+    assert tick(planner) == 1
+    assert [stop.order_id for stop in planner.routes[1].stops] == [11, 10]
+    assert planner.eta(11) < planner.eta(10)
+    assert set(planner.take_pending_writes()) == {10, 11}
+
+def test_plan_for_changed_route_is_discarded():
+    planner = make_planner()
+    planner.add_stop(1, 10, 55.800, 37.610)
+    jobs, _ = planner._collect()
+    plans = planner._plan(jobs, datetime.utcnow())
+    # Пока маршрут считался в пуле потоков, курьеру добавили остановку
+    planner.add_stop(1, 11, 55.760, 37.610)
+    planner._apply(jobs, plans)
+    assert planner.eta(10) is None
+    tick(planner)
+    assert [stop.order_id for stop in planner.routes[1].stops] == [11, 10]
+    assert planner.eta(10) is not None
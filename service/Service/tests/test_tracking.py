@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+from starlette.websockets import WebSocketDisconnect
+from database import SessionLocal
+from gps_tracker import GPSTracker, gps_tracker
+from location_history import LocationCompactor, iter_track
+from models import Courier, CourierLocation, OrderStatus, UserRole
+from spatial_index import courier_index
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+def test_watcher_follows_reassignment_and_closes_on_delivery():
+    tracker = GPSTracker(min_interval=0, bridge_enabled=False)
+    watcher = tracker.watch(order_id=1, courier_id=5)
+    other = tracker.watch(order_id=2, courier_id=5)
+
+    run(tracker.on_order_update(1, OrderStatus.ASSIGNED_TO_COURIER, 7))
+    assert watcher.courier_id == 7
+    assert tracker.watchers[7] == {watcher}
+    assert tracker.watchers[5] == {other}
+
+    run(tracker.on_order_update(1, OrderStatus.DELIVERED, 7))
+    assert run(watcher.next_frame()) is None
+    tracker.unwatch(watcher)
+    assert 7 not in tracker.watchers
+    assert set(tracker.order_watchers) == {2}
+    assert not other.closed
+
+def test_track_merges_segments_and_late_raw_points_by_time(client, make_user):
+    courier_user, _, _ = make_user("track-courier@example.com", UserRole.COURIER)
+    base = datetime(2024, 5, 1, 12, 0)
+    db = SessionLocal()
+    try:
+        courier = Courier(user_id=courier_user, name="Курьер", phone="+70000000000")
+        db.add(courier)
+        db.flush()
+        db.add_all(
+            CourierLocation(courier_id=courier.id, latitude=55.75 + i * 0.001, longitude=37.61, timestamp=base + timedelta(minutes=i))
+            for i in range(5)
+        )
+        db.flush()
+        # Первые три точки сворачиваются в сегмент, следом приходит опоздавшая точка из того же интервала
+        compactor = LocationCompactor(retention_hours=1, interval_seconds=3600, tolerance_m=0)
+        assert compactor.compact_courier(db, courier.id, base + timedelta(minutes=3)) == (3, 3)
+        db.add(CourierLocation(courier_id=courier.id, latitude=55.7515, longitude=37.61,
+                               timestamp=base + timedelta(minutes=1, seconds=30)))
+        db.commit()
+
+        timestamps = [timestamp for timestamp, _, _ in iter_track(db, courier.id, base, base + timedelta(hours=1))]
+    finally:
+        db.close()
+    assert timestamps == sorted(timestamps)
+    assert len(timestamps) == 6
+
+def test_courier_location_socket_requires_own_token(client, make_user):
+    courier_user, _, headers = make_user("socket-courier@example.com", UserRole.COURIER)
+    _, _, stranger = make_user("socket-stranger@example.com", UserRole.COURIER)
+    db = SessionLocal()
+    try:
+        courier = Courier(user_id=courier_user, name="Курьер", phone="+70000000000", is_available=True)
+        db.add(courier)
+        db.commit()
+        courier_id = courier.id
+    finally:
+        db.close()
+    url = f"/ws/courier/{courier_id}/location?token="
+
+    for token, code in (("invalid", 4401), (stranger["Authorization"][7:], 4403)):
+        with pytest.raises(WebSocketDisconnect) as rejected:
+            with client.websocket_connect(url + token) as websocket:
+                websocket.receive_text()
+        assert rejected.value.code == code
+
+    with client.websocket_connect(url + headers["Authorization"][7:]) as websocket:
+        websocket.send_json({"latitude": 55.75, "longitude": 37.61})
+        # Подключенному курьеру его же кадр возвращается эхом
+        assert websocket.receive_json()["latitude"] == 55.75
+        websocket.send_json({"latitude": "север"})
+        with pytest.raises(WebSocketDisconnect) as closed:
+            websocket.receive_text()
+        assert closed.value.code == 1007
+    assert courier_index.get(courier_id).latitude == 55.75
+    assert courier_id not in gps_tracker.active_connections
+    courier_index.remove(courier_id)